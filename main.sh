@@ -1,19 +1,14 @@
 raw_data_dir=raw_data
 output_dir=output
 
-data_year=2022
-nibrs_zipped_file=$raw_data_dir/nibrs-$data_year.zip
+data_years=(2022)
 
-if [[ ! -f $nibrs_zipped_file ]]; then
-    echo "No NIBRS zipped file found in $raw_data_dir. Aborting shell script..."
-    exit 1
-fi
-
-nibrs_mf=$raw_data_dir/${data_year}_NIBRS_NATIONAL_MASTER_FILE_ENC.txt
-
-if [[ ! -f $nibrs_mf ]]; then
-    unzip $nibrs_zipped_file -d $raw_data_dir
-fi
+for data_year in ${data_years[@]}; do
+    if [[ ! -f $raw_data_dir/nibrs-$data_year.zip ]]; then
+        echo "No NIBRS zipped file for $data_year found in $raw_data_dir. Aborting shell script..."
+        exit 1
+    fi
+done
 
 src=src/
 
@@ -29,16 +24,16 @@ for prefix in ${segment_prefixes[@]}; do
     nibrs_segments+=(${prefix}_segment)
 done
 
-for segment in ${nibrs_segments[@]}; do
-    echo "Decoding $segment..."
-    python src/decode_segments.py \
-        --output_dir=$output_dir \
-        --nibrs_master_file=$nibrs_mf \
-        --config_file=configuration/col_specs.yaml \
-        --segment_name=$segment \
-        --to_aws_s3
-done
-
-wait
+echo "Decoding ${nibrs_segments[@]} for ${data_years[@]}..."
+python src/run_pipeline.py \
+    --years ${data_years[@]} \
+    --raw_data_dir=$raw_data_dir \
+    --output_dir=$output_dir \
+    --config_file=configuration/col_specs.yaml \
+    --segment_name ${nibrs_segments[@]} \
+    --max_memory_gb=16 \
+    --engine=numpy \
+    --nibrs_codes_file=configuration/nibrs_codes.yaml \
+    --to_aws_s3
 
 echo "Done. All segments have been decoded."
\ No newline at end of file
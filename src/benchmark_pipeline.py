@@ -0,0 +1,167 @@
+import argparse
+import multiprocessing
+import os
+import resource
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from time import perf_counter
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from utils import general_utils, NIBRSDecoder, NIBRSCodeMapper, SyntheticMasterFile
+
+STAGES = ("decode", "export", "load")
+
+def _peak_rss_mb() -> float:
+    '''
+    returns the peak resident set size of this process or of any of its (finished) worker processes
+    '''
+    peak_kb = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                  resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    
+    return round(peak_kb / 1024, 1)
+
+def run_stage(stage: str, master_file: str, config_file: str, nibrs_codes_file: str, engine: str, n_workers: int,
+              export_dir: str, postgres_config_file: str, copy_format: str) -> dict:
+    '''
+    runs one benchmark in its own process (so that its peak RSS is its own), timing only the given stage
+    '''
+    config = general_utils.load_yaml(config_file)
+    code_mapper = NIBRSCodeMapper(general_utils.load_yaml(nibrs_codes_file)) if nibrs_codes_file else None
+    segment_names = list(config["segment_level_codes"].keys())
+    
+    start = perf_counter()
+    decoder = NIBRSDecoder(master_file, config, engine = engine, n_workers = n_workers)
+    out_tables = decoder.decode_segments(segment_names)
+    seconds = perf_counter() - start
+    n_rows = sum(len(out_table) for out_table in out_tables.values())
+    n_bytes = os.path.getsize(master_file)
+    
+    if stage in ("export", "load"):
+        out_files = []
+        
+        start = perf_counter()
+        for segment_name, out_table in out_tables.items():
+            if code_mapper is not None:
+                out_table = code_mapper.encode(out_table, segment_name)
+            
+            out_table = NIBRSDecoder.add_db_id(out_table, "benchmark")
+            
+            out_file = Path(export_dir).joinpath(f"{segment_name}.parquet")
+            pq.write_table(out_table, out_file)
+            out_files.append((segment_name, out_file))
+        export_seconds = perf_counter() - start
+        
+        if stage == "export":
+            seconds = export_seconds
+            n_bytes = sum(out_file.stat().st_size for _, out_file in out_files)
+    
+    if stage == "load":
+        from db_design import Postgres # only the load stage needs a database driver
+        
+        del out_tables
+        postgres_tool = Postgres(**general_utils.load_yaml(postgres_config_file)["postgresql"])
+        
+        start = perf_counter()
+        try:
+            for segment_name, out_file in out_files:
+                postgres_tool.bulk_load_year(f"raw.{segment_name}", Path(master_file).name[0:4], 
+                                             [lambda out_file = out_file: pq.ParquetFile(out_file).iter_batches()],
+                                             copy_format = copy_format)
+        finally:
+            postgres_tool.close_pool()
+        seconds = perf_counter() - start
+        n_bytes = sum(out_file.stat().st_size for _, out_file in out_files)
+    
+    return {
+        "stage": stage,
+        "engine": engine,
+        "n_workers": n_workers,
+        "rows": n_rows,
+        "seconds": round(seconds, 3),
+        "rows_per_second": round(n_rows / seconds),
+        "mb_per_second": round(n_bytes / 1024 ** 2 / seconds, 1),
+        "peak_rss_mb": _peak_rss_mb()
+        }
+
+def main(args: argparse.Namespace) -> None:
+    '''
+    benchmarks decode, export, and load across engines and synthetic master files of several sizes
+    '''
+    start = perf_counter()
+    output_dir, logger = general_utils.create_output_dir_and_logger(
+        output_dir_str = args.output_dir,
+        log_file = f"{Path(__file__).stem}.log"
+        )
+    
+    if "load" in args.stages and not args.postgres_config:
+        raise ValueError("The load stage requires --postgres_config; point it at a scratch database, since "
+                         "every run appends its rows to the raw tables.")
+    
+    config = general_utils.load_yaml(args.config_file)
+    nibrs_codes = general_utils.load_yaml(args.nibrs_codes_file) if args.nibrs_codes_file else None
+    
+    results = []
+    for n_incidents in args.n_incidents:
+        data_dir = output_dir.joinpath("data", f"{n_incidents}_incidents_seed_{args.seed}")
+        master_file = data_dir.joinpath(f"{args.data_year}_NIBRS_NATIONAL_MASTER_FILE_ENC.txt")
+        
+        if not master_file.exists():
+            logger.info(f"Generating {n_incidents} synthetic incidents...")
+            SyntheticMasterFile(config, nibrs_codes, data_year = args.data_year, seed = args.seed).write(master_file, n_incidents)
+        
+        master_file_mb = round(master_file.stat().st_size / 1024 ** 2, 1)
+        export_dir = data_dir.joinpath("export")
+        export_dir.mkdir(exist_ok = True)
+        
+        for engine in args.engines:
+            for stage in args.stages:
+                n_workers = args.n_workers if engine == "numpy" else 1
+                
+                for repeat in range(args.repeats):
+                    logger.info(f"{stage} with {engine} (n_workers = {n_workers}) on {master_file_mb} MB, run {repeat + 1}...")
+                    
+                    with ProcessPoolExecutor(max_workers = 1, mp_context = multiprocessing.get_context("spawn")) as executor:
+                        result = executor.submit(run_stage, stage, str(master_file), args.config_file, args.nibrs_codes_file,
+                                                 engine, n_workers, str(export_dir), args.postgres_config,
+                                                 args.copy_format).result()
+                    
+                    results.append({"n_incidents": n_incidents, "master_file_mb": master_file_mb, "run": repeat + 1, **result})
+                    logger.info(result)
+    
+    results = pd.DataFrame(results)
+    results.to_csv(output_dir.joinpath("benchmark_results.csv"), index = False)
+    
+    summary = (results.groupby(["n_incidents", "master_file_mb", "stage", "engine", "n_workers"], sort = False)
+               [["rows", "seconds", "rows_per_second", "mb_per_second", "peak_rss_mb"]]
+               .median())
+    
+    logger.info(f"Median of {args.repeats} run(s):\n{summary.to_string()}")
+    
+    end = perf_counter()
+    
+    logger.info(f"Done. Total run time: {round((end - start) / 60, 2)} minutes")
+
+def parse_args(argv: list = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description = main.__doc__)
+    parser.add_argument("--output_dir", "-o", default = "benchmarks",
+                        help = "where the synthetic master files, exports, logs, and benchmark_results.csv are written")
+    parser.add_argument("--config_file", "-c", default = "configuration/col_specs.yaml")
+    parser.add_argument("--nibrs_codes_file", "-n",
+                        help = "if specified, code columns are drawn from its code lists and encoded on export")
+    parser.add_argument("--data_year", "-y", type = int, default = 2022)
+    parser.add_argument("--n_incidents", type = int, nargs = "+", default = [10_000, 100_000],
+                        help = "size(s) of the synthetic master files, at about 650 bytes per incident")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--engines", "-e", nargs = "+", default = ["pandas", "numpy"], choices = ["pandas", "numpy"])
+    parser.add_argument("--stages", nargs = "+", default = ["decode", "export"], choices = STAGES)
+    parser.add_argument("--n_workers", "-w", type = int, default = 1, help = "processes per decode with the numpy engine")
+    parser.add_argument("--repeats", type = int, default = 3)
+    parser.add_argument("--postgres_config", "-postgres", help = ".yaml file with postgresql key; required by the load stage")
+    parser.add_argument("--copy_format", default = "text", choices = ["text", "binary"])
+    
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,143 @@
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from io import RawIOBase
+
+# Encoders for the payload of postgres' COPY ... FROM STDIN, which turn one pyarrow record batch at a time
+# into bytes with vectorized pyarrow compute kernels rather than a Python loop over rows.
+# https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9
+
+COPY_FORMATS = ("text", "binary")
+
+BINARY_HEADER = b"PGCOPY\n\xff\r\n\x00" + np.array([0, 0], dtype = ">i4").tobytes()
+BINARY_TRAILER = np.array([-1], dtype = ">i2").tobytes()
+
+# postgres type (as in information_schema.columns.data_type): numpy dtype of its binary representation
+_FIXED_WIDTH_PG_TYPES = {
+    "smallint": ">i2",
+    "integer": ">i4",
+    "bigint": ">i8",
+    "date": ">i4",
+    "boolean": "u1"
+}
+
+_TEXT_PG_TYPES = ("text", "character varying", "character")
+
+_DAYS_FROM_UNIX_TO_PG_EPOCH = 10957 # 1970-01-01 to 2000-01-01
+
+def _concat_values(array: pa.Array) -> bytes:
+    '''
+    returns the values of a binary or string array without nulls, back to back, straight from its data buffer
+    '''
+    _, offsets, data = array.buffers()
+    offsets = np.frombuffer(offsets, dtype = np.int32)
+    
+    start, end = offsets[array.offset], offsets[array.offset + len(array)]
+    
+    return data[start:end].to_pybytes()
+
+def _to_fixed_binary(values: np.ndarray) -> pa.Array:
+    '''
+    returns a binary array with one value per element of values, which holds its bytes
+    '''
+    return pa.FixedSizeBinaryArray.from_buffers(pa.binary(values.dtype.itemsize), len(values),
+                                                [None, pa.py_buffer(values.tobytes())]).cast(pa.binary())
+
+def _decode_dictionary(column: pa.Array) -> pa.Array:
+    return column.dictionary_decode() if pa.types.is_dictionary(column.type) else column
+
+def _to_text_field(column: pa.Array) -> pa.Array:
+    '''
+    casts column to strings in COPY's text format; escapes are only needed for string columns
+    '''
+    column = _decode_dictionary(column)
+    is_string = pa.types.is_string(column.type) or pa.types.is_large_string(column.type)
+    column = pc.cast(column, pa.string())
+    
+    if is_string:
+        for character, escaped in (("\\", "\\\\"), ("\t", "\\t"), ("\n", "\\n"), ("\r", "\\r")):
+            column = pc.replace_substring(column, character, escaped)
+    
+    return column
+
+def encode_text(batch: pa.RecordBatch) -> bytes:
+    '''
+    encodes batch in COPY's text format: one tab-delimited line per row, with \\N for missing values
+    '''
+    rows = pc.binary_join_element_wise(*[_to_text_field(column) for column in batch.columns], "\t",
+                                       null_handling = "replace", null_replacement = "\\N")
+    
+    return _concat_values(pc.binary_join_element_wise(rows, "", "\n"))
+
+def _to_binary_field(column: pa.Array, pg_type: str) -> pa.Array:
+    '''
+    returns column's fields in COPY's binary format, i.e., each value's length as a 4-byte integer
+    (-1 if missing) followed by its bytes in pg_type's binary representation
+    '''
+    column = _decode_dictionary(column)
+    is_null = column.is_null()
+    
+    if pg_type in _FIXED_WIDTH_PG_TYPES:
+        if pg_type == "date":
+            days = pc.cast(pc.cast(column, pa.date32()), pa.int32()).fill_null(0).to_numpy()
+            values = days - _DAYS_FROM_UNIX_TO_PG_EPOCH
+        else:
+            values = column.fill_null(False if pa.types.is_boolean(column.type) else 0).to_numpy(zero_copy_only = False)
+            
+            if pg_type != "boolean":
+                limits = np.iinfo(_FIXED_WIDTH_PG_TYPES[pg_type])
+                
+                if len(values) > 0 and (values.min() < limits.min or values.max() > limits.max):
+                    raise ValueError(f"Column {column.type} has values that do not fit in postgres type {pg_type}.")
+        
+        data = _to_fixed_binary(np.asarray(values).astype(_FIXED_WIDTH_PG_TYPES[pg_type]))
+    elif pg_type in _TEXT_PG_TYPES:
+        data = pc.cast(pc.cast(column, pa.string()), pa.binary()).fill_null(b"")
+    else:
+        raise ValueError(f"Postgres type {pg_type} is not supported by the binary COPY format; use the text format.")
+    
+    lengths = np.where(is_null.to_numpy(zero_copy_only = False), -1, pc.binary_length(data).to_numpy()).astype(">i4")
+    data = pc.if_else(is_null, pa.scalar(b"", pa.binary()), data)
+    
+    return pc.binary_join_element_wise(_to_fixed_binary(lengths), data, b"")
+
+def encode_binary(batch: pa.RecordBatch, pg_types: list) -> bytes:
+    '''
+    pg_types: the postgres type of each of batch's columns in the target table, as in
+    information_schema.columns.data_type
+    
+    encodes batch's rows in COPY's binary format, without the file header and trailer
+    (BINARY_HEADER and BINARY_TRAILER)
+    '''
+    row_header = _to_fixed_binary(np.full(batch.num_rows, batch.num_columns, dtype = ">i2"))
+    fields = [_to_binary_field(column, pg_type) for column, pg_type in zip(batch.columns, pg_types)]
+    
+    return _concat_values(pc.binary_join_element_wise(row_header, *fields, b""))
+
+class CopyStream(RawIOBase):
+    def __init__(self, chunks):
+        '''
+        chunks: an iterable of bytes
+        
+        a read-only file object that pulls chunks one at a time as they are read
+        '''
+        self._chunks = iter(chunks)
+        self._chunk = memoryview(b"")
+    
+    def readable(self) -> bool:
+        return True
+    
+    def readinto(self, out_buffer) -> int:
+        while not self._chunk:
+            chunk = next(self._chunks, None)
+            
+            if chunk is None:
+                return 0
+            
+            self._chunk = memoryview(chunk)
+        
+        n_bytes = min(len(out_buffer), len(self._chunk))
+        out_buffer[:n_bytes] = self._chunk[:n_bytes]
+        self._chunk = self._chunk[n_bytes:]
+        
+        return n_bytes
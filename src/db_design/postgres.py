@@ -1,7 +1,19 @@
 import sqlalchemy
 import psycopg2
+from psycopg2 import pool, sql
 import polars as pl
-from io import StringIO
+import pyarrow as pa
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from io import BufferedReader, StringIO
+from itertools import chain
+from threading import Lock
+from time import perf_counter
+
+from utils.incident_index import KEY_COLS
+from utils.run_metrics import RunMetrics, DISABLED_METRICS
+
+from .copy_formats import COPY_FORMATS, BINARY_HEADER, BINARY_TRAILER, CopyStream, encode_binary, encode_text
 
 # https://www.psycopg.org/docs/cursor.html
 # https://www.psycopg.org/docs/connection.html
@@ -9,15 +21,22 @@ from io import StringIO
 # https://stackoverflow.com/questions/77160257/postgresql-create-database-cannot-run-inside-a-transaction-block
 
 class Postgres:
-    def __init__(self, credentials: dict, schemas: list) -> None:
+    def __init__(self, credentials: dict, schemas: list, max_connections: int = 4, metrics: RunMetrics = None) -> None:
         '''
         credentials: a dictionary of key:value pairs where keys are host, dbname, user, and port
         schemas: a list of desired schemas
+        max_connections: the size of the connection pools, which caps how many chunks self.copy_chunks() loads at once
+        metrics: if specified, every COPY is recorded in it as a copy stage; see RunMetrics
                 
         dbname nor the schemas need not exist beforehand
         '''
         self.credentials = credentials
         self.schemas = schemas
+        self.max_connections = max_connections
+        self.metrics = metrics or DISABLED_METRICS
+        self._pool = None
+        self._pool_lock = Lock()
+        self._sqlalchemy_engine = None
 
     def _create_psycopg2_connection(self, db_name: str = None) -> psycopg2.extensions.connection:
         '''
@@ -48,9 +67,44 @@ class Postgres:
         return url
     
     def create_sqlalchemy_engine(self) -> sqlalchemy.Engine:
-        engine = sqlalchemy.create_engine(self._build_sqlalchemy_url())
+        '''
+        returns the instance's SQLAlchemy engine, which is created on the first call and then reused, 
+        so that its connection pool is shared by every caller
+        '''
+        if self._sqlalchemy_engine is None:
+            self._sqlalchemy_engine = sqlalchemy.create_engine(self._build_sqlalchemy_url(), 
+                                                               pool_size = self.max_connections,
+                                                               pool_pre_ping = True)
+        
+        return self._sqlalchemy_engine
+    
+    @contextmanager
+    def pooled_connection(self):
+        '''
+        borrows a psycopg2 connection to self.credentials["dbname"] from a thread-safe pool, which is created on first use
+        '''
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = pool.ThreadedConnectionPool(1, self.max_connections, **self.credentials)
+        
+        connection = self._pool.getconn()
+        try:
+            yield connection
+        finally:
+            self._pool.putconn(connection, close = bool(connection.closed))
+    
+    def close_pool(self) -> None:
+        '''
+        closes every pooled connection and disposes of the SQLAlchemy engine, if they were created
+        '''
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
         
-        return engine
+        if self._sqlalchemy_engine is not None:
+            self._sqlalchemy_engine.dispose()
+            self._sqlalchemy_engine = None
         
     def initialize_database(self, default_db: str = "postgres") -> None:
         '''
@@ -96,4 +150,329 @@ class Postgres:
         finally:
             connection.close()
             nibrs_db_connection.close()
-
+    
+    def _get_pg_types(self, cursor: psycopg2.extensions.cursor, schema: str, table: str, col_names: list) -> list:
+        cursor.execute("select column_name, data_type from information_schema.columns "
+                       "where table_schema = %s and table_name = %s", (schema, table))
+        pg_types = dict(cursor.fetchall())
+        
+        missing_columns = [col_name for col_name in col_names if col_name not in pg_types]
+        if missing_columns:
+            raise KeyError(f"{schema}.{table} does not have columns {', '.join(missing_columns)}.")
+        
+        return [pg_types[col_name] for col_name in col_names]
+    
+    def copy_record_batches(self, table_name: str, record_batches, copy_format: str = "text", 
+                            buffer_size: int = 1024 * 1024) -> dict:
+        '''
+        table_name: a schema-qualified table that already exists, e.g., raw.offense_segment
+        record_batches: an iterable of pyarrow record batches (or tables) with the same columns, all of 
+        which must be in table_name
+        copy_format: 'text' or 'binary' (integer, date, boolean, and string columns only)
+        
+        bulk loads record_batches into table_name with a single COPY ... FROM STDIN; returns its rows, seconds, and rows per second
+        '''
+        if copy_format not in COPY_FORMATS:
+            raise ValueError(f"Invalid copy_format '{copy_format}': only {', '.join(COPY_FORMATS)} are allowed.")
+        
+        schema, _, table = table_name.rpartition(".")
+        record_batches = iter(record_batches)
+        first_batch = next(record_batches, None)
+        
+        if first_batch is None:
+            return {"rows": 0, "seconds": 0.0, "rows_per_second": 0.0}
+        
+        col_names = first_batch.schema.names
+        
+        start = perf_counter()
+        with self.metrics.stage("copy", table = table_name, copy_format = copy_format) as stage:
+            with self.pooled_connection() as connection:
+                with connection:
+                    with connection.cursor() as cur:
+                        pg_types = self._get_pg_types(cur, schema or "public", table, col_names) if copy_format == "binary" else None
+                        counts = self._copy_into(cur, sql.Identifier(*filter(None, (schema, table))), 
+                                                 chain([first_batch], record_batches), col_names, copy_format, 
+                                                 pg_types, buffer_size)
+            
+            stage.add(**counts)
+        
+        seconds = perf_counter() - start
+        
+        return {"rows": counts["rows"], "seconds": round(seconds, 2), "rows_per_second": round(counts["rows"] / seconds)}
+    
+    def _copy_into(self, cur: psycopg2.extensions.cursor, table: sql.Composable, record_batches, col_names: list, 
+                   copy_format: str, pg_types: list = None, buffer_size: int = 1024 * 1024) -> dict:
+        '''
+        streams record_batches into table with a single COPY ... FROM STDIN on cur, within the caller's transaction
+        '''
+        counts = {"rows": 0, "bytes_out": 0, "encode_seconds": 0.0}
+        
+        def encoded_batches(encode):
+            for batch in record_batches:
+                for record_batch in (batch.to_batches() if isinstance(batch, pa.Table) else [batch]):
+                    if record_batch.schema.names != col_names:
+                        raise ValueError(f"Every record batch must have the columns {', '.join(col_names)}.")
+                    
+                    encode_start = perf_counter()
+                    encoded = encode(record_batch)
+                    counts["encode_seconds"] += perf_counter() - encode_start
+                    
+                    counts["rows"] += record_batch.num_rows
+                    counts["bytes_out"] += len(encoded)
+                    yield encoded
+        
+        if copy_format == "binary":
+            chunks = chain([BINARY_HEADER], encoded_batches(lambda batch: encode_binary(batch, pg_types)), [BINARY_TRAILER])
+        else:
+            chunks = encoded_batches(encode_text)
+        
+        command = sql.SQL("copy {} ({}) from stdin with (format {})").format(
+            table,
+            sql.SQL(", ").join(map(sql.Identifier, col_names)),
+            sql.SQL(copy_format)
+            )
+        
+        cur.copy_expert(command, BufferedReader(CopyStream(chunks), buffer_size = buffer_size), size = buffer_size)
+        
+        return counts
+    
+    def merge_incident_changes(self, table_name: str, data_year: int, changes, record_batches, 
+                               copy_format: str = "text") -> dict:
+        '''
+        table_name: a schema-qualified table partitioned by data_year that already holds data_year, 
+        e.g., raw.offense_segment
+        changes: an iterable of pyarrow record batches (or tables) with the keys (ori and incident_number) 
+        of the incidents that changed, e.g., IncidentDelta.changes
+        record_batches: an iterable of pyarrow record batches (or tables) with the new rows of those 
+        incidents, e.g., IncidentDelta.rows
+        
+        replaces the rows of the changed incidents in the year's partition in a single transaction; returns the
+        numbers of changed incidents and of deleted and inserted rows, and the seconds it took
+        '''
+        if copy_format not in COPY_FORMATS:
+            raise ValueError(f"Invalid copy_format '{copy_format}': only {', '.join(COPY_FORMATS)} are allowed.")
+        
+        schema, _, table = Postgres.partition_name(table_name, data_year).rpartition(".")
+        target = sql.Identifier(*filter(None, (schema, table)))
+        key_cols = list(KEY_COLS)
+        record_batches = iter(record_batches)
+        first_batch = next(record_batches, None)
+        
+        start = perf_counter()
+        with self.metrics.stage("merge", table = table_name) as stage:
+            with self.pooled_connection() as connection:
+                with connection:
+                    with connection.cursor() as cur:
+                        cur.execute(sql.SQL("create temp table incident_changes ({}) on commit drop").format(
+                            sql.SQL(", ").join(sql.SQL("{} text").format(sql.Identifier(col)) for col in key_cols)
+                            ))
+                        key_counts = self._copy_into(cur, sql.Identifier("incident_changes"), 
+                                                     (batch.select(key_cols) for batch in changes), key_cols, "text")
+                        cur.execute("analyze incident_changes")
+                        
+                        # plain equality, so that each changed incident is looked up in the (ori, incident_number) index
+                        cur.execute(sql.SQL("delete from {} as t using incident_changes as c where {}").format(
+                            target,
+                            sql.SQL(" and ").join(sql.SQL("t.{col} = c.{col}").format(col = sql.Identifier(col)) for col in key_cols)
+                            ))
+                        n_deleted = cur.rowcount
+                        
+                        # incidents with a missing key match on nulls too, as in IncidentDelta
+                        has_null_key = sql.SQL(" or ").join(sql.SQL("{} is null").format(sql.Identifier(col)) for col in key_cols)
+                        cur.execute(sql.SQL("select exists (select 1 from incident_changes where {})").format(has_null_key))
+                        
+                        if cur.fetchone()[0]:
+                            cur.execute(sql.SQL("delete from {} as t using (select * from incident_changes where {}) as c where {}").format(
+                                target, has_null_key,
+                                sql.SQL(" and ").join(sql.SQL("t.{col} is not distinct from c.{col}").format(col = sql.Identifier(col)) for col in key_cols)
+                                ))
+                            n_deleted += cur.rowcount
+                        n_inserted = 0
+                        
+                        if first_batch is not None:
+                            col_names = first_batch.schema.names
+                            pg_types = self._get_pg_types(cur, schema or "public", table, col_names) if copy_format == "binary" else None
+            
+                            cur.execute(sql.SQL("create temp table incident_rows (like {} including defaults) on commit drop").format(target))
+                            row_counts = self._copy_into(cur, sql.Identifier("incident_rows"), chain([first_batch], record_batches), 
+                                                         col_names, copy_format, pg_types)
+        
+                            columns = sql.SQL(", ").join(map(sql.Identifier, col_names))
+                            cur.execute(sql.SQL("insert into {} ({}) select {} from incident_rows").format(target, columns, columns))
+                            n_inserted = cur.rowcount
+                            stage.add(bytes_out = row_counts["bytes_out"], encode_seconds = row_counts["encode_seconds"])
+        
+            stage.add(rows = n_inserted, changed_incidents = key_counts["rows"], deleted_rows = n_deleted)
+        
+        return {"table_name": table_name, "changed_incidents": key_counts["rows"], "deleted_rows": n_deleted, 
+                "inserted_rows": n_inserted, "seconds": round(perf_counter() - start, 2)}
+    
+    @staticmethod
+    def partition_name(table_name: str, data_year: int) -> str:
+        '''
+        returns the name of the partition of data_year of a table partitioned by data_year, e.g., 
+        raw.offense_segment_2022; see raw_tables.build_raw_tables()
+        '''
+        return f"{table_name}_{data_year}"
+    
+    @staticmethod
+    def _table_identifier(table_name: str) -> sql.Identifier:
+        schema, _, table = table_name.rpartition(".")
+        
+        return sql.Identifier(*filter(None, (schema, table)))
+    
+    def create_year_partition(self, table_name: str, data_year: int, truncate: bool = False) -> str:
+        '''
+        table_name: a schema-qualified table partitioned by data_year, e.g., raw.offense_segment
+        truncate: if True, the partition is emptied if it exists, so that loading the year again replaces its rows
+        
+        creates the partition of data_year of table_name, if it does not exist, and returns its name
+        '''
+        partition_name = Postgres.partition_name(table_name, data_year)
+        partition = Postgres._table_identifier(partition_name)
+        
+        with self.pooled_connection() as connection:
+            with connection:
+                with connection.cursor() as cur:
+                    cur.execute(sql.SQL("create table if not exists {} partition of {} for values in ({})").format(
+                        partition, Postgres._table_identifier(table_name), sql.Literal(int(data_year))
+                        ))
+                    cur.execute(sql.SQL("alter table {} alter column data_year set default {}").format(
+                        partition, sql.Literal(int(data_year))
+                        ))
+                    
+                    if truncate:
+                        cur.execute(sql.SQL("truncate table {}").format(partition))
+        
+        return partition_name
+    
+    def _get_indexes(self, cursor: psycopg2.extensions.cursor, table_name: str) -> list:
+        '''
+        returns (is_primary, is_unique, col_names) of every index of table_name
+        '''
+        cursor.execute("select i.indisprimary, i.indisunique, array_agg(a.attname::text order by k.position) "
+                       "from pg_index as i "
+                       "cross join unnest(i.indkey::int2[]) with ordinality as k(attnum, position) "
+                       "join pg_attribute as a on a.attrelid = i.indrelid and a.attnum = k.attnum "
+                       "where i.indrelid = %s::regclass "
+                       "group by i.indexrelid, i.indisprimary, i.indisunique", (table_name,))
+        
+        return cursor.fetchall()
+    
+    def bulk_load_year(self, table_name: str, data_year: int, chunks: list, max_concurrency: int = None, 
+                       copy_format: str = "text", max_retries: int = 2) -> dict:
+        '''
+        table_name: a schema-qualified table partitioned by data_year, e.g., raw.offense_segment
+        chunks: a list of functions that each return a fresh iterable of the record batches of one chunk 
+        of the year, e.g., one per parquet row group
+        
+        loads a whole year into an unindexed UNLOGGED table, indexes it, and attaches it as the partition of data_year,
+        replacing it if it exists; returns the partition, its rows, and the seconds spent in each step
+        '''
+        data_year = int(data_year)
+        partition_name = Postgres.partition_name(table_name, data_year)
+        staging_name = f"{partition_name}_load"
+        parent, partition, staging = map(Postgres._table_identifier, (table_name, partition_name, staging_name))
+        report = {"table_name": table_name, "partition": partition_name}
+        
+        with self.metrics.stage("bulk_load", table = table_name, data_year = data_year) as stage:
+            start = perf_counter()
+            with self.pooled_connection() as connection:
+                with connection:
+                    with connection.cursor() as cur:
+                        cur.execute(sql.SQL("drop table if exists {}").format(staging))
+                        cur.execute(sql.SQL("create unlogged table {} (like {} including defaults)").format(staging, parent))
+                        cur.execute(sql.SQL("alter table {} alter column data_year set default {}, add constraint {} check (data_year = {})").format(
+                            staging, sql.Literal(data_year), 
+                            sql.Identifier(f"{partition_name.rpartition('.')[2]}_data_year_check"), sql.Literal(data_year)
+                            ))
+                        indexes = [(is_primary, is_unique, col_names, "pkey" if is_primary else f"{'_'.join(col_names)}_idx") 
+                                   for is_primary, is_unique, col_names in self._get_indexes(cur, table_name)]
+            
+            load_reports = self.copy_chunks([(staging_name, get_record_batches) for get_record_batches in chunks],
+                                            max_concurrency = max_concurrency, copy_format = copy_format, 
+                                            max_retries = max_retries)
+            
+            failed = [load_report for load_report in load_reports if load_report["status"] == "failed"]
+            if failed:
+                raise Exception(f"{len(failed)} of {len(chunks)} chunks failed to load into {staging_name}, "
+                                f"which was not attached: {failed[0]['error']}")
+            
+            report["rows"] = sum(load_report["rows"] for load_report in load_reports)
+            report["copy_seconds"] = round(perf_counter() - start, 2)
+            
+            start = perf_counter()
+            with self.pooled_connection() as connection:
+                with connection:
+                    with connection.cursor() as cur:
+                        cur.execute(sql.SQL("alter table {} set logged").format(staging))
+                        
+                        for is_primary, is_unique, col_names, index_suffix in indexes:
+                            columns = sql.SQL(", ").join(map(sql.Identifier, col_names))
+                            index = sql.Identifier(f"{staging_name.rpartition('.')[2]}_{index_suffix}")
+                            
+                            if is_primary:
+                                cur.execute(sql.SQL("alter table {} add constraint {} primary key ({})").format(staging, index, columns))
+                            else:
+                                cur.execute(sql.SQL("create {}index {} on {} ({})").format(
+                                    sql.SQL("unique " if is_unique else ""), index, staging, columns
+                                    ))
+                        
+                        cur.execute(sql.SQL("analyze {}").format(staging))
+            
+            report["index_seconds"] = round(perf_counter() - start, 2)
+            
+            start = perf_counter()
+            with self.pooled_connection() as connection:
+                with connection:
+                    with connection.cursor() as cur:
+                        cur.execute(sql.SQL("drop table if exists {}").format(partition))
+                        cur.execute(sql.SQL("alter table {} rename to {}").format(
+                            staging, sql.Identifier(partition_name.rpartition(".")[2])
+                            ))
+                        
+                        for *_, index_suffix in indexes:
+                            cur.execute(sql.SQL("alter index {} rename to {}").format(
+                                Postgres._table_identifier(f"{staging_name}_{index_suffix}"),
+                                sql.Identifier(f"{partition_name.rpartition('.')[2]}_{index_suffix}")
+                                ))
+                        cur.execute(sql.SQL("alter table {} attach partition {} for values in ({})").format(
+                            parent, partition, sql.Literal(data_year)
+                            ))
+            
+            report["attach_seconds"] = round(perf_counter() - start, 2)
+            stage.add(rows = report["rows"])
+        
+        return report
+    
+    def _copy_chunk(self, table_name: str, get_record_batches, copy_format: str, max_retries: int) -> dict:
+        for attempt in range(1, max_retries + 2):
+            try:
+                load_report = self.copy_record_batches(table_name, get_record_batches(), copy_format = copy_format)
+                
+                return {"table_name": table_name, "status": "loaded", "attempts": attempt, **load_report}
+            except (psycopg2.OperationalError, psycopg2.InterfaceError, psycopg2.extensions.TransactionRollbackError, 
+                    OSError) as error:
+                if attempt > max_retries:
+                    return {"table_name": table_name, "status": "failed", "attempts": attempt, "error": repr(error)}
+    
+    def copy_chunks(self, chunks: list, max_concurrency: int = None, copy_format: str = "text", 
+                    max_retries: int = 2) -> list:
+        '''
+        chunks: a list of (table_name, get_record_batches) pairs, where get_record_batches returns a fresh
+        iterable of the chunk's record batches
+        max_concurrency: how many chunks are loaded at the same time; defaults to self.max_connections
+        max_retries: how many more times a chunk is loaded after a connection or serialization error
+        
+        loads the chunks concurrently, each in its own transaction; returns one report per chunk, in order
+        '''
+        max_concurrency = max_concurrency or self.max_connections
+        
+        if max_concurrency > self.max_connections:
+            raise ValueError(f"max_concurrency ({max_concurrency}) cannot exceed max_connections ({self.max_connections}).")
+        
+        with ThreadPoolExecutor(max_workers = max_concurrency) as executor:
+            futures = [executor.submit(self._copy_chunk, table_name, get_record_batches, copy_format, max_retries) 
+                       for table_name, get_record_batches in chunks]
+            
+            return [future.result() for future in futures]
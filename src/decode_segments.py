@@ -5,7 +5,9 @@ from pathlib import Path
 
 from time import perf_counter
 
-from utils import general_utils, NIBRSDecoder, AmazonS3
+import pyarrow.parquet as pq
+
+from utils import general_utils, NIBRSDecoder, ParquetBatchWriter, PartitionedDatasetWriter, NIBRSCodeMapper, DecodeCache, RunMetrics, BatchPipeline, ByteChunkSink, SegmentValidator
 
 def main(args: argparse.Namespace) -> None:
     output_dir: Path
@@ -16,57 +18,431 @@ def main(args: argparse.Namespace) -> None:
         output_dir_str = args.output_dir, 
         log_file = f"{Path(__file__).stem}.log"
         )
-        
-    data_year = Path(args.nibrs_master_file).name[0:4]
+    
+    config = general_utils.load_yaml(args.config_file)
+    metrics = RunMetrics(Path(__file__).stem)
+    code_mapper = NIBRSCodeMapper(general_utils.load_yaml(args.nibrs_codes_file)) if args.nibrs_codes_file else None
+    validator = SegmentValidator(config, code_mapper) if args.validate else None
+    # validation reports unknown codes, so they need not stop the run
+    encode_errors = "coerce" if args.validate else "raise"
+    
+    nibrs_processor_tool = NIBRSDecoder(args.nibrs_master_file, config, 
+                                        engine = args.engine, 
+                                        use_index = args.use_index,
+                                        n_workers = args.n_workers,
+                                        zip_member = args.zip_member,
+                                        metrics = metrics,
+                                        validator = validator)
+    
+    data_year = nibrs_processor_tool.master_file_name[0:4]
+    metrics.labels["data_year"] = data_year
     
     if not data_year.isdigit():
-        logger.warning("Double check args.nibrs_master_file. This text file's file name must be "
+        logger.warning("Double check args.nibrs_master_file (or args.zip_member). This text file's file name must be "
                        "prefixed with the year (e.g., 2022).")
-        
-    logger.info(f"Decoding {args.segment_name}...")
     
-    config = general_utils.load_yaml(args.config_file)
-    
-    nibrs_processor_tool = NIBRSDecoder(args.nibrs_master_file, config)
+    if args.all_segments:
+        segment_names = list(config["segment_level_codes"].keys())
+    elif args.segment_name:
+        segment_names = args.segment_name
+    else:
+        raise ValueError("Specify at least one segment with --segment_name, or toggle --all_segments.")
     
-    out_table = nibrs_processor_tool.decode_segment(args.segment_name)
-    out_table["db_id"] = [f"{data_year}_{i}" for i in out_table.index]
+    if args.delta and (args.batch_size or args.partitioned):
+        raise ValueError("--delta diffs whole segments, so it cannot be combined with --batch_size or --partitioned.")
     
-    out_name = f"{args.segment_name}_{data_year}.parquet"
+    if args.pipelined and (not args.batch_size or args.partitioned):
+        raise ValueError("--pipelined streams batches into one parquet file per segment: it requires --batch_size "
+                         "and cannot be combined with --partitioned.")
     
-    logger.info("Exporting...")
     if args.to_aws_s3:
-        logger.info("Sending decoded segment to s3 bucket...")
+        from utils import AmazonS3 # boto3 and s3fs are slow to import, and a local decode does not need them
         
         AmazonS3_tool = AmazonS3(
             region_name = os.environ["region_name"],
             aws_access_key_id = os.environ["aws_access_key_id"],
-            aws_secret_access_key = os.environ["aws_secret_access_key"]
+            aws_secret_access_key = os.environ["aws_secret_access_key"],
+            part_size = args.s3_part_size_mb * 1024 * 1024,
+            max_concurrency = args.s3_max_concurrency,
+            metrics = metrics
             )
+    
+    if args.partitioned:
+        dataset_name = "dataset"
+        out_names = {segment_name: f"{dataset_name}/{segment_name}/data_year={data_year}" for segment_name in segment_names}
+    else:
+        out_names = {segment_name: f"{segment_name}_{data_year}.parquet" for segment_name in segment_names}
+    
+    def get_location(out_name: str) -> str:
+        if args.to_aws_s3:
+            return f"s3://{config['s3_bucket']}/{out_name}"
+        
+        return str(output_dir.joinpath(out_name).resolve())
+    
+    def location_exists(location: str) -> bool:
+        if location.startswith("s3://"):
+            bucket_name, _, object_name = location.removeprefix("s3://").partition("/")
+            
+            if args.partitioned:
+                return len(AmazonS3_tool.list_objects_in_s3_bucket(bucket_name = bucket_name, prefix = f"{object_name}/")) > 0
+            
+            return AmazonS3_tool.object_exists_in_s3_bucket(bucket_name = bucket_name, object_name = object_name)
+        
+        return Path(location).exists()
+    
+    decode_cache = None
+    if not args.no_cache:
+        decode_cache = DecodeCache(output_dir)
+        master_file_digest = decode_cache.hash_file(args.nibrs_master_file)
+        
+        # everything a segment's output depends on; if any of it changes, the segment is decoded again
+        cache_keys = {segment_name: DecodeCache.make_key(
+            master_file = master_file_digest,
+            zip_member = nibrs_processor_tool.zip_member,
+            segment_level_code = config["segment_level_codes"][segment_name],
+            col_specs = config[segment_name],
+            decoder_version = NIBRSDecoder.VERSION,
+            nibrs_codes_version = code_mapper.version if code_mapper is not None else None,
+            code_columns = code_mapper.get_code_columns_for_segment(segment_name) if code_mapper is not None else None,
+            encode_errors = encode_errors if code_mapper is not None else None,
+            validated = args.validate
+            ) for segment_name in segment_names}
+        
+        up_to_date = [segment_name for segment_name in segment_names 
+                      if decode_cache.is_up_to_date(out_names[segment_name], cache_keys[segment_name], 
+                                                    get_location(out_names[segment_name]), location_exists)]
+        
+        if up_to_date:
+            logger.info(f"Skipping {', '.join(up_to_date)}: up to date in the decode cache.")
+        
+        segment_names = [segment_name for segment_name in segment_names if segment_name not in up_to_date]
+    
+    def record_in_cache(segment_name: str) -> None:
+        if decode_cache is not None:
+            out_name = out_names[segment_name]
+            decode_cache.record(out_name, cache_keys[segment_name], get_location(out_name))
+    
+    def open_writer(segment_name: str):
+        if not args.partitioned and args.to_aws_s3:
+            # row groups are uploaded as parts while the next batches are decoded, with no local copy
+            return ParquetBatchWriter(AmazonS3_tool.open_multipart_writer(bucket_name = config["s3_bucket"],
+                                                                          object_name = out_names[segment_name]))
+        
+        if not args.partitioned:
+            return ParquetBatchWriter(output_dir.joinpath(out_names[segment_name]))
+        
+        if args.to_aws_s3:
+            return PartitionedDatasetWriter(f"{config['s3_bucket']}/{dataset_name}", segment_name, data_year,
+                                            filesystem = AmazonS3_tool.create_arrow_file_system())
+        
+        return PartitionedDatasetWriter(str(output_dir.joinpath(dataset_name)), segment_name, data_year)
+    
+    if not segment_names:
+        logger.info("Nothing to decode.")
+    elif args.pipelined:
+        logger.info(f"Streaming {', '.join(segment_names)} through a decode -> encode -> "
+                    f"{'upload' if args.to_aws_s3 else 'write'} pipeline in batches of up to {args.batch_size} rows...")
+        
+        writers = {}
+        
+        def decode_batches():
+            return nibrs_processor_tool.iter_segment_batches(segment_names, batch_size = args.batch_size)
+        
+        def encode_batches(batches):
+            # encodes every batch as a row group of its segment's parquet file, and passes its bytes on
+            for segment_name, batch in batches:
+                if code_mapper is not None:
+                    batch = code_mapper.encode(batch, segment_name, errors = encode_errors)
+                
+                if segment_name not in writers:
+                    writers[segment_name] = ParquetBatchWriter(ByteChunkSink())
+                
+                writer = writers[segment_name]
+                writer.write_batch(NIBRSDecoder.add_db_id(batch, data_year, first_row = writer.n_rows))
+                
+                yield segment_name, writer.out_file.take()
+            
+            for segment_name, writer in writers.items():
+                writer.close()
+                yield segment_name, writer.out_file.take()
+        
+        def write_chunks(chunks):
+            out_files = {}
+            try:
+                for segment_name, data in chunks:
+                    if segment_name not in out_files:
+                        if args.to_aws_s3:
+                            out_files[segment_name] = AmazonS3_tool.open_multipart_writer(bucket_name = config["s3_bucket"],
+                                                                                          object_name = out_names[segment_name])
+                        else:
+                            out_files[segment_name] = open(output_dir.joinpath(out_names[segment_name]), "wb")
+                    
+                    out_files[segment_name].write(data)
+                    yield segment_name
+            except BaseException:
+                for out_file in out_files.values():
+                    if hasattr(out_file, "abort"):
+                        out_file.abort()
+                    else:
+                        out_file.close()
+                raise
+            
+            for out_file in out_files.values():
+                out_file.close()
+        
+        pipeline = BatchPipeline([("decode", decode_batches),
+                                  ("encode", encode_batches),
+                                  ("upload" if args.to_aws_s3 else "write", write_chunks)],
+                                 queue_size = args.queue_size, metrics = metrics)
+        
+        with metrics.profile("decode", mode = args.profile, out_dir = output_dir.joinpath("logs")):
+            pipeline_report = pipeline.run()
+        
+        for stage_report in pipeline_report:
+            logger.info(f"Pipeline stage {stage_report['stage']}: {stage_report['utilization']:.0%} busy, "
+                        f"{stage_report['starved_seconds']} s waiting for input, "
+                        f"{stage_report['blocked_seconds']} s waiting for the next stage")
+        
+        for segment_name, writer in writers.items():
+            logger.info(f"{segment_name}: {writer.n_rows} rows written to {get_location(out_names[segment_name])}.")
+            record_in_cache(segment_name)
+    elif args.batch_size:
+        logger.info(f"Streaming {', '.join(segment_names)} in batches of up to {args.batch_size} rows...")
+        
+        writers = {}
+        rows_written = {segment_name: 0 for segment_name in segment_names}
+        try:
+            with metrics.profile("decode", mode = args.profile, out_dir = output_dir.joinpath("logs")):
+                for segment_name, batch in nibrs_processor_tool.iter_segment_batches(segment_names, 
+                                                                                     batch_size = args.batch_size):
+                    with metrics.stage("export_batch", segment = segment_name) as stage:
+                        if code_mapper is not None:
+                            batch = code_mapper.encode(batch, segment_name, errors = encode_errors)
+                        
+                        batch = NIBRSDecoder.add_db_id(batch, data_year, first_row = rows_written[segment_name])
+                        rows_written[segment_name] += len(batch)
+                        
+                        if segment_name not in writers:
+                            writers[segment_name] = open_writer(segment_name)
+                        
+                        writers[segment_name].write_batch(batch)
+                        stage.add(rows = len(batch))
+        except BaseException:
+            for writer in writers.values():
+                writer.close()
+                
+                if args.to_aws_s3 and not args.partitioned:
+                    writer.out_file.abort() # so that no partial upload is left in the bucket
+            raise
+        
+        for writer in writers.values():
+            writer.close()
+            
+            if args.to_aws_s3 and not args.partitioned:
+                writer.out_file.close() # uploads the last part and completes the upload
         
-        AmazonS3_tool.upload_table_to_s3_bucket(table = out_table, 
-                                                how = "parquet",
-                                                bucket_name = config["s3_bucket"],
-                                                object_name = out_name)
+        for segment_name, writer in writers.items():
+            logger.info(f"{segment_name}: {writer.n_rows} rows written to {get_location(out_names[segment_name])}.")
+            record_in_cache(segment_name)
     else:
-        out_table.to_parquet(output_dir.joinpath(out_name))
+        logger.info(f"Decoding {', '.join(segment_names)} in a single pass...")
+        
+        with metrics.profile("decode", mode = args.profile, out_dir = output_dir.joinpath("logs")):
+            out_tables = nibrs_processor_tool.decode_segments(segment_names)
+        
+        if nibrs_processor_tool.parallel_report is not None:
+            logger.info(f"Parallel decoding report: {nibrs_processor_tool.parallel_report}")
+        
+        for segment_name, out_table in out_tables.items():
+            with metrics.stage("prepare_export", segment = segment_name) as stage:
+                if code_mapper is not None:
+                    out_table = code_mapper.encode(out_table, segment_name, errors = encode_errors)
+                
+                out_table = NIBRSDecoder.add_db_id(out_table, data_year)
+                stage.add(rows = len(out_table))
+            
+            out_name = out_names[segment_name]
+            
+            if args.delta:
+                from utils import IncidentDelta # polars is only needed to diff releases
+                
+                previous_location = get_location(out_name)
+                
+                if not location_exists(previous_location):
+                    raise FileNotFoundError(f"--delta needs the previous release of {segment_name} at {previous_location}.")
+                
+                logger.info(f"Diffing {segment_name} against its previous release...")
+                with metrics.stage("diff", segment = segment_name) as stage:
+                    if args.to_aws_s3:
+                        previous_table = AmazonS3_tool.read_table_from_s3_bucket(bucket_name = config["s3_bucket"],
+                                                                                 object_name = out_name)
+                    else:
+                        previous_table = pq.read_table(previous_location)
+                    
+                    delta = IncidentDelta.compare(previous_table, out_table, segment_name, data_year)
+                    stage.add(rows = delta.rows.num_rows)
+                
+                # the release is exported with the db_ids its rows have in postgres once the delta is merged
+                out_table = delta.table
+                
+                logger.info(f"{segment_name} delta: {delta.summarize()}")
+                
+                if args.to_aws_s3:
+                    for delta_table, object_name in zip([delta.changes, delta.rows], 
+                                                        IncidentDelta.object_names(segment_name, data_year)):
+                        AmazonS3_tool.upload_table_to_s3_bucket(table = delta_table, 
+                                                                how = "parquet",
+                                                                bucket_name = config["s3_bucket"],
+                                                                object_name = object_name)
+                else:
+                    delta.write(output_dir)
+            
+            logger.info(f"Exporting {segment_name}...")
+            with metrics.stage("export", segment = segment_name) as stage:
+                if args.partitioned:
+                    with open_writer(segment_name) as writer:
+                        writer.write_batch(out_table)
+                elif args.to_aws_s3:
+                    logger.info("Sending decoded segment to s3 bucket...")
+                    
+                    AmazonS3_tool.upload_table_to_s3_bucket(table = out_table, 
+                                                            how = "parquet",
+                                                            bucket_name = config["s3_bucket"],
+                                                            object_name = out_name)
+                else:
+                    pq.write_table(out_table, output_dir.joinpath(out_name))
+                    stage.add(bytes_out = output_dir.joinpath(out_name).stat().st_size)
+                
+                stage.add(rows = len(out_table))
+            
+            record_in_cache(segment_name)
+    
+    if validator is not None and segment_names:
+        violations = validator.violations()
+        violations_file = output_dir.joinpath("logs", f"validation_{data_year}.parquet")
+        pq.write_table(violations, violations_file)
+        
+        logger.info(f"Validation: {validator.summarize()}; violations in {violations_file}")
+        
+        for violation in violations.to_pylist():
+            logger.warning(f"{violation['segment']}.{violation['column']} failed {violation['check']} "
+                           f"(expected {violation['expected']}) in {violation['count']} rows, "
+                           f"e.g., rows {violation['sample_rows']}: {violation['sample_values']}")
+    
+    if decode_cache is not None:
+        evicted = decode_cache.evict()
+        decode_cache.save()
+        
+        if evicted:
+            logger.info(f"Evicted {len(evicted)} least recently used entries from the decode cache.")
+    
+    metrics_file = output_dir.joinpath("logs", f"{Path(__file__).stem}_metrics.json")
+    metrics.write_json(metrics_file)
+    
+    if args.prometheus_textfile:
+        metrics.write_prometheus(args.prometheus_textfile)
+    
+    for totals in metrics.summarize():
+        logger.info(f"{totals['stage']} {totals['labels']}: {round(totals['wall_seconds'], 2)} s wall, "
+                    f"{round(totals['cpu_seconds'], 2)} s CPU, {totals['rows']} rows")
     
     end = perf_counter()
     
-    logger.info(f"Done. Total run time: {round((end - start) / 60, 2)} minutes")
+    logger.info(f"Done. Total run time: {round((end - start) / 60, 2)} minutes; per-stage metrics in {metrics_file}")
     
-if __name__ == "__main__":
+def parse_args(argv: list = None) -> argparse.Namespace:
     parser = argparse.ArgumentParser()
     parser.add_argument("--output_dir", "-o")
-    parser.add_argument("--nibrs_master_file", "-f", help = "path to the NIBRS fixed-length, ASCII text file")
+    parser.add_argument("--nibrs_master_file", "-f", 
+                        help = ("path to the NIBRS fixed-length, ASCII text file, or to the zipped file it comes in "
+                                "(e.g., nibrs-2022.zip), which is decoded without being extracted"))
+    parser.add_argument("--zip_member", "-z", 
+                        help = ("name of the text file inside nibrs_master_file, if it is zipped; only needed if the "
+                                "archive does not have exactly one .txt file"))
     parser.add_argument("--config_file", "-c", help = ".yaml file with 'segment_level_codes' and 's3_bucket' keys, plus any segments of interests as keys")
-    parser.add_argument("--segment_name", "-s", help = "segment of interest to decode; it must be present as key in config_file")
+    parser.add_argument("--segment_name", "-s", nargs = "+",
+                        help = ("segment(s) of interest to decode; each must be present as key in config_file. "
+                                "All of them are decoded in a single pass over nibrs_master_file."))
+    parser.add_argument("--all_segments",
+                        help = "if toggled, every segment in config_file['segment_level_codes'] is decoded in a single pass",
+                        action = "store_true")
+    
+    parser.add_argument("--engine", "-e", default = "pandas", choices = ["pandas", "numpy"],
+                        help = ("how lines are decoded: 'pandas' (pd.read_fwf, the reference) or "
+                                "'numpy' (vectorized fixed-width slicing)"))
+    
+    parser.add_argument("--use_index",
+                        help = ("if toggled, segments are read from their byte ranges in a sidecar index of "
+                                "nibrs_master_file, which is built on first use"),
+                        action = "store_true")
+    
+    parser.add_argument("--n_workers", "-w", type = int, default = 1,
+                        help = ("number of processes that decode newline-aligned byte ranges of nibrs_master_file "
+                                "in parallel; values above 1 require --engine=numpy"))
+    
+    parser.add_argument("--batch_size", "-b", type = int,
+                        help = ("if specified, segments are decoded in batches of up to this many rows and written "
+                                "to parquet one row group at a time, which bounds memory use by the batch size"))
+    
+    parser.add_argument("--pipelined",
+                        help = ("if toggled (with --batch_size), decoding, parquet encoding, and writing or uploading run "
+                                "at the same time in their own threads, joined by bounded queues, so that a run takes about "
+                                "as long as its slowest stage; each stage's utilization is logged"),
+                        action = "store_true")
+    
+    parser.add_argument("--queue_size", type = int, default = 2,
+                        help = "number of batches that can wait between two stages of --pipelined")
+    
+    parser.add_argument("--nibrs_codes_file", "-n",
+                        help = (".yaml file with 'dictionary_version' and 'code_columns' keys (e.g., configuration/nibrs_codes.yaml); "
+                                "if specified, code columns are encoded with its fixed, versioned dictionaries; a code that is "
+                                "not in it stops the run, unless --validate (which run_pipeline.py passes with this file)"))
+    
+    parser.add_argument("--validate",
+                        help = ("if toggled, every batch is validated as it is decoded: record lengths, integer and date fields "
+                                "that do not parse, and codes that are not in nibrs_codes_file (if specified). Violations are "
+                                "logged, with counts and sample row numbers, and written to output_dir/logs/validation_{data_year}.parquet; "
+                                "unknown codes are then encoded as missing values instead of stopping the run"),
+                        action = "store_true")
+    
+    parser.add_argument("--partitioned",
+                        help = ("if toggled, segments are written to a parquet dataset partitioned by data_year and state_code "
+                                "(in output_dir/dataset, or the s3 bucket's dataset/ prefix), sorted by ori and incident_date "
+                                "within each file; rerunning a year replaces only that year's partitions"),
+                        action = "store_true")
+    
+    parser.add_argument("--no_cache",
+                        help = ("if toggled, every segment is decoded even if the decode cache in output_dir says that "
+                                "its output is up to date for this master file, col_specs, and decoder version"),
+                        action = "store_true")
     
     parser.add_argument("--to_aws_s3",
                         help = ("if toggled, the decoded segment won't be exported to output_dir and instead be "
                                 "uploaded to an s3 bucket using secrets configured as environment variables"),
                         action = "store_true")
-
-    args = parser.parse_args()
     
-    main(args)
+    parser.add_argument("--s3_part_size_mb", type = int, default = 16,
+                        help = "size of the parts of multipart uploads to the s3 bucket, in MB (at least 5)")
+    
+    parser.add_argument("--s3_max_concurrency", type = int, default = 8,
+                        help = "number of parts of an upload to the s3 bucket that are sent at the same time")
+    
+    parser.add_argument("--delta",
+                        help = ("if toggled, each segment is diffed incident by incident against its previous release in "
+                                "output_dir (or the s3 bucket) before that is overwritten, and the changed incidents are "
+                                "written next to it as {segment_name}_{data_year}_changes.parquet and _delta.parquet, "
+                                "which ingest_data_into_db.py --delta loads in place of the whole segment"),
+                        action = "store_true")
+    
+    parser.add_argument("--prometheus_textfile",
+                        help = ("if specified, the run's per-stage metrics are also written to this .prom file "
+                                "(e.g., in node_exporter's textfile collector directory)"))
+    
+    parser.add_argument("--profile", choices = ["cprofile", "sampling"],
+                        help = ("if specified, decoding is profiled with cProfile or a sampling profiler, and the "
+                                "profile is written to output_dir/logs"))
+
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,316 @@
+import argparse
+import json
+import os
+import socket
+import socketserver
+import sys
+from pathlib import Path
+from time import perf_counter
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from utils import general_utils, NIBRSDecoder, NIBRSCodeMapper
+
+class DecodeService:
+    def __init__(self, config: dict, output_dir: Path, logger, code_mapper: NIBRSCodeMapper = None,
+                 engine: str = "numpy", use_index: bool = False):
+        '''
+        config: the contents of col_specs.yaml
+        output_dir: where decoded segments are written, unless a request names its own output_dir
+        code_mapper: if specified, code columns are encoded with its dictionaries; see NIBRSCodeMapper
+        
+        serves decode requests (see self.handle()), keeping one NIBRSDecoder per master file across them
+        '''
+        self.config = config
+        self.output_dir = Path(output_dir)
+        self.logger = logger
+        self.code_mapper = code_mapper
+        self.engine = engine
+        self.use_index = use_index
+        self.n_requests = 0
+        self.stopped = False
+        
+        self._decoders = {}
+    
+    def get_decoder(self, nibrs_master_file: str, zip_member: str = None) -> NIBRSDecoder:
+        '''
+        returns the warm decoder of nibrs_master_file, which is created (and its segments compiled) on first use
+        '''
+        key = (str(Path(nibrs_master_file).resolve()), zip_member)
+        decoder = self._decoders.get(key)
+        
+        if decoder is not None and decoder.segment_index is not None and not decoder.segment_index.is_current():
+            self.logger.info(f"{nibrs_master_file} has changed since it was indexed; indexing it again...")
+            self.close_decoder(key)
+            decoder = None
+        
+        if decoder is None:
+            decoder = NIBRSDecoder(nibrs_master_file, self.config, engine = self.engine, use_index = self.use_index,
+                                   zip_member = zip_member)
+            
+            for segment_name in self.config["segment_level_codes"]:
+                decoder.compile_segment(segment_name)
+            
+            if decoder.segment_index is not None:
+                decoder.segment_index.open()
+            
+            self._decoders[key] = decoder
+        
+        return decoder
+    
+    def close_decoder(self, key: tuple) -> None:
+        decoder = self._decoders.pop(key)
+        
+        if decoder.segment_index is not None:
+            decoder.segment_index.close()
+    
+    def decode(self, request: dict) -> dict:
+        '''
+        request: nibrs_master_file, plus segment_name (a segment or a list of them; every segment in the
+        config if omitted), and optionally zip_member, state_code (a state or a list of them), and output_dir
+        
+        decodes the segments of the request in a single pass and writes each to
+        {output_dir}/{segment_name}_{data_year}.parquet, suffixed with the state codes if only some are kept,
+        with a warning in its output if none of its rows have those state codes
+        '''
+        if "nibrs_master_file" not in request:
+            raise KeyError("A decode request must have a nibrs_master_file key.")
+        
+        segment_names = request.get("segment_name") or list(self.config["segment_level_codes"].keys())
+        segment_names = [segment_names] if isinstance(segment_names, str) else segment_names
+        state_codes = request.get("state_code")
+        state_codes = [state_codes] if isinstance(state_codes, str) else state_codes
+        
+        for segment_name in segment_names:
+            if segment_name not in self.config["segment_level_codes"]:
+                raise KeyError(f"{segment_name} is not a segment in the config.")
+        
+        output_dir = Path(request.get("output_dir") or self.output_dir)
+        output_dir.mkdir(parents = True, exist_ok = True)
+        
+        decoder = self.get_decoder(request["nibrs_master_file"], request.get("zip_member"))
+        data_year = decoder.master_file_name[0:4]
+        
+        outputs = {}
+        for segment_name, out_table in decoder.decode_segments(segment_names).items():
+            if self.code_mapper is not None:
+                out_table = self.code_mapper.encode(out_table, segment_name)
+            
+            out_table = NIBRSDecoder.add_db_id(out_table, data_year)
+            out_name = f"{segment_name}_{data_year}"
+            
+            if state_codes:
+                out_table = out_table.filter(pc.is_in(out_table.column("state_code").cast(pa.string()),
+                                                      value_set = pa.array(state_codes, type = pa.string())))
+                out_name = f"{out_name}_{'_'.join(state_codes)}"
+            
+            out_file = output_dir.joinpath(f"{out_name}.parquet")
+            pq.write_table(out_table, out_file)
+            
+            outputs[segment_name] = {"file": str(out_file), "rows": out_table.num_rows}
+            
+            # e.g., a state's abbreviation rather than its FIPS code, which would otherwise pass as an empty file
+            if state_codes and out_table.num_rows == 0:
+                outputs[segment_name]["warning"] = f"No rows have state_code {', '.join(state_codes)}."
+                self.logger.warning(f"{segment_name}: {outputs[segment_name]['warning']}")
+        
+        return {"outputs": outputs}
+    
+    def handle(self, request: dict) -> dict:
+        '''
+        request: a dictionary whose command is 'decode' (the default; see self.decode()), 'status', or 'shutdown'
+        
+        returns the response to request, with its id (if it has one), status ('ok' or 'error'), and seconds
+        '''
+        start = perf_counter()
+        command = request.get("command", "decode")
+        
+        try:
+            if command == "decode":
+                response = self.decode(request)
+            elif command == "status":
+                response = {"requests": self.n_requests, "engine": self.engine, "use_index": self.use_index,
+                            "master_files": [nibrs_master_file for nibrs_master_file, _ in self._decoders]}
+            elif command == "shutdown":
+                self.stopped = True
+                response = {}
+            else:
+                raise ValueError(f"Invalid command '{command}': only decode, status, shutdown are allowed.")
+            
+            response = {"status": "ok", **response}
+        except Exception as error:
+            self.logger.exception(f"Request {request} failed.")
+            response = {"status": "error", "error": f"{type(error).__name__}: {error}"}
+        
+        self.n_requests += 1
+        response["seconds"] = round(perf_counter() - start, 3)
+        
+        if "id" in request:
+            response = {"id": request["id"], **response}
+        
+        self.logger.info(f"{command} {request.get('segment_name', '')} {request.get('state_code', '')}: "
+                         f"{response['status']} in {response['seconds']} s")
+        
+        return response
+    
+    def handle_line(self, line: str) -> dict:
+        '''
+        handles a request sent as a line of JSON
+        '''
+        try:
+            request = json.loads(line)
+        except json.JSONDecodeError as error:
+            return {"status": "error", "error": f"Invalid request, which must be one line of JSON: {error}"}
+        
+        if not isinstance(request, dict):
+            return {"status": "error", "error": "Invalid request, which must be a JSON object."}
+        
+        return self.handle(request)
+    
+    def close(self) -> None:
+        for key in list(self._decoders):
+            self.close_decoder(key)
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    '''
+    answers every line of JSON that a client sends over its connection with a line of JSON
+    '''
+    def handle(self) -> None:
+        service = self.server.service
+        
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            
+            self.wfile.write((json.dumps(service.handle_line(line.decode())) + "\n").encode())
+            self.wfile.flush()
+            
+            if service.stopped:
+                break
+
+def serve_socket(service: DecodeService, socket_path: str) -> None:
+    '''
+    serves requests on a Unix domain socket at socket_path, one connection at a time, until a shutdown request
+    '''
+    if os.path.exists(socket_path):
+        os.unlink(socket_path) # left behind by a service that did not shut down cleanly
+    
+    try:
+        with socketserver.UnixStreamServer(socket_path, _RequestHandler) as server:
+            server.service = service
+            
+            while not service.stopped:
+                server.handle_request()
+    finally:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+def serve_stdin(service: DecodeService) -> None:
+    '''
+    serves requests read from stdin, one line of JSON each, and writes every response to stdout as a
+    line of JSON; stops at the end of stdin or at a shutdown request
+    '''
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        
+        print(json.dumps(service.handle_line(line)), flush = True)
+        
+        if service.stopped:
+            break
+
+def send_requests(socket_path: str, requests: list) -> list:
+    '''
+    sends requests (dictionaries; see DecodeService.handle()) to the service listening on socket_path,
+    over a single connection, and returns its responses
+    '''
+    responses = []
+    
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        
+        with client.makefile("rwb") as stream:
+            for request in requests:
+                stream.write((json.dumps(request) + "\n").encode())
+                stream.flush()
+                responses.append(json.loads(stream.readline()))
+    
+    return responses
+
+def main(args: argparse.Namespace) -> None:
+    if args.request:
+        if not args.socket:
+            raise ValueError("--request sends requests to a running service: specify its --socket.")
+        
+        responses = send_requests(args.socket, [json.loads(request) for request in args.request])
+        
+        for response in responses:
+            print(json.dumps(response))
+        
+        if any(response["status"] != "ok" for response in responses):
+            sys.exit(1)
+        
+        return
+    
+    output_dir, logger = general_utils.create_output_dir_and_logger(
+        output_dir_str = args.output_dir,
+        log_file = f"{Path(__file__).stem}.log"
+        )
+    
+    config = general_utils.load_yaml(args.config_file)
+    code_mapper = NIBRSCodeMapper(general_utils.load_yaml(args.nibrs_codes_file)) if args.nibrs_codes_file else None
+    
+    service = DecodeService(config, output_dir, logger, code_mapper = code_mapper, engine = args.engine,
+                            use_index = args.use_index)
+    
+    for nibrs_master_file in args.nibrs_master_file or []:
+        logger.info(f"Warming up {nibrs_master_file}...")
+        service.get_decoder(nibrs_master_file)
+    
+    try:
+        if args.socket:
+            logger.info(f"Listening on {args.socket}...")
+            serve_socket(service, args.socket)
+        else:
+            logger.info("Reading requests from stdin...")
+            serve_stdin(service)
+    finally:
+        service.close()
+    
+    logger.info(f"Done. {service.n_requests} requests served.")
+
+def parse_args(argv: list = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description = ("A long-running decode service, for scripted jobs that decode many small pieces (e.g., one segment or "
+                       "one state at a time), each of which would otherwise spend most of its time starting up. Requests "
+                       "and responses are lines of JSON, e.g., "
+                       "{\"nibrs_master_file\": \"raw_data/2022_NIBRS_NATIONAL_MASTER_FILE_ENC.txt\", "
+                       "\"segment_name\": \"offense_segment\", \"state_code\": \"17\"}.")
+        )
+    parser.add_argument("--output_dir", "-o", default = "output",
+                        help = "where decoded segments (and the service's log) are written, unless a request names its own output_dir")
+    parser.add_argument("--config_file", "-c", help = ".yaml file with 'segment_level_codes' and the col_specs of each segment")
+    parser.add_argument("--nibrs_codes_file", "-n",
+                        help = "if specified, code columns are encoded with the dictionaries in this .yaml file")
+    parser.add_argument("--engine", "-e", default = "numpy", choices = ["pandas", "numpy"])
+    parser.add_argument("--use_index",
+                        help = ("if toggled, master files are indexed on first use (see decode_segments.py) and stay "
+                                "memory-mapped, so that a request only reads the bytes of its segments"),
+                        action = "store_true")
+    parser.add_argument("--nibrs_master_file", "-f", nargs = "+",
+                        help = "master file(s) whose decoders are set up (and indexed, with --use_index) before the first request")
+    
+    parser.add_argument("--socket",
+                        help = ("path of a Unix domain socket to listen on; if not specified, requests are read from stdin "
+                                "and responses written to stdout"))
+    
+    parser.add_argument("--request", nargs = "+",
+                        help = ("if specified, these requests (JSON objects) are sent to the service listening on --socket, "
+                                "instead of starting one, and its responses are printed"))
+    
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    main(parse_args())
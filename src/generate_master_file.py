@@ -0,0 +1,65 @@
+import argparse
+from pathlib import Path
+from time import perf_counter
+
+from utils import general_utils, SyntheticMasterFile
+
+def main(args: argparse.Namespace) -> None:
+    '''
+    writes a synthetic NIBRS master file, e.g., for benchmarks or for testing the pipeline without
+    the real release; see SyntheticMasterFile
+    '''
+    start = perf_counter()
+    output_dir, logger = general_utils.create_output_dir_and_logger(
+        output_dir_str = args.output_dir,
+        log_file = f"{Path(__file__).stem}.log"
+        )
+    
+    config = general_utils.load_yaml(args.config_file)
+    nibrs_codes = general_utils.load_yaml(args.nibrs_codes_file) if args.nibrs_codes_file else None
+    
+    segment_mix = None
+    if args.segment_mix:
+        segment_mix = {segment_name: float(mean) for segment_name, mean in
+                       (pair.split("=") for pair in args.segment_mix)}
+    
+    if args.zipped:
+        out_file = output_dir.joinpath(f"nibrs-{args.data_year}.zip")
+    else:
+        out_file = output_dir.joinpath(f"{args.data_year}_NIBRS_NATIONAL_MASTER_FILE_ENC.txt")
+    
+    logger.info(f"Writing {args.n_incidents} synthetic incidents to {out_file}...")
+    
+    synthetic_master_file = SyntheticMasterFile(config, nibrs_codes,
+                                                data_year = args.data_year,
+                                                segment_mix = segment_mix,
+                                                blank_rate = args.blank_rate,
+                                                n_agencies = args.n_agencies,
+                                                seed = args.seed)
+    synthetic_master_file.write(out_file, n_incidents = args.n_incidents)
+    
+    end = perf_counter()
+    
+    logger.info(f"Done. {round(out_file.stat().st_size / 1024 ** 2, 1)} MB written in {round(end - start, 1)} seconds.")
+
+def parse_args(argv: list = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description = main.__doc__)
+    parser.add_argument("--output_dir", "-o", default = "raw_data")
+    parser.add_argument("--config_file", "-c", default = "configuration/col_specs.yaml")
+    parser.add_argument("--nibrs_codes_file", "-n",
+                        help = ".yaml file with the code lists that code columns are drawn from; otherwise they are random")
+    parser.add_argument("--data_year", "-y", type = int, default = 2022)
+    parser.add_argument("--n_incidents", type = int, default = 100_000,
+                        help = "about 650 bytes per incident with the default segment mix")
+    parser.add_argument("--segment_mix", nargs = "+",
+                        help = "average rows per incident of the decoded segments, e.g., offense_segment=1.3 arrestee_segment=0.3")
+    parser.add_argument("--blank_rate", type = float, default = 0.2)
+    parser.add_argument("--n_agencies", type = int, default = 5000)
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--zipped", action = "store_true",
+                        help = "if toggled, the master file is written inside nibrs-{data_year}.zip, like the FBI's releases")
+    
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    main(parse_args())
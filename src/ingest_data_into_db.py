@@ -1,29 +1,192 @@
-import polars as pl
-import psycopg2
 import argparse
+from functools import partial
+from pathlib import Path
+from time import perf_counter
 
-from utils import general_utils, AWS_S3, Postgres
+from utils import general_utils, AmazonS3, RunMetrics, IncidentDelta
+from db_design import Postgres
 
 def main(args: argparse.Namespace):
     aws_config = general_utils.load_yaml(args.aws_config)
     postgres_config = general_utils.load_yaml(args.postgres_config)
     
-    aws_s3_tool = AWS_S3(aws_config["credentials"])
-    postgres_tool = Postgres(postgres_config["postgresql"])
+    logs_dir = Path("logs")
+    logs_dir.mkdir(exist_ok = True)
+    logger = general_utils.create_logger(log_file = logs_dir.joinpath(f"{Path(__file__).stem}.log"))
     
-    test_table = aws_s3_tool.read_table_from_s3_bucket(bucket_name = aws_config["bucket_name"], 
-                                                       object_name = "administrative_segment_2022.parquet")
+    metrics = RunMetrics(Path(__file__).stem)
+    aws_s3_tool = AmazonS3(**aws_config["credentials"], metrics = metrics)
+    postgres_tool = Postgres(**postgres_config["postgresql"], max_connections = args.max_concurrency, metrics = metrics)
     
-    sqlalchemy_engine = postgres_tool.create_sqlalchemy_engine()
+    if args.delta:
+        merge_incident_deltas(args, aws_config, aws_s3_tool, postgres_tool, metrics, logs_dir, logger)
+        return
     
-    test_table.write_database(table_name="raw.administrative_segment", if_table_exists = "replace", connection = sqlalchemy_engine)
+    if args.bulk_load:
+        bulk_load_years(args, aws_config, aws_s3_tool, postgres_tool, metrics, logs_dir, logger)
+        return
     
+    # one chunk per row group, so that a failed chunk is retried without reloading the rest of its table;
+    # the partition is emptied first, so that loading a year again replaces it
+    chunks = []
+    for object_name in args.object_name:
+        segment_name, data_year = object_name.removesuffix(".parquet").rsplit("_", 1)
+        table_name = postgres_tool.create_year_partition(f"{args.schema}.{segment_name}", data_year, truncate = True)
+        
+        get_chunks = list_row_group_chunks(args, aws_config, aws_s3_tool, object_name)
+        logger.info(f"{object_name} -> {table_name}: {len(get_chunks)} chunks")
+        
+        chunks.extend((table_name, get_record_batches) for get_record_batches in get_chunks)
+    
+    logger.info(f"Loading {len(chunks)} chunks with COPY ({args.copy_format} format), "
+                f"{args.max_concurrency} at a time...")
+    start = perf_counter()
+    try:
+        load_reports = postgres_tool.copy_chunks(chunks, copy_format = args.copy_format, max_retries = args.max_retries)
+    finally:
+        postgres_tool.close_pool()
+    
+    seconds = perf_counter() - start
+    
+    for table_name in dict.fromkeys(table_name for table_name, _ in chunks):
+        table_reports = [report for report in load_reports if report["table_name"] == table_name]
+        loaded = [report for report in table_reports if report["status"] == "loaded"]
+        
+        logger.info(f"{table_name}: {sum(report['rows'] for report in loaded)} rows in {len(loaded)}/{len(table_reports)} chunks.")
+    
+    n_rows = sum(report["rows"] for report in load_reports if report["status"] == "loaded")
+    logger.info(f"{n_rows} rows in {round(seconds, 2)} seconds ({round(n_rows / seconds)} rows per second).")
+    
+    metrics.write_json(logs_dir.joinpath(f"{Path(__file__).stem}_metrics.json"))
+    
+    if args.prometheus_textfile:
+        metrics.write_prometheus(args.prometheus_textfile)
+    
+    failed = [(i, report) for i, report in enumerate(load_reports) if report["status"] == "failed"]
+    
+    for i, report in failed:
+        logger.error(f"Chunk {i} of {report['table_name']} failed after {report['attempts']} attempts: {report['error']}")
+    
+    if failed:
+        raise Exception(f"{len(failed)} of {len(chunks)} chunks failed to load; the other chunks were committed.")
+    
+    logger.info("Done.")
+
+def list_row_group_chunks(args: argparse.Namespace, aws_config: dict, aws_s3_tool: AmazonS3, object_name: str) -> list:
+    '''
+    returns one function per row group of object_name, which reads its record batches from the s3 bucket
+    '''
+    n_row_groups = aws_s3_tool.count_row_groups_in_s3_object(bucket_name = aws_config["bucket_name"], 
+                                                             object_name = object_name)
+    
+    return [partial(aws_s3_tool.iter_record_batches_from_s3_bucket, 
+                    bucket_name = aws_config["bucket_name"], 
+                    object_name = object_name,
+                    batch_size = args.batch_size,
+                    row_groups = [row_group]) for row_group in range(n_row_groups)]
+
+def bulk_load_years(args: argparse.Namespace, aws_config: dict, aws_s3_tool: AmazonS3, postgres_tool: Postgres,
+                    metrics: RunMetrics, logs_dir: Path, logger) -> None:
+    '''
+    loads each object in args.object_name as a whole new partition of its year, which replaces the 
+    year's partition if it exists, with indexes built after the load; see Postgres.bulk_load_year()
+    '''
+    load_reports = []
+    try:
+        for object_name in args.object_name:
+            segment_name, data_year = object_name.removesuffix(".parquet").rsplit("_", 1)
+            table_name = f"{args.schema}.{segment_name}"
+            get_chunks = list_row_group_chunks(args, aws_config, aws_s3_tool, object_name)
+            
+            logger.info(f"Bulk loading {object_name} ({len(get_chunks)} chunks) into a new {data_year} partition of {table_name}...")
+            
+            report = postgres_tool.bulk_load_year(table_name, data_year, get_chunks, 
+                                                  copy_format = args.copy_format, max_retries = args.max_retries)
+            load_reports.append(report)
+            
+            logger.info(f"{report['partition']}: {report['rows']} rows copied in {report['copy_seconds']} seconds, "
+                        f"indexed in {report['index_seconds']} seconds, and attached in {report['attach_seconds']} seconds.")
+    finally:
+        postgres_tool.close_pool()
+        metrics.write_json(logs_dir.joinpath(f"{Path(__file__).stem}_metrics.json"))
+        
+        if args.prometheus_textfile:
+            metrics.write_prometheus(args.prometheus_textfile)
+    
+    logger.info(f"Done. {len(load_reports)} partitions loaded.")
+    
+def merge_incident_deltas(args: argparse.Namespace, aws_config: dict, aws_s3_tool: AmazonS3, postgres_tool: Postgres,
+                          metrics: RunMetrics, logs_dir: Path, logger) -> None:
+    '''
+    applies the deltas that decode_segments.py --delta wrote next to each object in args.object_name,
+    one transaction per table, instead of reloading the whole year
+    '''
+    merge_reports = []
+    try:
+        for object_name in args.object_name:
+            segment_name, data_year = object_name.removesuffix(".parquet").rsplit("_", 1)
+            table_name = f"{args.schema}.{segment_name}"
+            changes_object, rows_object = IncidentDelta.object_names(segment_name, data_year)
+            
+            logger.info(f"Merging {changes_object} and {rows_object} into {table_name}...")
+            
+            report = postgres_tool.merge_incident_changes(
+                table_name, data_year,
+                changes = aws_s3_tool.iter_record_batches_from_s3_bucket(bucket_name = aws_config["bucket_name"], 
+                                                                         object_name = changes_object,
+                                                                         batch_size = args.batch_size),
+                record_batches = aws_s3_tool.iter_record_batches_from_s3_bucket(bucket_name = aws_config["bucket_name"], 
+                                                                                object_name = rows_object,
+                                                                                batch_size = args.batch_size),
+                copy_format = args.copy_format
+                )
+            merge_reports.append(report)
+            
+            logger.info(f"{table_name}: {report['changed_incidents']} changed incidents, {report['deleted_rows']} rows deleted, "
+                        f"{report['inserted_rows']} rows inserted in {report['seconds']} seconds.")
+    finally:
+        postgres_tool.close_pool()
+        metrics.write_json(logs_dir.joinpath(f"{Path(__file__).stem}_metrics.json"))
+        
+        if args.prometheus_textfile:
+            metrics.write_prometheus(args.prometheus_textfile)
+    
+    logger.info(f"Done. {len(merge_reports)} deltas merged.")
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--aws_config", "-aws", help = ".yaml file with bucket_name and credentials keys")
     parser.add_argument("--postgres_config", "-postgres", help = ".yaml file with postgresql key, under which exists credentials and schemas keys")
+    parser.add_argument("--object_name", "-obj", nargs = "+", default = ["administrative_segment_2022.parquet"], 
+                        help = ("parquet file(s) in the s3 bucket to be loaded, named like {segment_name}_{data_year}.parquet; "
+                                "each replaces the partition of data_year of the table {schema}.{segment_name}, which is "
+                                "created if it does not exist and emptied (truncated) if it does, so that a year can be "
+                                "loaded again; readers see the partition empty until its chunks are loaded (see --bulk_load)"))
+    parser.add_argument("--schema", default = "raw", help = "schema of the tables that the parquet files are loaded into")
+    parser.add_argument("--copy_format", default = "text", choices = ["text", "binary"],
+                        help = "format of the COPY ... FROM STDIN stream; binary is more compact but stricter about column types")
+    parser.add_argument("--batch_size", "-b", type = int, default = 100_000,
+                        help = "number of rows read from the s3 bucket, encoded, and sent to postgres at a time")
+    parser.add_argument("--max_concurrency", type = int, default = 4,
+                        help = "number of chunks (parquet row groups) loaded at the same time, each on its own connection")
+    parser.add_argument("--max_retries", type = int, default = 2,
+                        help = "number of times a chunk that failed to load is retried in a new transaction")
+    
+    parser.add_argument("--bulk_load",
+                        help = ("if toggled, each object replaces its year's partition: it is loaded into an UNLOGGED table "
+                                "without indexes, which is then indexed and attached as the partition; much faster than "
+                                "loading into an indexed partition, for a new year or a full reload"),
+                        action = "store_true")
+    
+    parser.add_argument("--delta",
+                        help = ("if toggled, each object is not loaded in full; instead, the delta that decode_segments.py --delta "
+                                "wrote next to it ({segment_name}_{data_year}_changes.parquet and _delta.parquet) replaces the "
+                                "changed incidents of that year in the table, in a single transaction"),
+                        action = "store_true")
+    
+    parser.add_argument("--prometheus_textfile",
+                        help = "if specified, the load's per-stage metrics are also written to this .prom file")
     
     args = parser.parse_args()
     
     main(args)
-    
\ No newline at end of file
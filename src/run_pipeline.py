@@ -0,0 +1,248 @@
+import argparse
+import os
+import zipfile
+from functools import partial
+from pathlib import Path
+from time import perf_counter
+
+import pyarrow.parquet as pq
+
+import decode_segments
+from utils import general_utils, IncidentIndex, Task, TaskScheduler
+
+# The tasks below run in worker processes of TaskScheduler, so they are module-level functions of plain arguments.
+
+def extract_master_file(nibrs_zipped_file: str, zip_member: str, out_dir: str) -> str:
+    '''
+    extracts zip_member from nibrs_zipped_file into out_dir, unless it was already extracted, and returns its path
+    '''
+    out_file = Path(out_dir).joinpath(zip_member)
+    
+    with zipfile.ZipFile(nibrs_zipped_file) as zipped_file:
+        if not out_file.exists() or out_file.stat().st_size != zipped_file.getinfo(zip_member).file_size:
+            zipped_file.extract(zip_member, out_dir)
+    
+    return str(out_file)
+
+def decode_year(decode_argv: list) -> str:
+    '''
+    decode_argv: the command line arguments of decode_segments.py
+    
+    decodes and exports one year's segments, exactly as decode_segments.py would
+    '''
+    decode_segments.main(decode_segments.parse_args(decode_argv))
+    
+    return "decoded"
+
+def load_segment(postgres_config_file: str, bucket_name: str, object_name: str, table_name: str, data_year: int,
+                 copy_format: str, max_connections: int, bulk_load: bool = False) -> dict:
+    '''
+    loads one decoded parquet file from the s3 bucket into the partition of data_year of table_name, one 
+    chunk per row group; see Postgres.copy_chunks(), or Postgres.bulk_load_year() if bulk_load
+    '''
+    from db_design import Postgres # only the load tasks need a database driver
+    from utils import AmazonS3 # boto3 and s3fs are slow to import, and only the load tasks need them here
+    
+    aws_s3_tool = AmazonS3(region_name = os.environ["region_name"],
+                           aws_access_key_id = os.environ["aws_access_key_id"],
+                           aws_secret_access_key = os.environ["aws_secret_access_key"])
+    postgres_tool = Postgres(**general_utils.load_yaml(postgres_config_file)["postgresql"],
+                             max_connections = max_connections)
+    
+    n_row_groups = aws_s3_tool.count_row_groups_in_s3_object(bucket_name = bucket_name, object_name = object_name)
+    get_chunks = [partial(aws_s3_tool.iter_record_batches_from_s3_bucket, bucket_name = bucket_name,
+                          object_name = object_name, row_groups = [row_group])
+                  for row_group in range(n_row_groups)]
+    
+    try:
+        if bulk_load:
+            report = postgres_tool.bulk_load_year(table_name, data_year, get_chunks, copy_format = copy_format)
+            
+            return {"rows": report["rows"], "chunks": len(get_chunks), "index_seconds": report["index_seconds"]}
+        
+        partition_name = postgres_tool.create_year_partition(table_name, data_year, truncate = True)
+        chunks = [(partition_name, get_record_batches) for get_record_batches in get_chunks]
+        load_reports = postgres_tool.copy_chunks(chunks, copy_format = copy_format)
+    finally:
+        postgres_tool.close_pool()
+    
+    failed = [report for report in load_reports if report["status"] == "failed"]
+    if failed:
+        raise Exception(f"{len(failed)} of {len(chunks)} chunks of {object_name} failed to load: {failed[0]['error']}")
+    
+    return {"rows": sum(report["rows"] for report in load_reports), "chunks": len(chunks)}
+
+def assemble_incidents(output_dir: str, data_year: int, segment_names: list) -> dict:
+    '''
+    writes the incident-level table of output_dir's segments, and the incidents whose counts disagree, to output_dir
+    '''
+    incident_index = IncidentIndex.load_or_build(output_dir, data_year, segment_names)
+    
+    incidents = incident_index.assemble()
+    pq.write_table(incidents, Path(output_dir).joinpath(f"incidents_{data_year}.parquet"))
+    
+    mismatches = incident_index.check_counts()
+    pq.write_table(mismatches, Path(output_dir).joinpath(f"incident_count_mismatches_{data_year}.parquet"))
+    
+    return {"incidents": incidents.num_rows, "count_mismatches": mismatches.num_rows,
+            "orphans": {segment_name: incident_index.n_orphans(segment_name) for segment_name in incident_index.segment_names}}
+
+def build_tasks(args: argparse.Namespace, config: dict, segment_names: list) -> list:
+    '''
+    builds the task graph: for every year, an optional extract task, a decode task, and optionally an
+    incident assembly task and one load task per segment, which depend on that year's decode
+    '''
+    tasks = []
+    for data_year in args.years:
+        nibrs_zipped_file = Path(args.raw_data_dir).joinpath(f"nibrs-{data_year}.zip")
+        zip_member = f"{data_year}_NIBRS_NATIONAL_MASTER_FILE_ENC.txt"
+        decode_deps = ()
+        
+        if args.n_workers > 1 or args.use_index:
+            extract_task = Task(f"extract_{data_year}", extract_master_file,
+                                args = (str(nibrs_zipped_file), zip_member, args.raw_data_dir))
+            tasks.append(extract_task)
+            
+            decode_deps = (extract_task.name,)
+            master_file_args = [f"--nibrs_master_file={Path(args.raw_data_dir).joinpath(zip_member)}"]
+        else:
+            master_file_args = [f"--nibrs_master_file={nibrs_zipped_file}", f"--zip_member={zip_member}"]
+        
+        decode_argv = [
+            f"--output_dir={Path(args.output_dir).joinpath(str(data_year))}",
+            *master_file_args,
+            f"--config_file={args.config_file}",
+            "--segment_name", *segment_names,
+            f"--engine={args.engine}",
+            f"--n_workers={args.n_workers}",
+            *([f"--batch_size={args.batch_size}"] if args.batch_size else []),
+            *(["--pipelined"] if args.pipelined else []),
+            # a code missing from nibrs_codes_file (e.g., one added this year) is reported and encoded as missing,
+            # rather than stopping the run after a whole year is decoded, unless --strict_codes
+            *(["--validate"] if args.validate or (args.nibrs_codes_file and not args.strict_codes) else []),
+            *([f"--nibrs_codes_file={args.nibrs_codes_file}"] if args.nibrs_codes_file else []),
+            *(["--use_index"] if args.use_index else []),
+            *(["--partitioned"] if args.partitioned else []),
+            *(["--to_aws_s3"] if args.to_aws_s3 else [])
+            ]
+        
+        decode_task = Task(f"decode_{data_year}", decode_year, args = (decode_argv,), deps = decode_deps,
+                           cpus = args.n_workers, memory_gb = args.decode_memory_gb)
+        tasks.append(decode_task)
+        
+        if args.assemble_incidents:
+            tasks.append(Task(f"assemble_{data_year}", assemble_incidents,
+                              args = (str(Path(args.output_dir).joinpath(str(data_year))), data_year, segment_names),
+                              deps = (decode_task.name,), memory_gb = args.decode_memory_gb))
+        
+        if args.postgres_config:
+            for segment_name in segment_names:
+                tasks.append(Task(f"load_{data_year}_{segment_name}", load_segment,
+                                  args = (args.postgres_config, config["s3_bucket"], f"{segment_name}_{data_year}.parquet",
+                                          f"raw.{segment_name}", data_year, args.copy_format, args.load_connections,
+                                          args.bulk_load),
+                                  deps = (decode_task.name,), memory_gb = args.load_memory_gb))
+    
+    return tasks
+
+def main(args: argparse.Namespace) -> None:
+    start = perf_counter()
+    output_dir, logger = general_utils.create_output_dir_and_logger(
+        output_dir_str = args.output_dir,
+        log_file = f"{Path(__file__).stem}.log"
+        )
+    
+    config = general_utils.load_yaml(args.config_file)
+    
+    if args.all_segments:
+        segment_names = list(config["segment_level_codes"].keys())
+    elif args.segment_name:
+        segment_names = args.segment_name
+    else:
+        raise ValueError("Specify at least one segment with --segment_name, or toggle --all_segments.")
+    
+    if args.postgres_config and (not args.to_aws_s3 or args.partitioned):
+        raise ValueError("--postgres_config loads the flat parquet files in the s3 bucket: it requires --to_aws_s3 "
+                         "and cannot be combined with --partitioned.")
+    
+    if args.assemble_incidents and (args.to_aws_s3 or args.partitioned or "administrative_segment" not in segment_names):
+        raise ValueError("--assemble_incidents reads the flat parquet files in output_dir: it cannot be combined with "
+                         "--to_aws_s3 or --partitioned, and requires the administrative segment.")
+    
+    tasks = build_tasks(args, config, segment_names)
+    
+    logger.info(f"Running {len(tasks)} tasks for {', '.join(map(str, args.years))} with up to {args.max_cpus} CPUs "
+                f"and {args.max_memory_gb} GB of memory...")
+    
+    scheduler = TaskScheduler(max_cpus = args.max_cpus, max_memory_gb = args.max_memory_gb,
+                              max_retries = args.max_retries, logger = logger)
+    statuses, results = scheduler.run(tasks)
+    
+    for task_name, status in statuses.items():
+        logger.info(f"{task_name}: {status} ({results.get(task_name)})")
+    
+    end = perf_counter()
+    
+    logger.info(f"Done. Total run time: {round((end - start) / 60, 2)} minutes")
+    
+    not_succeeded = [task_name for task_name, status in statuses.items() if status != "succeeded"]
+    if not_succeeded:
+        raise Exception(f"{len(not_succeeded)} of {len(tasks)} tasks did not succeed: {', '.join(not_succeeded)}.")
+
+def parse_args(argv: list = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--years", "-y", type = int, nargs = "+", required = True,
+                        help = "data years to process; raw_data_dir must have nibrs-{year}.zip for each of them")
+    parser.add_argument("--raw_data_dir", default = "raw_data")
+    parser.add_argument("--output_dir", "-o", help = "each year is decoded into its own subdirectory, output_dir/{year}")
+    parser.add_argument("--config_file", "-c", help = ".yaml file with 'segment_level_codes' and 's3_bucket' keys, plus any segments of interests as keys")
+    parser.add_argument("--segment_name", "-s", nargs = "+", help = "segment(s) of interest to decode for every year")
+    parser.add_argument("--all_segments", help = "if toggled, every segment in config_file['segment_level_codes'] is decoded",
+                        action = "store_true")
+    
+    parser.add_argument("--max_cpus", type = int, default = os.cpu_count(),
+                        help = "CPU budget shared by the running tasks; a decode task uses n_workers CPUs")
+    parser.add_argument("--max_memory_gb", type = float, default = 16,
+                        help = "memory budget shared by the running tasks")
+    parser.add_argument("--decode_memory_gb", type = float, default = 8,
+                        help = "memory that a decode task is assumed to need; lower it along with --batch_size")
+    parser.add_argument("--load_memory_gb", type = float, default = 1,
+                        help = "memory that a load task is assumed to need")
+    parser.add_argument("--max_retries", type = int, default = 1, help = "number of times a failed task is retried")
+    
+    # passed through to decode_segments.py
+    parser.add_argument("--engine", "-e", default = "numpy", choices = ["pandas", "numpy"])
+    parser.add_argument("--n_workers", "-w", type = int, default = 1,
+                        help = "processes per decode task; values above 1 extract the master file first")
+    parser.add_argument("--use_index", help = "if toggled, the master file is extracted and indexed before it is decoded",
+                        action = "store_true")
+    parser.add_argument("--batch_size", "-b", type = int)
+    parser.add_argument("--pipelined", action = "store_true")
+    parser.add_argument("--validate", help = "if toggled, each year is validated as it is decoded; see decode_segments.py",
+                        action = "store_true")
+    parser.add_argument("--nibrs_codes_file", "-n",
+                        help = ("if specified, code columns are encoded with its dictionaries, and each year is validated, so that "
+                                "codes that are not in it are logged and written to the year's validation report, and encoded as "
+                                "missing values"))
+    parser.add_argument("--strict_codes", help = "if toggled, a code that is not in nibrs_codes_file stops the decode of its year instead",
+                        action = "store_true")
+    parser.add_argument("--partitioned", action = "store_true")
+    parser.add_argument("--to_aws_s3", action = "store_true")
+    
+    parser.add_argument("--assemble_incidents", action = "store_true",
+                        help = "if toggled, every year's segments are indexed and assembled into an incident-level table")
+    
+    # passed through to the load tasks
+    parser.add_argument("--postgres_config", "-postgres",
+                        help = (".yaml file with postgresql key; if specified, every decoded segment is loaded into the "
+                                "partition of its year of raw.{segment_name}"))
+    parser.add_argument("--copy_format", default = "text", choices = ["text", "binary"])
+    parser.add_argument("--load_connections", type = int, default = 2,
+                        help = "number of connections, and thus of concurrent chunks, per load task")
+    parser.add_argument("--bulk_load", action = "store_true",
+                        help = "if toggled, every year is loaded as a new partition, indexed after the load; see ingest_data_into_db.py")
+    
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -3,11 +3,12 @@ from utils import general_utils
 from db_design import Postgres, raw_tables
 from pathlib import Path
 
-def main(config_file: dict) -> None:
+def main(config_file: dict, col_specs: dict) -> None:
     '''
     creates a postgres db called config_file["postgresql"]["credentials"]["db_name"], if one doesn't exist, 
-    along with the specified schemas in config_file["postgresql"]["schemas"] and then creates tables in the raw 
-    schema based on the metadata found in ./src/db_design/raw_tables.py
+    along with the specified schemas in config_file["postgresql"]["schemas"] and then creates one table per 
+    segment in the raw schema, partitioned by data_year, whose columns and types are generated from col_specs 
+    (see ./src/db_design/raw_tables.py)
     '''
     postgres_config = config_file["postgresql"]
     
@@ -24,11 +25,12 @@ def main(config_file: dict) -> None:
         raise KeyError("config_file must have 'credentials' and 'schemas' keys.")
     
     logging.info("Creating tables in raw schema...")
-    if raw_tables.Base.metadata.schema in postgres_config["schemas"]:
+    if raw_tables.raw_metadata.schema in postgres_config["schemas"]:
+        raw_tables.build_raw_tables(col_specs)
         sqlalchemy_engine = db_config.create_sqlalchemy_engine()
-        raw_tables.Base.metadata.create_all(bind = sqlalchemy_engine)
+        raw_tables.raw_metadata.create_all(bind = sqlalchemy_engine)
     else:
-        message = (f"Please make sure that '{raw_tables.Base.metadata.schema}' schema "
+        message = (f"Please make sure that '{raw_tables.raw_metadata.schema}' schema "
                    "is defined in config_file['postgresql']['schemas'].")
         logging.error(message)
         raise Exception(message)
@@ -41,9 +43,11 @@ if __name__ == "__main__":
         "a .yaml file with a 'postgresql' key, which contains a key:value pair called 'credentials' "
         "with host/dbname/user/port keys and a list of desired schemas called 'schemas'"
         ))
+    parser.add_argument("--col_specs_file", default = "configuration/col_specs.yaml",
+                        help = ".yaml file with 'segment_level_codes' and the col_specs of each segment, from which the raw tables are generated")
     
     args = parser.parse_args()
     
     config = general_utils.load_yaml(args.c)
     
-    main(config_file = config)
\ No newline at end of file
+    main(config_file = config, col_specs = general_utils.load_yaml(args.col_specs_file))
\ No newline at end of file
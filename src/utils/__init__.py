@@ -1,3 +1,36 @@
+from importlib import import_module
+
 from .general_utils import *
-from .nibrs_decoder import NIBRSDecoder
-from .aws_integration import AmazonS3
+
+# name: module that defines it. These are imported on first use rather than with the package, so that
+# a script only pays for what it uses, e.g., boto3, s3fs, and polars are only imported for s3 or for diffs.
+# pandas is not deferred by this: pyarrow imports it (if installed) as soon as it converts a NumPy array.
+_LAZY_IMPORTS = {
+    "NIBRSDecoder": "nibrs_decoder",
+    "AmazonS3": "aws_integration",
+    "ParquetBatchWriter": "parquet_io",
+    "PartitionedDatasetWriter": "parquet_io",
+    "ByteChunkSink": "parquet_io",
+    "NIBRSCodeMapper": "nibrs_codes",
+    "DecodeCache": "decode_cache",
+    "Task": "task_scheduler",
+    "TaskScheduler": "task_scheduler",
+    "IncidentIndex": "incident_index",
+    "SyntheticMasterFile": "synthetic_master_file",
+    "RunMetrics": "run_metrics",
+    "IncidentDelta": "incident_delta",
+    "BatchPipeline": "batch_pipeline",
+    "SegmentValidator": "segment_validator"
+}
+
+def __getattr__(name: str):
+    if name not in _LAZY_IMPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    
+    value = getattr(import_module(f".{_LAZY_IMPORTS[name]}", __name__), name)
+    globals()[name] = value
+    
+    return value
+
+def __dir__() -> list:
+    return sorted([*globals(), *_LAZY_IMPORTS])
\ No newline at end of file
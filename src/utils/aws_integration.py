@@ -1,10 +1,21 @@
 import boto3
+from boto3.s3.transfer import TransferConfig
 from botocore.client import BaseClient
-from botocore.exceptions import UnknownServiceError
+from botocore.config import Config
+from botocore.exceptions import ClientError, UnknownServiceError
 import s3fs
-import pandas as pd
 import polars as pl
-from io import BytesIO, StringIO
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.fs as pafs
+import pyarrow.parquet as pq
+from concurrent.futures import ThreadPoolExecutor
+from io import RawIOBase
+from pathlib import Path
+from threading import Lock
+
+from .parquet_io import to_arrow_table
+from .run_metrics import RunMetrics, DISABLED_METRICS
 
 # https://stackoverflow.com/questions/53416226/how-to-write-parquet-file-from-pandas-dataframe-in-s3-in-python
 # https://stackoverflow.com/questions/75115246/with-python-is-there-a-way-to-load-a-polars-dataframe-directly-into-an-s3-bucke
@@ -20,6 +31,9 @@ class AWSBase:
         self.region_name = region_name
         self.aws_access_key_id = aws_access_key_id
         self.aws_secret_access_key = aws_secret_access_key
+        self._session = None
+        self._clients = {}
+        self._clients_lock = Lock()
         
     def _create_credentials_dict(self) -> dict:
         credentials = {
@@ -30,16 +44,155 @@ class AWSBase:
         
         return credentials
         
-    def _create_client(self, service: str) -> BaseClient:
+    def _create_client(self, service: str, client_config: Config = None) -> BaseClient:
         try:
-            client = boto3.client(service, **self._create_credentials_dict())
+            if self._session is None:
+                self._session = boto3.session.Session(**self._create_credentials_dict())
+            
+            client = self._session.client(service, config = client_config)
             return client
         except UnknownServiceError:
             raise ValueError(f"Service '{service}' is invalid. AWS client could not be created.")
+    
+    def _get_client(self, service: str, **config_options) -> BaseClient:
+        '''
+        config_options: botocore Config options, e.g., max_pool_connections
+        
+        returns the instance's client for service and config_options, which is created on the first call
+        '''
+        key = (service, tuple(sorted(config_options.items())))
+        
+        with self._clients_lock:
+            if key not in self._clients:
+                self._clients[key] = self._create_client(service, Config(**config_options) if config_options else None)
+            
+            return self._clients[key]
+
+class S3MultipartWriter(RawIOBase):
+    MIN_PART_SIZE = 5 * 1024 * 1024 # S3's minimum size of every part but the last
+    
+    def __init__(self, client: BaseClient, bucket_name: str, object_name: str, 
+                 part_size: int = 16 * 1024 * 1024, max_concurrency: int = 8, metrics: RunMetrics = None):
+        '''
+        a write-only file object that uploads what is written to it as the parts of an S3 multipart upload;
+        close() completes the upload, and abort() (or an error inside a with block) discards it
+        
+        metrics: if specified, part uploads (s3_upload_part) and waits for them (s3_upload_wait) are recorded in it
+        '''
+        if part_size < self.MIN_PART_SIZE:
+            raise ValueError(f"part_size must be at least {self.MIN_PART_SIZE} bytes.")
+        
+        self.client = client
+        self.bucket_name = bucket_name
+        self.object_name = object_name
+        self.part_size = part_size
+        self.max_concurrency = max_concurrency
+        self.metrics = metrics or DISABLED_METRICS
+        self.n_bytes = 0
+        
+        self._upload_id = client.create_multipart_upload(Bucket = bucket_name, Key = object_name)["UploadId"]
+        self._executor = ThreadPoolExecutor(max_workers = max_concurrency)
+        self._in_flight = []
+        self._parts = []
+        self._buffer = bytearray()
+    
+    def writable(self) -> bool:
+        return True
+    
+    def tell(self) -> int:
+        return self.n_bytes
+    
+    def _upload_part(self, part_number: int, body: bytes) -> dict:
+        with self.metrics.stage("s3_upload_part", object = self.object_name) as stage:
+            response = self.client.upload_part(Bucket = self.bucket_name, Key = self.object_name, 
+                                               UploadId = self._upload_id, PartNumber = part_number, Body = body)
+            stage.add(bytes_out = len(body))
+        
+        return {"PartNumber": part_number, "ETag": response["ETag"]}
+    
+    def _submit_part(self, body: bytes) -> None:
+        if len(self._in_flight) >= self.max_concurrency:
+            with self.metrics.stage("s3_upload_wait", object = self.object_name):
+                self._parts.append(self._in_flight.pop(0).result())
+        
+        part_number = len(self._parts) + len(self._in_flight) + 1
+        self._in_flight.append(self._executor.submit(self._upload_part, part_number, body))
+    
+    def write(self, data) -> int:
+        self._buffer += data
+        self.n_bytes += len(data)
+        
+        while len(self._buffer) >= self.part_size:
+            self._submit_part(bytes(self._buffer[:self.part_size]))
+            del self._buffer[:self.part_size]
+        
+        return len(data)
+    
+    def close(self) -> None:
+        if self.closed:
+            return
+        
+        try:
+            if self._buffer or not (self._parts or self._in_flight):
+                self._submit_part(bytes(self._buffer))
+                self._buffer = bytearray()
+            
+            with self.metrics.stage("s3_upload_wait", object = self.object_name):
+                self._parts.extend(future.result() for future in self._in_flight)
+            self._in_flight = []
+            
+            self.client.complete_multipart_upload(Bucket = self.bucket_name, Key = self.object_name, 
+                                                  UploadId = self._upload_id, 
+                                                  MultipartUpload = {"Parts": self._parts})
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self._executor.shutdown()
+            super().close()
+    
+    def abort(self) -> None:
+        for future in self._in_flight:
+            future.cancel()
+        
+        self._executor.shutdown()
+        self.client.abort_multipart_upload(Bucket = self.bucket_name, Key = self.object_name, UploadId = self._upload_id)
+        super().close()
+    
+    def __exit__(self, exc_type, *exc_info) -> None:
+        if exc_type is not None and not self.closed:
+            self.abort()
+        else:
+            self.close()
 
 class AmazonS3(AWSBase):
-    def __init__(self, region_name: str, aws_access_key_id: str, aws_secret_access_key: str):
+    def __init__(self, region_name: str, aws_access_key_id: str, aws_secret_access_key: str, 
+                 part_size: int = 16 * 1024 * 1024, max_concurrency: int = 8, metrics: RunMetrics = None):
+        '''
+        part_size: the size, in bytes, of the parts of multipart uploads
+        max_concurrency: how many parts of an upload are sent at the same time
+        metrics: if specified, uploads are recorded in it; see RunMetrics
+        '''
         super().__init__(region_name, aws_access_key_id, aws_secret_access_key)
+        self.part_size = part_size
+        self.max_concurrency = max_concurrency
+        self.metrics = metrics or DISABLED_METRICS
+    
+    def _get_s3_client(self) -> BaseClient:
+        return self._get_client("s3", max_pool_connections = max(10, self.max_concurrency))
+    
+    def _get_transfer_config(self) -> TransferConfig:
+        return TransferConfig(multipart_threshold = self.part_size, multipart_chunksize = self.part_size,
+                              max_concurrency = self.max_concurrency)
+    
+    def open_multipart_writer(self, bucket_name: str, object_name: str) -> S3MultipartWriter:
+        '''
+        returns a file object whose contents are streamed to object_name in s3 bucket as they are 
+        written; see S3MultipartWriter
+        '''
+        return S3MultipartWriter(self._get_s3_client(), bucket_name, object_name, 
+                                 part_size = self.part_size, max_concurrency = self.max_concurrency,
+                                 metrics = self.metrics)
 
     @staticmethod
     def _build_s3_uri(bucket_name: str, object_name: str) -> str:
@@ -51,6 +204,52 @@ class AmazonS3(AWSBase):
         '''
         return s3fs.S3FileSystem(key = self.aws_access_key_id, secret = self.aws_secret_access_key)
 
+    def create_arrow_file_system(self) -> pafs.S3FileSystem:
+        '''
+        a pyarrow file system over s3, in which paths are bucket_name/object_name
+        '''
+        return pafs.S3FileSystem(access_key = self.aws_access_key_id, secret_key = self.aws_secret_access_key,
+                                 region = self.region_name)
+
+    def _create_storage_options(self) -> dict:
+        '''
+        the credentials in the form that polars' cloud readers expect
+        '''
+        return {
+            "aws_region": self.region_name,
+            "aws_access_key_id": self.aws_access_key_id,
+            "aws_secret_access_key": self.aws_secret_access_key
+        }
+
+    def scan_tables_from_s3_bucket(self, bucket_name: str, object_names, columns: list = None, 
+                                   filters: pl.Expr = None) -> pl.LazyFrame:
+        '''
+        object_names: the name of a parquet file in s3 bucket, or a list of them; names may be glob 
+        patterns, e.g., offense_segment_*.parquet
+        columns: if specified, only these columns are read
+        filters: if specified, a polars expression that rows must satisfy, e.g., pl.col("state_code") == "IL"
+        
+        returns a polars LazyFrame over the parquet file(s), which reads nothing until it is collected
+        '''
+        if isinstance(object_names, str):
+            object_names = [object_names]
+        
+        if not all(object_name.endswith("parquet") for object_name in object_names):
+            raise ValueError("This method only supports reading parquet tables at this time.")
+        
+        s3_uris = [AmazonS3._build_s3_uri(bucket_name = bucket_name, object_name = object_name) 
+                   for object_name in object_names]
+        
+        out_table = pl.scan_parquet(s3_uris, storage_options = self._create_storage_options())
+        
+        if filters is not None:
+            out_table = out_table.filter(filters)
+        
+        if columns is not None:
+            out_table = out_table.select(columns)
+        
+        return out_table
+
     def read_table_from_s3_bucket(self, bucket_name: str, object_name: str) -> pl.DataFrame:
         '''
         ingests a parquet file from s3 bucket as a polars dataframe
@@ -66,50 +265,113 @@ class AmazonS3(AWSBase):
         else:
             raise ValueError("This method only supports reading parquet tables at this time.")
 
+    def object_exists_in_s3_bucket(self, bucket_name: str, object_name: str) -> bool:
+        '''
+        returns whether object_name exists in s3 bucket, checking only its metadata
+        '''
+        try:
+            self._get_s3_client().head_object(Bucket = bucket_name, Key = object_name)
+            return True
+        except ClientError as error:
+            if error.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+    
+    def count_row_groups_in_s3_object(self, bucket_name: str, object_name: str) -> int:
+        '''
+        returns the number of row groups of a parquet file in s3 bucket, reading only its footer
+        '''
+        s3_uri = AmazonS3._build_s3_uri(bucket_name = bucket_name, object_name = object_name)
+        fs = self._build_s3fs_file_system()
+        
+        with fs.open(s3_uri, "rb") as file:
+            return pq.ParquetFile(file).num_row_groups
+    
+    def iter_record_batches_from_s3_bucket(self, bucket_name: str, object_name: str, batch_size: int = 100_000,
+                                           row_groups: list = None):
+        '''
+        row_groups: if specified, only these row groups of the parquet file are read
+        
+        yields a parquet file from s3 bucket as pyarrow record batches of up to batch_size rows, as they are downloaded
+        '''
+        if not object_name.endswith("parquet"):
+            raise ValueError("This method only supports reading parquet tables at this time.")
+        
+        s3_uri = AmazonS3._build_s3_uri(bucket_name = bucket_name, object_name = object_name)
+        fs = self._build_s3fs_file_system()
+        
+        with fs.open(s3_uri, "rb") as file:
+            yield from pq.ParquetFile(file).iter_batches(batch_size = batch_size, row_groups = row_groups)
+
+    def _iter_list_objects_pages(self, bucket_name: str, prefix: str = ""):
+        '''
+        yields every page of client.list_objects_v2(Bucket = bucket_name, Prefix = prefix), which 
+        returns at most 1000 objects per call
+        '''
+        paginator = self._get_s3_client().get_paginator("list_objects_v2")
+        
+        yield from paginator.paginate(Bucket = bucket_name, Prefix = prefix)
+    
+    def list_objects_in_s3_bucket(self, bucket_name: str, prefix: str = "") -> list:
+        '''
+        returns the names of all the objects in s3 bucket whose names start with prefix
+        '''
+        return [object["Key"] for page in self._iter_list_objects_pages(bucket_name, prefix) 
+                for object in page.get("Contents", [])]
+    
     def print_objects_in_s3_bucket(self, bucket_name: str, print_full_dict: bool = False) -> None:
         '''
         print_full_dict: whether or not to print the full nested dictionary from 
-        client.list_objects_v2(Bucket = bucket_name) or just the object names + storage size
+        client.list_objects_v2(Bucket = bucket_name), one per page of up to 1000 objects, 
+        or just the object names + storage size
         
         prints all the object names in s3 bucket
         '''
-        full_dict = self._create_client("s3").list_objects_v2(Bucket = bucket_name)
-        
-        if print_full_dict:
-            print(full_dict)
-        else:
-            try:
-                for object in full_dict["Contents"]:
+        n_objects = 0
+        for page in self._iter_list_objects_pages(bucket_name):
+            n_objects += page.get("KeyCount", 0)
+            
+            if print_full_dict:
+                print(page)
+            else:
+                for object in page.get("Contents", []):
                     file_name = object["Key"]
                     file_size_as_mb = round(object["Size"] / (1000 * 1000), 2)
                     print(f"File Name: {file_name}, Size: {file_size_as_mb} MB")
-            except KeyError:
-                raise KeyError(f"No objects found in {bucket_name}.")
+        
+        if n_objects == 0 and not print_full_dict:
+            raise KeyError(f"No objects found in {bucket_name}.")
 
     def upload_table_to_s3_bucket(self, 
-                                  table: pd.DataFrame, 
+                                  table: pa.Table, 
                                   how: str, 
                                   bucket_name: str,
-                                  object_name: str) -> None:
+                                  object_name: str,
+                                  row_group_size: int = 500_000) -> None:
         '''
-        table: a pandas table
+        table: a pyarrow table or a polars dataframe
         how: 'csv' or 'parquet,' depending on the desired file type
+        row_group_size: the number of rows per parquet row group, or per chunk of csv lines
 
-        uploads a pandas table in-memory onto an S3 bucket, either as a 
-        parquet file (if how is 'parquet') or csv file (if how is 'csv')
+        streams a table onto an S3 bucket, either as a parquet file (if how is 'parquet') 
+        or csv file (if how is 'csv'), one row group at a time
         '''
-        if how == "parquet":
-            out_buffer = BytesIO()
-            table.to_parquet(out_buffer, index = False, engine = "pyarrow")
-        elif how == "csv":
-            out_buffer = StringIO()
-            table.to_csv(out_buffer, index = False)
-        else:
+        if how not in ("csv", "parquet"):
             raise ValueError("Invalid 'how' value: only 'csv' and 'parquet' are allowed.")
         
-        out_buffer.seek(0)
+        table = to_arrow_table(table)
         
-        self._create_client("s3").upload_fileobj(out_buffer, Bucket = bucket_name, Key = object_name)
+        with self.metrics.stage("s3_upload_table", object = object_name, how = how) as stage:
+            with self.open_multipart_writer(bucket_name = bucket_name, object_name = object_name) as out_file:
+                if how == "parquet":
+                    with pq.ParquetWriter(out_file, table.schema) as writer:
+                        writer.write_table(table, row_group_size = row_group_size)
+                else:
+                    with pacsv.CSVWriter(out_file, table.schema) as writer:
+                        for batch in table.to_batches(max_chunksize = row_group_size):
+                            writer.write_batch(batch)
+            
+            stage.add(rows = len(table), bytes_out = out_file.n_bytes)
         
     def upload_file_to_s3_bucket(self, 
                                  file: str,
@@ -120,4 +382,7 @@ class AmazonS3(AWSBase):
         
         uploads a file onto an S3 bucket as a file called object_name
         '''
-        self._create_client("s3").upload_file(Filename = file, Bucket = bucket_name, Key = object_name)
+        with self.metrics.stage("s3_upload_file", object = object_name) as stage:
+            self._get_s3_client().upload_file(Filename = file, Bucket = bucket_name, Key = object_name, 
+                                              Config = self._get_transfer_config())
+            stage.add(bytes_out = Path(file).stat().st_size)
@@ -0,0 +1,149 @@
+import queue
+import threading
+from time import perf_counter
+
+from .run_metrics import RunMetrics, DISABLED_METRICS
+
+class _Aborted(Exception):
+    '''
+    raised inside a stage when another stage failed, so that it stops instead of waiting forever
+    '''
+
+class _StageCounters:
+    def __init__(self, name: str):
+        self.name = name
+        self.items_out = 0
+        self.wall_seconds = 0.0
+        self.starved_seconds = 0.0
+        self.blocked_seconds = 0.0
+    
+    @property
+    def busy_seconds(self) -> float:
+        return max(self.wall_seconds - self.starved_seconds - self.blocked_seconds, 0.0)
+
+class BatchPipeline:
+    _END = object()
+    
+    def __init__(self, stages: list, queue_size: int = 2, metrics: RunMetrics = None, poll_interval: float = 0.1):
+        '''
+        stages: a list of (name, function) pairs; the first function returns an iterable of items, and every
+        later one maps the iterable of the stage before it to an iterable of its own
+        queue_size: how many items can wait between two stages
+        metrics: if specified, every stage is recorded in it as a pipeline stage; see RunMetrics
+        
+        runs the stages at the same time, each in its own thread, joined by bounded queues
+        '''
+        if not stages:
+            raise ValueError("A pipeline needs at least one stage.")
+        
+        self.stages = stages
+        self.queue_size = queue_size
+        self.metrics = metrics or DISABLED_METRICS
+        self.poll_interval = poll_interval
+        self.wall_seconds = 0.0
+        self.counters = [_StageCounters(name) for name, _ in stages]
+        
+        self._abort = threading.Event()
+        self._errors = []
+    
+    def _get(self, in_queue: queue.Queue, counters: _StageCounters):
+        '''
+        yields the items of in_queue until the stage before puts self._END in it
+        '''
+        while True:
+            start = perf_counter()
+            
+            while True:
+                try:
+                    item = in_queue.get(timeout = self.poll_interval)
+                    break
+                except queue.Empty:
+                    if self._abort.is_set():
+                        raise _Aborted()
+            
+            counters.starved_seconds += perf_counter() - start
+            
+            if item is BatchPipeline._END:
+                return
+            
+            yield item
+    
+    def _put(self, out_queue: queue.Queue, item, counters: _StageCounters) -> None:
+        start = perf_counter()
+        
+        while True:
+            try:
+                out_queue.put(item, timeout = self.poll_interval)
+                break
+            except queue.Full:
+                if self._abort.is_set():
+                    raise _Aborted()
+        
+        counters.blocked_seconds += perf_counter() - start
+    
+    def _run_stage(self, i: int, in_queue: queue.Queue, out_queue: queue.Queue) -> None:
+        name, function = self.stages[i]
+        counters = self.counters[i]
+        
+        with self.metrics.stage("pipeline", pipeline_stage = name) as record:
+            start = perf_counter()
+            items = None
+            try:
+                items = function() if in_queue is None else function(self._get(in_queue, counters))
+                
+                for item in items:
+                    counters.items_out += 1
+                    
+                    if out_queue is not None:
+                        self._put(out_queue, item, counters)
+                
+                if out_queue is not None:
+                    self._put(out_queue, BatchPipeline._END, counters)
+            except _Aborted:
+                pass
+            except BaseException as error:
+                self._errors.append((name, error))
+                self._abort.set()
+            finally:
+                # a stage that stopped early closes its generator, so that its own cleanup runs now
+                if hasattr(items, "close"):
+                    items.close()
+                
+                counters.wall_seconds = perf_counter() - start
+                record.add(items = counters.items_out, busy_seconds = counters.busy_seconds,
+                           starved_seconds = counters.starved_seconds, blocked_seconds = counters.blocked_seconds)
+    
+    def run(self) -> list:
+        '''
+        runs the pipeline to the end and returns self.report()
+        '''
+        queues = [None] + [queue.Queue(maxsize = self.queue_size) for _ in self.stages[1:]] + [None]
+        threads = [threading.Thread(target = self._run_stage, args = (i, queues[i], queues[i + 1]),
+                                    name = f"pipeline-{name}", daemon = True)
+                   for i, (name, _) in enumerate(self.stages)]
+        
+        start = perf_counter()
+        for thread in threads:
+            thread.start()
+        
+        for thread in threads:
+            thread.join()
+        
+        self.wall_seconds = perf_counter() - start
+        
+        if self._errors:
+            raise self._errors[0][1]
+        
+        return self.report()
+    
+    def report(self) -> list:
+        '''
+        returns, for every stage, the items it yielded and its busy, starved, and blocked seconds and utilization
+        '''
+        return [{"stage": counters.name,
+                 "items": counters.items_out,
+                 "busy_seconds": round(counters.busy_seconds, 3),
+                 "starved_seconds": round(counters.starved_seconds, 3),
+                 "blocked_seconds": round(counters.blocked_seconds, 3),
+                 "utilization": round(counters.busy_seconds / self.wall_seconds, 3) if self.wall_seconds else 0.0}
+                for counters in self.counters]
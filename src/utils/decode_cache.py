@@ -0,0 +1,100 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from time import time
+
+from .segment_index import file_digest
+
+class DecodeCache:
+    MANIFEST_NAME = ".decode_cache.json"
+    
+    def __init__(self, cache_dir: Path, max_entries: int = 256):
+        '''
+        cache_dir: the directory of the manifest file, typically the output directory
+        max_entries: how many entries the manifest keeps; the least recently used ones are evicted
+        
+        a manifest of decoded outputs, each with the cache key it was decoded with and where it was written
+        '''
+        self.manifest_file = Path(cache_dir).joinpath(self.MANIFEST_NAME)
+        self.max_entries = max_entries
+        
+        if self.manifest_file.exists():
+            with open(self.manifest_file, "r") as file:
+                self.manifest = json.load(file)
+        else:
+            self.manifest = {"files": {}, "entries": {}}
+    
+    def hash_file(self, file: str) -> str:
+        '''
+        returns the blake2b digest of file, which is only recomputed if its size or mtime changed
+        '''
+        stat = os.stat(file)
+        fingerprint = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        cached = self.manifest["files"].get(str(Path(file).resolve()))
+        
+        if cached is not None and all(cached[k] == v for k, v in fingerprint.items()):
+            return cached["blake2b"]
+        
+        digest = file_digest(file)
+        self.manifest["files"][str(Path(file).resolve())] = {**fingerprint, "blake2b": digest}
+        
+        return digest
+    
+    @staticmethod
+    def make_key(**inputs) -> str:
+        '''
+        inputs: everything that the decoded output depends on, as json-serializable values
+        
+        returns the blake2b digest of inputs' canonical json representation
+        '''
+        canonical = json.dumps(inputs, sort_keys = True, separators = (",", ":"))
+        
+        return hashlib.blake2b(canonical.encode(), digest_size = 32).hexdigest()
+    
+    def is_up_to_date(self, out_name: str, key: str, location: str, exists) -> bool:
+        '''
+        location: where the current run writes out_name (a local path or an s3:// uri)
+        exists: a function that returns whether a location still exists
+        
+        returns whether out_name was recorded with key and location, and is still there
+        '''
+        entry = self.manifest["entries"].get(out_name)
+        
+        if entry is None or entry["key"] != key or entry["location"] != location or not exists(location):
+            return False
+        
+        entry["last_used"] = time()
+        
+        return True
+    
+    def record(self, out_name: str, key: str, location: str) -> None:
+        '''
+        records that out_name was decoded with key and written to location, and saves the manifest
+        '''
+        self.manifest["entries"][out_name] = {"key": key, "location": location, "last_used": time()}
+        self.save()
+    
+    def evict(self) -> list:
+        '''
+        drops all but the self.max_entries most recently used entries from the manifest; returns their out_names
+        '''
+        entries = sorted(self.manifest["entries"].items(), key = lambda item: item[1]["last_used"], reverse = True)
+        evicted = [out_name for out_name, _ in entries[self.max_entries:]]
+        
+        for out_name in evicted:
+            del self.manifest["entries"][out_name]
+        
+        self.manifest["files"] = {file: fingerprint for file, fingerprint in self.manifest["files"].items()
+                                  if Path(file).exists()}
+        
+        return evicted
+    
+    def save(self) -> None:
+        self.manifest_file.parent.mkdir(parents = True, exist_ok = True)
+        temp_file = self.manifest_file.with_suffix(".tmp")
+        
+        with open(temp_file, "w") as file:
+            json.dump(self.manifest, file, indent = 2)
+        
+        os.replace(temp_file, self.manifest_file)
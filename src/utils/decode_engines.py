@@ -0,0 +1,264 @@
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from io import BytesIO
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+# An engine turns the raw lines of one segment into a pyarrow table. Every engine has the same
+# signature, engine(lines, col_specs, col_names, dtypes), where lines is a list of bytes (one per
+# record, line endings included), col_specs is a tuple of (start, end) pairs, col_names is a list of
+# column names, and dtypes is a list of declared dtypes (None where undeclared); see
+# NIBRSDecoder.get_col_specs_for_segment(), get_col_names_for_segment(), and get_dtypes_for_segment().
+
+def _to_byte_matrix(lines: list, width: int) -> np.ndarray:
+    '''
+    lays out the lines, padded or truncated to width, as an (n_lines, width) uint8 matrix
+    '''
+    records = b"".join(line.rstrip(b"\r\n")[:width].ljust(width) for line in lines)
+    
+    return np.frombuffer(records, dtype = np.uint8).reshape(len(lines), width)
+
+def _slice_column(byte_matrix: np.ndarray, start: int, end: int) -> np.ndarray:
+    '''
+    returns column [start, end) of byte_matrix as an array of fixed-width bytes
+    '''
+    return np.ascontiguousarray(byte_matrix[:, start:end]).view(f"S{end - start}").ravel()
+
+def _decode_strings(raw_values: np.ndarray) -> np.ndarray:
+    '''
+    strips and decodes an array of fixed-width bytes into an array of strings
+    '''
+    raw_values = np.char.strip(raw_values)
+    
+    try:
+        return raw_values.astype("U")
+    except UnicodeDecodeError:
+        return np.char.decode(raw_values, "latin-1")
+
+def _parse_integer_column(byte_matrix: np.ndarray, start: int, end: int) -> tuple:
+    '''
+    parses column [start, end) of byte_matrix as integers; returns (values, has_digits, is_integer),
+    where values is only meaningful where the field has digits and is an integer
+    '''
+    field_bytes = byte_matrix[:, start:end]
+    is_digit = (field_bytes >= ord("0")) & (field_bytes <= ord("9"))
+    is_space = field_bytes == ord(" ")
+    
+    n_digits = is_digit.sum(axis = 1)
+    has_digits = n_digits > 0
+    width = end - start
+    first_digit = is_digit.argmax(axis = 1)
+    last_digit = width - 1 - is_digit[:, ::-1].argmax(axis = 1)
+    
+    # e.g., '1 2' and '1A' are strings to pd.read_fwf, not numbers
+    is_integer = (is_digit | is_space).all(axis = 1) & (~has_digits | (last_digit - first_digit + 1 == n_digits))
+    
+    exponents = np.clip(last_digit[:, None] - np.arange(width)[None, :], 0, None)
+    digits = np.where(is_digit, field_bytes - ord("0"), 0).astype(np.int64)
+    
+    return (digits * 10 ** exponents).sum(axis = 1), has_digits, is_integer
+
+def infer_dtype(column: pa.Array) -> pa.Array:
+    '''
+    casts a string column to int64 or float64 as pd.read_fwf would infer it, or leaves it as strings
+    '''
+    for dtype in (pa.int64(), pa.float64()):
+        try:
+            column_as_dtype = pc.cast(column, dtype)
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+            continue
+        
+        return column_as_dtype.cast(pa.float64()) if column.null_count > 0 else column_as_dtype
+    
+    return column
+
+def _build_integer_column(values: np.ndarray, is_valid: np.ndarray, dtype: str) -> pa.Array:
+    '''
+    builds a nullable integer column of dtype (e.g., 'int16') from values; fields that are not 
+    valid, or do not fit in dtype, are missing
+    '''
+    limits = np.iinfo(dtype)
+    is_valid = is_valid & (values >= limits.min) & (values <= limits.max)
+    
+    return pa.array(np.where(is_valid, values, 0).astype(dtype), mask = ~is_valid)
+
+def _build_date_column(values: np.ndarray, is_valid: np.ndarray) -> pa.Array:
+    '''
+    builds a date32 column from YYYYMMDD integers; fields that are not valid, or are not 
+    calendar dates, are missing
+    '''
+    years, months, days = values // 10000, values // 100 % 100, values % 100
+    is_valid = is_valid & (years >= 1) & (months >= 1) & (months <= 12) & (days >= 1) & (days <= 31)
+    
+    year_months = (np.where(is_valid, years, 1970) - 1970) * 12 + np.where(is_valid, months, 1) - 1
+    dates = year_months.astype("datetime64[M]").astype("datetime64[D]") + np.where(is_valid, days, 1) - 1
+    is_valid &= dates.astype("datetime64[M]") == year_months.astype("datetime64[M]") # e.g., 20220230
+    
+    return pa.array(dates, mask = ~is_valid, type = pa.date32())
+
+def _build_category_column(raw_values: np.ndarray) -> pa.Array:
+    '''
+    builds a dictionary-encoded column from fixed-width bytes with a single vectorized np.unique; 
+    blank fields are missing
+    '''
+    categories, codes = np.unique(np.char.strip(raw_values), return_inverse = True)
+    codes = codes.ravel().astype(np.int32)
+    
+    if len(categories) > 0 and categories[0] == b"":
+        categories, codes = categories[1:], codes - 1
+    
+    return pa.DictionaryArray.from_arrays(pa.array(codes, mask = codes < 0), 
+                                          pa.array(_decode_strings(categories), type = pa.string()))
+
+def _build_string_column(raw_values: np.ndarray) -> pa.Array:
+    '''
+    builds a string column from fixed-width bytes; blank fields are missing
+    '''
+    raw_values = np.char.strip(raw_values)
+    
+    return pa.array(raw_values, mask = raw_values == b"", type = pa.binary()).cast(pa.string())
+
+INTEGER_DTYPES = ("int8", "int16", "int32", "int64")
+
+DECLARED_DTYPES = (*INTEGER_DTYPES, "date", "category", "string")
+
+def _build_declared_column(raw_values: np.ndarray, integers: np.ndarray, has_digits: np.ndarray, 
+                           is_integer: np.ndarray, dtype: str) -> pa.Array:
+    if dtype in INTEGER_DTYPES:
+        return _build_integer_column(integers, has_digits & is_integer, dtype)
+    elif dtype == "date":
+        return _build_date_column(integers, has_digits & is_integer)
+    elif dtype == "category":
+        return _build_category_column(raw_values)
+    elif dtype == "string":
+        return _build_string_column(raw_values)
+    else:
+        raise ValueError(f"Invalid dtype '{dtype}': only {', '.join(DECLARED_DTYPES)} are allowed.")
+
+def cast_declared_dtype(column: "pd.Series", dtype: str) -> pa.Array:
+    '''
+    casts a column of strings (with missing values for blank fields) to dtype, yielding the same 
+    result as the numpy engine's _build_declared_column(); used by the pandas engine
+    '''
+    import pandas as pd # only the pandas engine needs pandas, which is slow to import
+    
+    if dtype in INTEGER_DTYPES or dtype == "date":
+        is_integer = column.isna() | column.str.fullmatch(r"\d+").fillna(False)
+        
+        if not is_integer.all():
+            column = column.where(is_integer)
+        
+        values = pd.to_numeric(column).fillna(0).to_numpy(np.int64)
+        raw_values = None
+    else:
+        raw_values = column.fillna("").to_numpy(dtype = "S")
+        values = None
+    
+    return _build_declared_column(raw_values, values, column.notna().to_numpy(), 
+                                  np.ones(len(column), dtype = bool), dtype)
+
+def pandas_engine(lines: list, col_specs: tuple, col_names: list, dtypes: list = None) -> pa.Table:
+    '''
+    the reference engine: pd.read_fwf, with declared columns read as strings and cast with cast_declared_dtype()
+    '''
+    import pandas as pd # only the pandas engine needs pandas, which is slow to import
+    
+    dtypes = dtypes or [None] * len(col_names)
+    declared = {col_name: dtype for col_name, dtype in zip(col_names, dtypes) if dtype is not None}
+    
+    if not declared:
+        return pa.Table.from_pandas(pd.read_fwf(BytesIO(b"".join(lines)), colspecs = list(col_specs), names = col_names),
+                                    preserve_index = False)
+    
+    out_table = pd.read_fwf(BytesIO(b"".join(lines)), colspecs = list(col_specs), names = col_names,
+                            dtype = {col_name: str for col_name in declared}, 
+                            keep_default_na = False, na_values = [""])
+    
+    return pa.table({col_name: cast_declared_dtype(out_table[col_name].astype(object), declared[col_name]) 
+                     if col_name in declared else pa.Array.from_pandas(out_table[col_name]) 
+                     for col_name in col_names})
+
+def _slice_and_parse_column(byte_matrix: np.ndarray, start: int, end: int, dtype: str = None) -> tuple:
+    '''
+    returns (column, raw_values, integers, has_digits) for column [start, end) of byte_matrix,
+    with only what assemble_columns() needs for the column's dtype set
+    '''
+    if dtype in INTEGER_DTYPES or dtype == "date":
+        integers, has_digits, is_integer = _parse_integer_column(byte_matrix, start, end)
+        
+        return _build_declared_column(None, integers, has_digits, is_integer, dtype), None, None, None
+    
+    raw_values = _slice_column(byte_matrix, start, end)
+    
+    if dtype is not None:
+        return None, raw_values, None, None
+    
+    integers, has_digits, is_integer = _parse_integer_column(byte_matrix, start, end)
+    
+    if is_integer.all():
+        return None, raw_values, integers, has_digits
+    
+    return None, raw_values, None, None
+
+def slice_columns(lines: list, col_specs: tuple, dtypes: list = None) -> list:
+    '''
+    the first half of the numpy engine, which can run on each chunk of a segment separately
+    '''
+    dtypes = dtypes or [None] * len(col_specs)
+    width = max(end for _, end in col_specs)
+    byte_matrix = _to_byte_matrix(lines, width)
+    
+    return [_slice_and_parse_column(byte_matrix, start, end, dtype) for (start, end), dtype in zip(col_specs, dtypes)]
+
+def assemble_columns(chunks: list, col_names: list, dtypes: list = None) -> pa.Table:
+    '''
+    chunks: the output of slice_columns() for consecutive chunks of a segment, in order
+    dtypes: the declared dtype of each column, or None for columns whose dtype should be inferred
+    
+    the second half of the numpy engine: concatenates the chunks column by column into a pyarrow table
+    '''
+    dtypes = dtypes or [None] * len(col_names)
+    
+    columns = {}
+    for i, (col_name, dtype) in enumerate(zip(col_names, dtypes)):
+        parts = [chunk[i] for chunk in chunks]
+        
+        if dtype in INTEGER_DTYPES or dtype == "date":
+            column = parts[0][0] if len(parts) == 1 else pa.concat_arrays([part[0] for part in parts])
+        elif dtype is not None:
+            column = _build_declared_column(np.concatenate([part[1] for part in parts]), None, None, None, dtype)
+        elif all(part[2] is not None for part in parts):
+            integers = np.concatenate([part[2] for part in parts])
+            has_digits = np.concatenate([part[3] for part in parts])
+            
+            if has_digits.all():
+                column = pa.array(integers, type = pa.int64())
+            else:
+                column = pa.array(integers.astype(np.float64), mask = ~has_digits)
+        else:
+            values = _decode_strings(np.concatenate([part[1] for part in parts]))
+            column = infer_dtype(pa.array(values, mask = values == "", type = pa.string()))
+        
+        columns[col_name] = column
+    
+    return pa.table(columns)
+
+def numpy_engine(lines: list, col_specs: tuple, col_names: list, dtypes: list = None) -> pa.Table:
+    '''
+    the vectorized engine: slices every column out of a fixed-width byte matrix, with the pandas engine's dtypes
+    '''
+    return assemble_columns([slice_columns(lines, col_specs, dtypes)], col_names, dtypes)
+
+DECODE_ENGINES = {
+    "pandas": pandas_engine,
+    "numpy": numpy_engine
+}
+
+def get_decode_engine(engine: str):
+    try:
+        return DECODE_ENGINES[engine]
+    except KeyError:
+        raise ValueError(f"Invalid engine '{engine}': only {', '.join(DECODE_ENGINES)} are available.")
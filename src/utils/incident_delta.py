@@ -0,0 +1,137 @@
+import polars as pl
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pathlib import Path
+
+from .incident_index import KEY_COLS
+
+CHANGE_TYPES = ("inserted", "updated", "deleted")
+
+class IncidentDelta:
+    def __init__(self, segment_name: str, data_year: int, changes: pa.Table, rows: pa.Table, table: pa.Table):
+        '''
+        changes: one row per incident that differs between two releases of a segment, with its KEY_COLS
+        and change ('inserted', 'updated', or 'deleted')
+        rows: the rows of table that belong to the inserted and updated incidents
+        table: the new release, with the db_ids that its rows have once the delta is merged
+        '''
+        self.segment_name = segment_name
+        self.data_year = data_year
+        self.changes = changes
+        self.rows = rows
+        self.table = table
+        self.n_rows = table.num_rows
+    
+    @staticmethod
+    def _hash_rows(table: pl.DataFrame) -> pl.LazyFrame:
+        '''
+        returns the KEY_COLS of every row of table, as strings, with row_hash, a hash of the row but its db_id,
+        and occurrence, the number of identical rows of the incident before it
+        '''
+        return (table.lazy()
+                .select(pl.col(list(KEY_COLS)).cast(pl.String),
+                        row_hash = pl.struct(pl.exclude(*KEY_COLS, "db_id").cast(pl.String)).hash(seed = 0))
+                .with_columns(occurrence = pl.int_range(pl.len()).over(*KEY_COLS, "row_hash")))
+    
+    @staticmethod
+    def hash_incidents(table: pl.DataFrame) -> pl.DataFrame:
+        '''
+        returns one row per incident (KEY_COLS) of table with incident_hash, a hash of its rows but their db_id
+        that ignores row order and dtypes
+        '''
+        return (IncidentDelta._hash_rows(table)
+                .group_by(KEY_COLS)
+                .agg(pl.col("row_hash").sort())
+                .select(*KEY_COLS, incident_hash = pl.col("row_hash").hash(seed = 0))
+                .collect())
+    
+    @staticmethod
+    def _carry_db_ids(previous_table: pl.DataFrame, new_table: pl.DataFrame, data_year: int) -> pl.Series:
+        '''
+        returns the db_ids of new_table's rows: a row that previous_table has too keeps its db_id, and the
+        others are numbered on from the highest row number in previous_table, in order
+        '''
+        join_cols = [*KEY_COLS, "row_hash", "occurrence"]
+        previous_rows = IncidentDelta._hash_rows(previous_table).with_columns(db_id = previous_table["db_id"].cast(pl.String))
+        last_row = previous_table["db_id"].cast(pl.String).str.split("_").list.last().cast(pl.Int64).max()
+        first_row = 0 if last_row is None else last_row + 1
+        
+        return (IncidentDelta._hash_rows(new_table)
+                .with_row_index("row_number")
+                .join(previous_rows.select(*join_cols, "db_id"), on = join_cols, how = "left", join_nulls = True)
+                .sort("row_number")
+                .select(pl.coalesce("db_id", pl.concat_str(pl.lit(f"{data_year}_"),
+                                                           (pl.col("db_id").is_null().cum_sum() - 1 + first_row).cast(pl.String))))
+                .collect()
+                .to_series()
+                .alias("db_id"))
+    
+    @classmethod
+    def compare(cls, previous_table, table, segment_name: str, data_year: int) -> "IncidentDelta":
+        '''
+        previous_table, table: the previous and the new release of a decoded segment with db_id, as pyarrow tables
+        or polars dataframes
+        
+        diffs the two releases incident by incident by their IncidentDelta.hash_incidents()
+        '''
+        previous_table = previous_table if isinstance(previous_table, pl.DataFrame) else pl.from_arrow(previous_table)
+        new_table = table if isinstance(table, pl.DataFrame) else pl.from_arrow(table)
+        
+        changes = (IncidentDelta.hash_incidents(previous_table)
+                   .join(IncidentDelta.hash_incidents(new_table), on = KEY_COLS, how = "full", coalesce = True,
+                         suffix = "_new", join_nulls = True)
+                   .select(*KEY_COLS,
+                           change = pl.when(pl.col("incident_hash").is_null()).then(pl.lit("inserted"))
+                                      .when(pl.col("incident_hash_new").is_null()).then(pl.lit("deleted"))
+                                      .when(pl.col("incident_hash") != pl.col("incident_hash_new")).then(pl.lit("updated")))
+                   .filter(pl.col("change").is_not_null())
+                   .sort(KEY_COLS))
+        
+        row_numbers = (new_table
+                       .with_row_index("row_number")
+                       .with_columns(pl.col(list(KEY_COLS)).cast(pl.String))
+                       .join(changes.filter(pl.col("change") != "deleted"), on = KEY_COLS, how = "semi", join_nulls = True)
+                       .sort("row_number")["row_number"])
+        
+        table = table.to_arrow() if isinstance(table, pl.DataFrame) else table
+        
+        if "db_id" in table.column_names:
+            table = table.drop_columns(["db_id"])
+        
+        table = table.append_column("db_id", IncidentDelta._carry_db_ids(previous_table, new_table, data_year).to_arrow().cast(pa.string()))
+        
+        return cls(segment_name, data_year, changes.to_arrow(), table.take(row_numbers.to_arrow()), table)
+    
+    def summarize(self) -> dict:
+        '''
+        returns the number of incidents per change type and the share of the new release's rows
+        that the delta reloads
+        '''
+        change_counts = pl.from_arrow(self.changes)["change"].value_counts()
+        summary = {change: 0 for change in CHANGE_TYPES}
+        summary.update(dict(zip(change_counts["change"].to_list(), change_counts["count"].to_list())))
+        
+        summary["rows"] = self.rows.num_rows
+        summary["pct_rows"] = round(100 * self.rows.num_rows / self.n_rows, 2) if self.n_rows else 0.0
+        
+        return summary
+    
+    @staticmethod
+    def object_names(segment_name: str, data_year: int) -> tuple:
+        '''
+        returns the file names of a delta's changes and rows, which sit next to the segment's
+        {segment_name}_{data_year}.parquet
+        '''
+        return f"{segment_name}_{data_year}_changes.parquet", f"{segment_name}_{data_year}_delta.parquet"
+    
+    def write(self, output_dir: str) -> tuple:
+        '''
+        writes self.changes and self.rows to output_dir; returns their paths
+        '''
+        changes_file, rows_file = [Path(output_dir).joinpath(object_name)
+                                   for object_name in IncidentDelta.object_names(self.segment_name, self.data_year)]
+        
+        pq.write_table(self.changes, changes_file)
+        pq.write_table(self.rows, rows_file)
+        
+        return changes_file, rows_file
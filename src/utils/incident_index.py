@@ -0,0 +1,277 @@
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+KEY_COLS = ("ori", "incident_number")
+
+# segment_name: the column of the administrative segment that counts the incident's rows in that segment
+TOTAL_COUNT_COLS = {
+    "offense_segment": "total_offense_segments",
+    "victim_segment": "total_victim_segments",
+    "offender_segment": "total_offender_segments",
+    "arrestee_segment": "total_arrestee_segments"
+}
+
+_KEY_SEPARATOR = "\x1f"
+
+class IncidentIndex:
+    def __init__(self, output_dir: str, data_year: int, keys: np.ndarray, counts: dict, row_orders: dict, fingerprint: dict):
+        '''
+        output_dir: the directory of the decoded segments, e.g., administrative_segment_2022.parquet
+        
+        keys: the sorted, unique incident keys of the administrative segment; an incident's id is its position in keys
+        counts, row_orders: dictionaries of segment_name:array pairs, the number of rows of every incident and
+        the segment's row numbers ordered by incident id, orphans last
+        fingerprint: the size and mtime of every segment file when it was indexed
+        '''
+        self.output_dir = Path(output_dir)
+        self.data_year = data_year
+        self.keys = keys
+        self.counts = counts
+        self.row_orders = row_orders
+        self.fingerprint = fingerprint
+        self.starts = {segment_name: np.concatenate(([0], np.cumsum(segment_counts)[:-1]))
+                       for segment_name, segment_counts in counts.items()}
+    
+    @property
+    def segment_names(self) -> list:
+        return list(self.counts.keys())
+    
+    @staticmethod
+    def segment_file(output_dir: str, segment_name: str, data_year: int) -> Path:
+        return Path(output_dir).joinpath(f"{segment_name}_{data_year}.parquet")
+    
+    @staticmethod
+    def sidecar_path(output_dir: str, data_year: int) -> Path:
+        return Path(output_dir).joinpath(f"incident_index_{data_year}.npz")
+    
+    @staticmethod
+    def _stat(file: Path) -> dict:
+        stat = os.stat(file)
+        
+        return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    
+    @staticmethod
+    def _read_keys(segment_file: Path) -> pa.Array:
+        table = pq.read_table(segment_file, columns = list(KEY_COLS))
+        
+        return pc.binary_join_element_wise(*[table[col] for col in KEY_COLS], _KEY_SEPARATOR).combine_chunks()
+    
+    @staticmethod
+    def _encode_key(ori: str, incident_number: str) -> bytes:
+        return f"{ori}{_KEY_SEPARATOR}{incident_number}".encode()
+    
+    @classmethod
+    def build(cls, output_dir: str, data_year: int, segment_names: list) -> "IncidentIndex":
+        '''
+        segment_names: the decoded segments to index, which must include administrative_segment
+        
+        matches the keys of every segment's rows to their incidents; writes the index to its sidecar file and returns it
+        '''
+        if "administrative_segment" not in segment_names:
+            raise ValueError("The administrative segment defines the incidents: include it in segment_names.")
+        
+        segment_names = ["administrative_segment"] + [name for name in segment_names if name != "administrative_segment"]
+        segment_files = {name: cls.segment_file(output_dir, name, data_year) for name in segment_names}
+        
+        keys = pc.unique(cls._read_keys(segment_files["administrative_segment"]).drop_null())
+        keys = keys.take(pc.sort_indices(keys))
+        
+        counts, row_orders = {}, {}
+        for segment_name, segment_file in segment_files.items():
+            incident_ids = (pc.index_in(cls._read_keys(segment_file), value_set = keys)
+                            .fill_null(len(keys))
+                            .to_numpy())
+            
+            counts[segment_name] = np.bincount(incident_ids, minlength = len(keys) + 1)[:-1]
+            row_orders[segment_name] = np.argsort(incident_ids, kind = "stable").astype(np.int64)
+        
+        fingerprint = {name: cls._stat(segment_file) for name, segment_file in segment_files.items()}
+        
+        incident_index = cls(output_dir, data_year, np.asarray(keys.to_numpy(zero_copy_only = False), dtype = "S"),
+                             counts, row_orders, fingerprint)
+        incident_index.save()
+        
+        return incident_index
+    
+    def save(self) -> None:
+        np.savez(self.sidecar_path(self.output_dir, self.data_year),
+                 keys = self.keys,
+                 **{f"{name}_counts": segment_counts for name, segment_counts in self.counts.items()},
+                 **{f"{name}_row_order": row_order for name, row_order in self.row_orders.items()},
+                 fingerprint = np.array(json.dumps(self.fingerprint)))
+    
+    def is_current(self) -> bool:
+        '''
+        whether every indexed segment file still has the size and mtime it was indexed with
+        '''
+        for segment_name, fingerprint in self.fingerprint.items():
+            segment_file = self.segment_file(self.output_dir, segment_name, self.data_year)
+            
+            if not segment_file.exists() or self._stat(segment_file) != fingerprint:
+                return False
+        
+        return True
+    
+    @classmethod
+    def load(cls, output_dir: str, data_year: int) -> "IncidentIndex":
+        '''
+        reads the sidecar index of the segments in output_dir and raises a ValueError if it is stale
+        '''
+        sidecar = cls.sidecar_path(output_dir, data_year)
+        
+        try:
+            with np.load(sidecar) as arrays:
+                fingerprint = json.loads(str(arrays["fingerprint"]))
+                incident_index = cls(output_dir, data_year,
+                                     keys = arrays["keys"],
+                                     counts = {name: arrays[f"{name}_counts"] for name in fingerprint},
+                                     row_orders = {name: arrays[f"{name}_row_order"] for name in fingerprint},
+                                     fingerprint = fingerprint)
+        except FileNotFoundError:
+            raise FileNotFoundError(f"No incident index found for {data_year} in {output_dir}: expected {sidecar}.")
+        
+        if not incident_index.is_current():
+            raise ValueError(f"{sidecar} is stale: a segment in {output_dir} has changed since it was indexed.")
+        
+        return incident_index
+    
+    @classmethod
+    def load_or_build(cls, output_dir: str, data_year: int, segment_names: list) -> "IncidentIndex":
+        '''
+        loads the sidecar index if it is current and covers segment_names; otherwise builds it
+        '''
+        try:
+            incident_index = cls.load(output_dir, data_year)
+            
+            if set(segment_names) <= set(incident_index.segment_names):
+                return incident_index
+        except (FileNotFoundError, ValueError):
+            pass
+        
+        return cls.build(output_dir, data_year, segment_names)
+    
+    def n_orphans(self, segment_name: str) -> int:
+        '''
+        returns the number of the segment's rows whose key is not in the administrative segment
+        '''
+        return len(self.row_orders[segment_name]) - int(self.counts[segment_name].sum())
+    
+    def find(self, ori: str, incident_number: str) -> int:
+        '''
+        returns the id of the incident, with a binary search over the sorted keys
+        '''
+        key = self._encode_key(ori, incident_number)
+        incident_id = int(np.searchsorted(self.keys, key))
+        
+        if incident_id == len(self.keys) or self.keys[incident_id] != key:
+            raise KeyError(f"No incident {incident_number} of {ori} in the {self.data_year} index.")
+        
+        return incident_id
+    
+    def row_numbers(self, segment_name: str, incident_ids) -> np.ndarray:
+        '''
+        returns the row numbers of the segment's rows that belong to incident_ids, incident by incident
+        '''
+        incident_ids = np.atleast_1d(incident_ids)
+        starts, counts = self.starts[segment_name][incident_ids], self.counts[segment_name][incident_ids]
+        positions = np.repeat(starts - np.concatenate(([0], np.cumsum(counts)[:-1])), counts) + np.arange(counts.sum())
+        
+        return self.row_orders[segment_name][positions]
+    
+    def take(self, segment_name: str, incident_ids, columns: list = None) -> pa.Table:
+        '''
+        returns the segment's rows that belong to incident_ids, by reading only the row groups that
+        hold them rather than the whole segment file
+        '''
+        row_numbers = self.row_numbers(segment_name, incident_ids)
+        parquet_file = pq.ParquetFile(self.segment_file(self.output_dir, segment_name, self.data_year))
+        
+        if len(row_numbers) == 0:
+            return parquet_file.schema_arrow.empty_table().select(columns or parquet_file.schema_arrow.names)
+        
+        group_sizes = [parquet_file.metadata.row_group(i).num_rows for i in range(parquet_file.num_row_groups)]
+        group_starts = np.concatenate(([0], np.cumsum(group_sizes)))
+        row_groups = np.unique(np.searchsorted(group_starts, row_numbers, side = "right") - 1)
+        
+        # where each row group that is read starts within the table of the row groups that are read
+        read_starts = np.concatenate(([0], np.cumsum(np.asarray(group_sizes)[row_groups])[:-1]))
+        group_of_row = np.searchsorted(row_groups, np.searchsorted(group_starts, row_numbers, side = "right") - 1)
+        
+        table = parquet_file.read_row_groups(row_groups.tolist(), columns = columns)
+        
+        return table.take(row_numbers - group_starts[row_groups][group_of_row] + read_starts[group_of_row])
+    
+    def _read_ordered_segment(self, segment_name: str, columns: list = None) -> pa.Table:
+        '''
+        returns the segment's rows that belong to an incident, ordered by incident id
+        '''
+        table = pq.read_table(self.segment_file(self.output_dir, segment_name, self.data_year), columns = columns)
+        
+        return table.take(self.row_orders[segment_name][:int(self.counts[segment_name].sum())])
+    
+    def assemble(self, columns: dict = None) -> pa.Table:
+        '''
+        columns: a dictionary of segment_name:list of columns pairs; by default, every column but the
+        keys of every indexed segment
+        
+        returns an incident-level table: the keys and administrative columns, then n_{segment_name} and
+        {segment_name}, a list of the incident's rows as structs, for every other segment
+        '''
+        columns = columns or {}
+        out_table = None
+        
+        for segment_name in self.segment_names:
+            segment_cols = columns.get(segment_name)
+            if segment_cols is not None:
+                segment_cols = list(KEY_COLS) + [col for col in segment_cols if col not in KEY_COLS]
+            
+            segment_table = self._read_ordered_segment(segment_name, segment_cols)
+            counts = self.counts[segment_name]
+            
+            if segment_name == "administrative_segment":
+                out_table = segment_table.take(self.starts[segment_name])
+            else:
+                segment_table = segment_table.drop_columns(list(KEY_COLS))
+                rows = pa.StructArray.from_arrays([col.combine_chunks() for col in segment_table.columns],
+                                                  names = segment_table.column_names)
+                offsets = pa.array(np.concatenate(([0], np.cumsum(counts))), pa.int64())
+                
+                out_table = out_table.append_column(f"n_{segment_name}", pa.array(counts, pa.int32()))
+                out_table = out_table.append_column(segment_name, pa.LargeListArray.from_arrays(offsets, rows))
+        
+        return out_table
+    
+    def check_counts(self) -> pa.Table:
+        '''
+        returns the incidents whose count columns (see TOTAL_COUNT_COLS) disagree with their indexed rows
+        '''
+        checked = {name: col for name, col in TOTAL_COUNT_COLS.items() if name in self.counts}
+        admin_table = self._read_ordered_segment("administrative_segment", list(KEY_COLS) + list(checked.values()))
+        admin_table = admin_table.take(self.starts["administrative_segment"])
+        
+        mismatches = []
+        for segment_name, count_col in checked.items():
+            expected = admin_table[count_col].to_numpy(zero_copy_only = False)
+            found = self.counts[segment_name]
+            mismatched = np.flatnonzero(~np.isnan(expected.astype(float)) & (expected != found))
+            
+            mismatches.append(pa.table({
+                "ori": admin_table["ori"].take(mismatched),
+                "incident_number": admin_table["incident_number"].take(mismatched),
+                "segment_name": pa.array([segment_name] * len(mismatched), pa.string()),
+                "expected": pa.array(expected[mismatched], pa.int64()),
+                "found": pa.array(found[mismatched], pa.int64())
+                }))
+        
+        if not mismatches:
+            return pa.table({"ori": pa.array([], pa.string()), "incident_number": pa.array([], pa.string()),
+                             "segment_name": pa.array([], pa.string()), "expected": pa.array([], pa.int64()),
+                             "found": pa.array([], pa.int64())})
+        
+        return pa.concat_tables(mismatches)
\ No newline at end of file
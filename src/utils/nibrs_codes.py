@@ -0,0 +1,134 @@
+import pyarrow as pa
+import pyarrow.compute as pc
+
+class NIBRSCodeMapper:
+    def __init__(self, nibrs_codes: dict):
+        '''
+        nibrs_codes: a dictionary of code lists (code:label pairs), plus a dictionary_version and a
+        code_columns key that assigns code lists to the code columns of each segment, which should
+        look something like in the .yaml file
+        
+        ------------------- an example of nibrs_codes (as a .yaml file)
+            dictionary_version: 1
+            
+            code_columns:
+                offense_segment:
+                    ucr_offense_code: [group_a_offenses, group_b_offenses]
+            
+            group_a_offenses:
+                09A: murder
+            
+            group_b_offenses:
+                90A: bad_checks
+        -------------------
+        '''
+        for key in ("dictionary_version", "code_columns"):
+            if key not in nibrs_codes.keys():
+                raise KeyError(f"Invalid nibrs_codes. It must have a {key} key.")
+        
+        self.nibrs_codes = nibrs_codes
+        self.version = nibrs_codes["dictionary_version"]
+        self._dictionaries = {}
+    
+    def _get_code_list(self, code_list_name: str) -> dict:
+        try:
+            return {str(code): label for code, label in self.nibrs_codes[code_list_name].items()}
+        except KeyError:
+            raise KeyError(f"{code_list_name} is not a code list in nibrs_codes.")
+    
+    def get_dictionary(self, code_list_names: list) -> tuple:
+        '''
+        returns (codes, labels) for the code lists in code_list_names: codes is the string array that
+        code columns are dictionary-encoded with, and labels are the codes' labels, in order
+        '''
+        key = tuple(code_list_names)
+        
+        if key not in self._dictionaries:
+            code_to_label = {}
+            for code_list_name in code_list_names:
+                code_to_label.update(self._get_code_list(code_list_name))
+            
+            self._dictionaries[key] = (pa.array(list(code_to_label.keys()), type = pa.string()),
+                                       pa.array(list(map(str, code_to_label.values())), type = pa.string()))
+        
+        return self._dictionaries[key]
+    
+    def get_code_columns_for_segment(self, segment_name: str) -> dict:
+        '''
+        returns a dictionary of col_name:code_list_names pairs, which is empty if the segment has
+        no code columns
+        '''
+        return self.nibrs_codes["code_columns"].get(segment_name) or {}
+    
+    @staticmethod
+    def _encode_chunk(chunk: pa.Array, codes: pa.Array) -> tuple:
+        '''
+        returns (encoded, unknown): chunk dictionary-encoded with codes, and a mask of its values that
+        are not in codes
+        '''
+        if pa.types.is_dictionary(chunk.type):
+            positions = pc.index_in(chunk.dictionary.cast(pa.string()), value_set = codes).take(chunk.indices)
+        else:
+            positions = pc.index_in(chunk.cast(pa.string()), value_set = codes)
+        
+        return pa.DictionaryArray.from_arrays(positions, codes), pc.and_(chunk.is_valid(), positions.is_null())
+    
+    def encode(self, table: pa.Table, segment_name: str, errors: str = "raise") -> pa.Table:
+        '''
+        errors: what to do with codes that are not in the dictionary; 'raise' a ValueError or
+        'coerce' them to missing values
+        
+        returns a copy of table with the segment's code columns encoded with their fixed dictionaries
+        '''
+        if errors not in ("raise", "coerce"):
+            raise ValueError(f"Invalid errors '{errors}': only raise, coerce are allowed.")
+        
+        out_table = table
+        
+        for col_name, code_list_names in self.get_code_columns_for_segment(segment_name).items():
+            if col_name not in out_table.column_names:
+                continue
+            
+            codes, _ = self.get_dictionary(code_list_names)
+            column = out_table.column(col_name)
+            encoded_chunks = [NIBRSCodeMapper._encode_chunk(chunk, codes) for chunk in column.chunks]
+            
+            if errors == "raise":
+                unknown_codes = pc.unique(pa.chunked_array(
+                    [chunk.filter(unknown).cast(pa.string()) for chunk, (_, unknown) in zip(column.chunks, encoded_chunks)],
+                    type = pa.string()
+                    ))
+                
+                if len(unknown_codes) > 0:
+                    raise ValueError(f"{segment_name}.{col_name} has codes that are not in the dictionary "
+                                     f"(version {self.version}): {', '.join(unknown_codes[:10].to_pylist())}.")
+            
+            encoded = pa.chunked_array([encoded for encoded, _ in encoded_chunks], type = pa.dictionary(pa.int32(), pa.string()))
+            out_table = out_table.set_column(out_table.schema.get_field_index(col_name), col_name, encoded)
+        
+        return out_table.replace_schema_metadata({**(out_table.schema.metadata or {}), 
+                                                  b"nibrs_codes_version": str(self.version).encode()})
+        
+    def decode_labels(self, table: pa.Table, segment_name: str) -> pa.Table:
+        '''
+        returns a copy of table in which the segment's encoded code columns (see self.encode())
+        hold labels instead of codes; only the dictionaries are replaced, so no row is touched
+        '''
+        out_table = table
+        
+        for col_name, code_list_names in self.get_code_columns_for_segment(segment_name).items():
+            if col_name not in out_table.column_names:
+                continue
+            
+            codes, labels = self.get_dictionary(code_list_names)
+            column = out_table.column(col_name)
+            
+            if not all(pa.types.is_dictionary(chunk.type) and chunk.dictionary.equals(codes) for chunk in column.chunks):
+                raise ValueError(f"{segment_name}.{col_name} is not encoded with the dictionary of "
+                                 f"version {self.version}; see NIBRSCodeMapper.encode().")
+            
+            labeled = pa.chunked_array([pa.DictionaryArray.from_arrays(chunk.indices, labels) for chunk in column.chunks],
+                                       type = pa.dictionary(pa.int32(), pa.string()))
+            out_table = out_table.set_column(out_table.schema.get_field_index(col_name), col_name, labeled)
+        
+        return out_table
@@ -1,8 +1,59 @@
-import pandas as pd
-from io import StringIO
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from io import BufferedReader, BytesIO
+from pathlib import Path
+from itertools import islice
+from time import perf_counter, process_time
+
+from .decode_engines import DECLARED_DTYPES, get_decode_engine, slice_columns, assemble_columns
+from .segment_index import SegmentIndex
+from .run_metrics import RunMetrics, DISABLED_METRICS
+from .segment_validator import SegmentValidator
+
+def _slice_byte_range(nibrs_master_file: str, start: int, end: int, segments: dict, 
+                      validator: SegmentValidator = None) -> tuple:
+    '''
+    segments: a dictionary of segment_code:(segment_name, col_specs, dtypes) tuples
+    
+    slices the columns of the lines in [start, end) by segment, in a worker process;
+    returns ({segment_name: sliced columns}, validator, cpu seconds)
+    '''
+    cpu_start = process_time()
+    segments_as_lines = {segment_name: [] for segment_name, _, _ in segments.values()}
+    
+    with open(nibrs_master_file, "rb") as file:
+        file.seek(start)
+        byte_range = file.read(end - start)
+    
+    for line in BytesIO(byte_range):
+        segment = segments.get(line[0:2])
+        
+        if segment is not None:
+            segments_as_lines[segment[0]].append(line)
+    
+    sliced_segments = {segment_name: slice_columns(segments_as_lines[segment_name], col_specs, dtypes) 
+                       for segment_name, col_specs, dtypes in segments.values()}
+    
+    if validator is not None:
+        for segment_name, sliced_columns in sliced_segments.items():
+            # integer and date columns are built in the worker, as the first element of each sliced column
+            columns = {col_name: sliced_column[0] for col_name, sliced_column in zip(validator.col_specs[segment_name], sliced_columns)}
+            validator.check_records(segment_name, segments_as_lines[segment_name], columns)
+    
+    return sliced_segments, validator, process_time() - cpu_start
 
 class NIBRSDecoder:
-    def __init__(self, nibrs_master_file: str, col_specs: dict):
+    # bump whenever a change to the decoder changes its output, which invalidates every DecodeCache entry
+    VERSION = 2
+    
+    def __init__(self, nibrs_master_file: str, col_specs: dict, engine: str = "pandas", use_index: bool = False,
+                 n_workers: int = 1, zip_member: str = None, metrics: RunMetrics = None, 
+                 validator: SegmentValidator = None):
         '''
         nibrs_master_file: the path to the NIBRS fixed-length, ASCII text file for some year
         
@@ -15,19 +66,90 @@ class NIBRSDecoder:
 
             administrative_segment:
                 col1: [start1, end1]
-                col2: [start2, end2]
+                col2: [start2, end2, dtype2]
         -------------------
         
+        A column's optional third element declares its dtype: int8 to int64, date (YYYYMMDD), category, or string.
+        Decoded segments are pyarrow tables; call .to_pandas() on one if a pandas table is needed.
+        
         In the NIBRS data, the segment 'level' (a 2-character alphanumeric sequence) is how we can 
         delineate which lines belong to which segment in the aforementioned text file. For example, 
         all lines that start with '01' are the so-called administrative segment data.
+        
+        engine: 'pandas' (pd.read_fwf) or 'numpy' (vectorized); see decode_engines.py
+        
+        use_index: if True, only read each segment's byte ranges, from a sidecar index; see segment_index.py
+        
+        n_workers: the number of processes that decode byte ranges of the file ('numpy' engine only, without use_index)
+        
+        zip_member: if nibrs_master_file is zipped (e.g., nibrs-2022.zip), the text file to stream from it,
+        which may be omitted if it is the archive's only .txt file
+        
+        metrics: if specified, every stage of decoding is recorded in it; see RunMetrics
+        
+        validator: if specified, every batch of lines is checked, in the same pass, by it; see SegmentValidator
         '''
         self.nibrs_master_file = nibrs_master_file
         self.col_specs = col_specs
+        self.engine = engine
+        self._decode_lines = get_decode_engine(engine)
+        self.zip_member = self._find_zip_member(zip_member) if zipfile.is_zipfile(nibrs_master_file) else None
+        
+        if self.zip_member is not None and (use_index or n_workers > 1):
+            raise ValueError("use_index and n_workers > 1 require an extracted master file, not a zipped one.")
+        
+        self.segment_index = SegmentIndex.load_or_build(nibrs_master_file) if use_index else None
+        self.n_workers = n_workers
+        self.parallel_report = None
+        self.metrics = metrics or DISABLED_METRICS
+        self.validator = validator
+        self._compiled_segments = {}
         
         if "segment_level_codes" not in self.col_specs.keys():
             raise KeyError("Invalid col_specs. It must have a segment_level_codes key.")
         
+        if n_workers > 1 and (engine != "numpy" or use_index):
+            raise ValueError("Parallel decoding (n_workers > 1) requires the 'numpy' engine and no index.")
+        
+    def _find_zip_member(self, zip_member: str = None) -> str:
+        with zipfile.ZipFile(self.nibrs_master_file) as zipped_file:
+            member_names = zipped_file.namelist()
+        
+        if zip_member is None:
+            text_files = [member_name for member_name in member_names if member_name.lower().endswith(".txt")]
+            
+            if len(text_files) != 1:
+                raise ValueError(f"Specify zip_member: {self.nibrs_master_file} does not have exactly one "
+                                 f".txt file. Its contents are: {', '.join(member_names)}.")
+            
+            return text_files[0]
+        
+        if zip_member not in member_names:
+            raise KeyError(f"{zip_member} not found in {self.nibrs_master_file}.")
+        
+        return zip_member
+    
+    @property
+    def master_file_name(self) -> str:
+        '''
+        the file name of the text file being decoded, which is prefixed with the data year
+        '''
+        return Path(self.zip_member if self.zip_member is not None else self.nibrs_master_file).name
+    
+    @contextmanager
+    def _open_master_file(self, buffer_size: int = 1024 * 1024):
+        '''
+        opens self.nibrs_master_file for reading in binary mode or, if it is zipped, opens 
+        self.zip_member as a decompressing stream
+        '''
+        if self.zip_member is None:
+            with open(self.nibrs_master_file, "rb", buffering = buffer_size) as file:
+                yield file
+        else:
+            with zipfile.ZipFile(self.nibrs_master_file) as zipped_file:
+                with BufferedReader(zipped_file.open(self.zip_member), buffer_size = buffer_size) as file:
+                    yield file
+    
     def _view_all_segment_level_codes(self) -> None:
         '''
         prints all available segment codes defined in self.col_specs["segment_level_codes"]
@@ -39,35 +161,241 @@ class NIBRSDecoder:
         try:
             return self.col_specs.get("segment_level_codes")[segment_name]
         except KeyError:
-            raise KeyError("no code for {segment_name} found in col_specs")
+            raise KeyError(f"no code for {segment_name} found in col_specs")
         
     def get_col_specs_for_segment(self, segment_name: str) -> tuple:
         col_specs_config = self.col_specs[segment_name]
         
-        return tuple(tuple(i) for i in col_specs_config.values())
+        return tuple(tuple(i[0:2]) for i in col_specs_config.values())
     
     def get_col_names_for_segment(self, segment_name: str) -> list:
         return list(self.col_specs[segment_name].keys())
     
-    def decode_segment(self, segment_name: str) -> pd.DataFrame:
+    def get_dtypes_for_segment(self, segment_name: str) -> list:
+        '''
+        returns the declared dtype of each of the segment's columns, or None for undeclared columns
+        '''
+        dtypes = [i[2] if len(i) > 2 else None for i in self.col_specs[segment_name].values()]
+        
+        for dtype in dtypes:
+            if dtype is not None and dtype not in DECLARED_DTYPES:
+                raise ValueError(f"Invalid dtype '{dtype}' in col_specs for {segment_name}: "
+                                 f"only {', '.join(DECLARED_DTYPES)} are allowed.")
+        
+        return dtypes
+    
+    def compile_segment(self, segment_name: str) -> tuple:
+        '''
+        returns (col_specs, col_names, dtypes) of the segment, as the engines take them, built once per decoder
+        '''
+        if segment_name not in self._compiled_segments:
+            self._compiled_segments[segment_name] = (self.get_col_specs_for_segment(segment_name), 
+                                                     self.get_col_names_for_segment(segment_name),
+                                                     self.get_dtypes_for_segment(segment_name))
+        
+        return self._compiled_segments[segment_name]
+    
+    def _read_segment(self, segment_name: str, lines: list, first_row: int = 0) -> pa.Table:
+        '''
+        first_row: the row number of the first of lines within its segment, which only matters to self.validator
+        '''
+        with self.metrics.stage("parse", segment = segment_name, engine = self.engine) as stage:
+            out_table = self._decode_lines(lines, *self.compile_segment(segment_name))
+            stage.add(rows = len(out_table), bytes_in = sum(map(len, lines)))
+        
+        if self.validator is not None:
+            with self.metrics.stage("validate", segment = segment_name) as stage:
+                self.validator.validate(segment_name, lines, out_table, first_row)
+                stage.add(rows = len(out_table))
+        
+        return out_table
+    
+    @staticmethod
+    def add_db_id(table: pa.Table, data_year: str, first_row: int = 0) -> pa.Table:
+        '''
+        first_row: the row number of table's first row within its segment, e.g., the number of rows 
+        in the segment's earlier batches
+        
+        appends db_id, the primary key of the raw tables, {data_year}_{row number within the segment}
+        '''
+        row_numbers = pa.array(np.arange(first_row, first_row + table.num_rows)).cast(pa.string())
+        
+        return table.append_column("db_id", pc.binary_join_element_wise(str(data_year), row_numbers, "_"))
+    
+    def decode_segment(self, segment_name: str) -> pa.Table:
         '''
         this opens self.nibrs_master_file; filters for lines that start with 
-        self._get_code_for_segment(segment_name); and produces a pandas table 
+        self._get_code_for_segment(segment_name); and produces a pyarrow table 
         based on the segment's column widths & names as defined in self.col_specs
         '''
-        segment_code = self._get_code_for_segment(segment_name)
-        col_specs = self.get_col_specs_for_segment(segment_name)
-        col_names = self.get_col_names_for_segment(segment_name)
+        return self.decode_segments([segment_name])[segment_name]
+    
+    def decode_segments(self, segment_names: list) -> dict:
+        '''
+        segment_names: the segments to decode, each of which must be defined in self.col_specs
         
-        with open(self.nibrs_master_file, "r") as file:
-            filtered_lines = (line for line in file if line.startswith(segment_code))
+        decodes the segments in a single pass over self.nibrs_master_file (or in parallel, if self.n_workers > 1);
+        returns a dictionary of segment_name:pyarrow table pairs
+        '''
+        if self.n_workers > 1:
+            return self._decode_segments_in_parallel(segment_names)
+        
+        if self.segment_index is not None:
+            out_tables = {}
+            for segment_name in segment_names:
+                with self.metrics.stage("read_indexed", segment = segment_name) as stage:
+                    lines = self.segment_index.read_lines(self._get_code_for_segment(segment_name))
+                    stage.add(rows = len(lines), bytes_in = sum(map(len, lines)))
+                
+                out_tables[segment_name] = self._read_segment(segment_name, lines)
             
-            segment_as_text = StringIO()
-            for line in filtered_lines:
-                segment_as_text.write(line)
+            return out_tables
+        
+        code_to_segment = {self._get_code_for_segment(segment_name).encode(): segment_name 
+                           for segment_name in segment_names}
+        segments_as_lines = {segment_name: [] for segment_name in code_to_segment.values()}
+        
+        with self.metrics.stage("read_and_route") as stage:
+            with self._open_master_file() as file:
+                for line in file:
+                    segment_name = code_to_segment.get(line[0:2])
+                    
+                    if segment_name is not None:
+                        segments_as_lines[segment_name].append(line)
+                
+                stage.add(bytes_in = file.tell(), rows = sum(map(len, segments_as_lines.values())))
+        
+        return {segment_name: self._read_segment(segment_name, lines) 
+                for segment_name, lines in segments_as_lines.items()}
+    
+    def _split_into_byte_ranges(self, n_ranges: int) -> list:
+        '''
+        splits self.nibrs_master_file into at most n_ranges (start, end) byte ranges of roughly equal 
+        size, each of which starts at the beginning of a line and ends right after a line ending
+        '''
+        file_size = os.path.getsize(self.nibrs_master_file)
+        boundaries = [0]
+        
+        with open(self.nibrs_master_file, "rb") as file:
+            for i in range(1, n_ranges):
+                approximate_boundary = max(file_size * i // n_ranges, boundaries[-1] + 1)
+                
+                if approximate_boundary >= file_size:
+                    break
+                
+                file.seek(approximate_boundary - 1)
+                file.readline() # moves to the start of the next line
+                boundaries.append(file.tell())
+        
+        boundaries.append(file_size)
+        
+        return [(start, end) for start, end in zip(boundaries[:-1], boundaries[1:]) if end > start]
+    
+    def _decode_segments_in_parallel(self, segment_names: list, ranges_per_worker: int = 4) -> dict:
+        '''
+        slices newline-aligned byte ranges in a pool of self.n_workers processes and assembles them in file order;
+        sets self.parallel_report to the run's timings
+        '''
+        wall_start = perf_counter()
+        segments = {self._get_code_for_segment(segment_name).encode(): 
+                        (segment_name, self.get_col_specs_for_segment(segment_name), self.get_dtypes_for_segment(segment_name)) 
+                    for segment_name in segment_names}
+        byte_ranges = self._split_into_byte_ranges(self.n_workers * ranges_per_worker)
+        
+        with self.metrics.stage("slice_in_workers", n_workers = self.n_workers) as stage:
+            with ProcessPoolExecutor(max_workers = self.n_workers) as executor:
+                results = list(executor.map(_slice_byte_range, 
+                                            [self.nibrs_master_file] * len(byte_ranges),
+                                            [start for start, _ in byte_ranges],
+                                            [end for _, end in byte_ranges],
+                                            [segments] * len(byte_ranges),
+                                            [self.validator] * len(byte_ranges)))
             
-            segment_as_text.seek(0) # to reset the pointer to the very beginning
+            worker_seconds = sum(cpu_seconds for _, _, cpu_seconds in results)
+            stage.add(bytes_in = byte_ranges[-1][1] if byte_ranges else 0, worker_cpu_seconds = worker_seconds)
+        
+        assemble_start = perf_counter()
+        out_tables = {}
+        for segment_name, _, dtypes in segments.values():
+            with self.metrics.stage("assemble", segment = segment_name) as stage:
+                out_tables[segment_name] = assemble_columns([sliced_segments[segment_name] for sliced_segments, _, _ in results], 
+                                                            self.get_col_names_for_segment(segment_name),
+                                                            dtypes)
+                stage.add(rows = len(out_tables[segment_name]))
+        
+        if self.validator is not None:
+            with self.metrics.stage("validate", n_workers = self.n_workers) as stage:
+                # the workers numbered their rows from 0, so each range's rows follow those of the ranges before it
+                first_rows = {}
+                for _, range_validator, _ in results:
+                    self.validator.merge(range_validator, first_rows)
+                    
+                    for segment_name, n_rows in range_validator.n_rows.items():
+                        first_rows[segment_name] = first_rows.get(segment_name, 0) + n_rows
+                
+                for segment_name, out_table in out_tables.items():
+                    self.validator.check_table(segment_name, out_table)
+                
+                stage.add(rows = sum(map(len, out_tables.values())))
+        wall_end = perf_counter()
+        
+        assemble_seconds = wall_end - assemble_start
+        wall_seconds = wall_end - wall_start
+        
+        self.parallel_report = {
+            "n_workers": self.n_workers,
+            "n_byte_ranges": len(byte_ranges),
+            "worker_cpu_seconds": round(worker_seconds, 2),
+            "assemble_seconds": round(assemble_seconds, 2),
+            "wall_seconds": round(wall_seconds, 2),
+            "speedup": round((worker_seconds + assemble_seconds) / wall_seconds, 2)
+        }
+        
+        return out_tables
+    
+    def decode_all(self) -> dict:
+        '''
+        decodes every segment in self.col_specs["segment_level_codes"] in a single pass 
+        over self.nibrs_master_file; see self.decode_segments()
+        '''
+        return self.decode_segments(list(self.col_specs["segment_level_codes"].keys()))
+    
+    def iter_segment_batches(self, segment_names: list, batch_size: int = 500_000):
+        '''
+        segment_names: the segments to decode, each of which must be defined in self.col_specs
+        batch_size: the maximum number of rows per batch
+        
+        yields (segment_name, pyarrow table) pairs as the lines are read, in file order within each segment
+        '''
+        if self.segment_index is not None:
+            for segment_name in segment_names:
+                lines = self.segment_index.iter_lines(self._get_code_for_segment(segment_name))
+                first_row = 0
+                
+                while batch := list(islice(lines, batch_size)):
+                    yield segment_name, self._read_segment(segment_name, batch, first_row)
+                    first_row += len(batch)
             
-            out_table = pd.read_fwf(segment_as_text, colspecs = col_specs, names = col_names)
-
-        return out_table
+            return
+        
+        code_to_segment = {self._get_code_for_segment(segment_name).encode(): segment_name 
+                           for segment_name in segment_names}
+        pending_lines = {segment_name: [] for segment_name in code_to_segment.values()}
+        first_rows = {segment_name: 0 for segment_name in code_to_segment.values()}
+        
+        with self._open_master_file() as file:
+            for line in file:
+                segment_name = code_to_segment.get(line[0:2])
+                
+                if segment_name is not None:
+                    batch = pending_lines[segment_name]
+                    batch.append(line)
+                    
+                    if len(batch) == batch_size:
+                        yield segment_name, self._read_segment(segment_name, batch, first_rows[segment_name])
+                        pending_lines[segment_name] = []
+                        first_rows[segment_name] += batch_size
+        
+        for segment_name, batch in pending_lines.items():
+            if batch:
+                yield segment_name, self._read_segment(segment_name, batch, first_rows[segment_name])
@@ -1,12 +1,47 @@
 import polars as pl
 import pandas as pd
+import pyarrow as pa
+from pathlib import Path
+
+# polars 1.25 deprecated collect(streaming = True) for collect(engine = "streaming"), which older versions reject
+STREAMING = {"engine": "streaming"} if tuple(map(int, pl.__version__.split(".")[:2])) >= (1, 25) else {"streaming": True}
 
 class Diagnostics:
-    def __init__(self, table: pl.DataFrame):
-        if not isinstance(table, pd.DataFrame):
-            self.table = table
-        else:
+    ALL_COLUMNS = "(all columns)"
+    PROFILED_COLUMNS = "(profiled columns)"
+    
+    def __init__(self, table):
+        '''
+        table: a polars DataFrame or LazyFrame, a pyarrow table, or the path to a parquet file or dataset directory,
+        which is only read when a method needs it
+        '''
+        if isinstance(table, pd.DataFrame):
             raise TypeError("Invalid table: it must be a Polars dataframe.")
+        elif isinstance(table, (pl.DataFrame, pa.Table)):
+            self._table = table if isinstance(table, pl.DataFrame) else pl.from_arrow(table)
+            self.lazy_table = self._table.lazy()
+        elif isinstance(table, pl.LazyFrame):
+            self._table = None
+            self.lazy_table = table
+        elif isinstance(table, (str, Path)):
+            self._table = None
+            
+            if Path(table).is_dir():
+                # as PartitionedDatasetWriter writes them; inferred, state_code=01 would be read as the integer 1
+                self.lazy_table = pl.scan_parquet(Path(table).joinpath("**", "*.parquet"), hive_partitioning = True,
+                                                  hive_schema = {"data_year": pl.Int16, "state_code": pl.String})
+            else:
+                self.lazy_table = pl.scan_parquet(table)
+        else:
+            raise TypeError("Invalid table: it must be a Polars dataframe or lazyframe, a pyarrow table, or the path "
+                            "to parquet file(s).")
+    
+    @property
+    def table(self) -> pl.DataFrame:
+        if self._table is None:
+            self._table = self.lazy_table.collect(**STREAMING)
+        
+        return self._table
     
     def return_duplicate_rows(self) -> pl.DataFrame:
         out_table = self.table.filter(self.table.is_duplicated())
@@ -15,7 +50,7 @@ class Diagnostics:
             return out_table
         else:
             raise Exception("No duplicate rows found.")
-        
+    
     def pct_unique_in_col(self, col_name: str) -> float:
         return round(self.table.n_unique(subset = col_name) / self.table.shape[0], 2)
     
@@ -25,7 +60,7 @@ class Diagnostics:
         
         Note that the polars table is cast to pandas because there is not an elegant way
         to rename the table after computing null counts and tranposing the result. Without casting
-        it to pandas, the missingness table retains the original columns as column names despite 
+        it to pandas, the missingness table retains the original columns as column names despite
         not appearing as such.
         '''
         pct_missing = ((self.table.null_count() / self.table.height)
@@ -35,4 +70,71 @@ class Diagnostics:
         out_table = pct_missing.to_pandas()
         out_table.columns = ["column", "pct_missing"]
         
-        return out_table
\ No newline at end of file
+        return out_table
+    
+    @staticmethod
+    def _profile_column(i: int, col_name: str, dtype: pl.DataType, top_k: int) -> list:
+        '''
+        returns the aggregations of self.profile() for one column, aliased with the column's position
+        so that they cannot collide with the aggregations of another column
+        '''
+        col = pl.col(col_name)
+        value_counts = col.drop_nulls().value_counts(sort = True, name = "count").head(top_k)
+        
+        # the min/max of a categorical follow its physical codes rather than its values, and polars' string
+        # min/max can be wrong (e.g., '1' for '01'), so text columns are compared as bytes
+        ordered = col.cast(pl.String).cast(pl.Binary) if dtype == pl.String or dtype == pl.Categorical else col
+        
+        return [
+            col.null_count().alias(f"{i}:n_missing"),
+            col.n_unique().alias(f"{i}:n_distinct"),
+            ordered.min().cast(pl.String).alias(f"{i}:min"),
+            ordered.max().cast(pl.String).alias(f"{i}:max"),
+            value_counts.struct.field(col_name).cast(pl.String).implode().alias(f"{i}:top_values"),
+            value_counts.struct.field("count").implode().alias(f"{i}:top_counts")
+            ]
+    
+    def profile(self, columns: list = None, top_k: int = 5) -> pl.DataFrame:
+        '''
+        columns: if specified, only these columns are profiled
+        top_k: the number of most frequent values to report per column
+        
+        returns a polars table with one row of statistics per column, after a row for the columns taken together:
+        Diagnostics.ALL_COLUMNS (whole rows), or Diagnostics.PROFILED_COLUMNS if columns leaves some out
+        
+        The table is read in one pass, but the distinct counts and top values hold each column's distinct values
+        in memory.
+        '''
+        schema = self.lazy_table.collect_schema()
+        columns = columns or schema.names()
+        label = Diagnostics.ALL_COLUMNS if set(columns) == set(schema.names()) else Diagnostics.PROFILED_COLUMNS
+        
+        aggregations = [pl.len().alias("n_rows"), pl.struct(columns).n_unique().alias("n_distinct_rows")]
+        for i, col_name in enumerate(columns):
+            aggregations += Diagnostics._profile_column(i, col_name, schema[col_name], top_k)
+        
+        stats = self.lazy_table.select(aggregations).collect(**STREAMING).row(0, named = True)
+        n_rows = stats["n_rows"]
+        
+        out_rows = [{"column": label, "dtype": None, "pct_missing": None,
+                     "n_distinct": stats["n_distinct_rows"], "n_duplicates": n_rows - stats["n_distinct_rows"],
+                     "min": None, "max": None, "top_values": None, "top_counts": None}]
+        
+        for i, col_name in enumerate(columns):
+            out_rows.append({
+                "column": col_name,
+                "dtype": str(schema[col_name]),
+                "pct_missing": stats[f"{i}:n_missing"] / n_rows if n_rows > 0 else None,
+                "n_distinct": stats[f"{i}:n_distinct"],
+                "n_duplicates": n_rows - stats[f"{i}:n_distinct"],
+                "min": stats[f"{i}:min"],
+                "max": stats[f"{i}:max"],
+                "top_values": stats[f"{i}:top_values"],
+                "top_counts": stats[f"{i}:top_counts"]
+                })
+        
+        return pl.DataFrame(out_rows, schema = {
+            "column": pl.String, "dtype": pl.String, "pct_missing": pl.Float64, "n_distinct": pl.UInt64,
+            "n_duplicates": pl.UInt64, "min": pl.String, "max": pl.String,
+            "top_values": pl.List(pl.String), "top_counts": pl.List(pl.UInt32)
+            })
\ No newline at end of file
@@ -0,0 +1,193 @@
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.fs as pafs
+import pyarrow.parquet as pq
+from io import RawIOBase
+from pathlib import Path
+
+def to_arrow_table(table) -> pa.Table:
+    '''
+    returns table, a pyarrow table or a polars dataframe, as a pyarrow table; a polars dataframe 
+    shares its buffers with Arrow, so no data is copied
+    '''
+    if isinstance(table, pa.Table):
+        return table
+    
+    import polars as pl # only needed for tables that are not already pyarrow tables
+    
+    if isinstance(table, pl.DataFrame):
+        return table.to_arrow()
+    else:
+        raise TypeError("Invalid table: it must be a pyarrow table or a polars dataframe.")
+
+class ByteChunkSink(RawIOBase):
+    def __init__(self):
+        '''
+        a write-only file object that keeps what is written to it until self.take() hands it over
+        '''
+        self.n_bytes = 0
+        self._buffer = bytearray()
+    
+    def writable(self) -> bool:
+        return True
+    
+    def tell(self) -> int:
+        return self.n_bytes
+    
+    def write(self, data) -> int:
+        self._buffer += data
+        self.n_bytes += len(data)
+        
+        return len(data)
+    
+    def take(self) -> bytes:
+        '''
+        returns what was written since the last call, and forgets it
+        '''
+        data = bytes(self._buffer)
+        self._buffer = bytearray()
+        
+        return data
+
+class ParquetBatchWriter:
+    def __init__(self, out_file: Path, compression: str = "snappy"):
+        '''
+        out_file: path to the parquet file to be written, or a writable file object (e.g., a ByteChunkSink)
+        
+        writes tables one row group at a time, cast to the schema of the first
+        '''
+        self.out_file = out_file
+        self.compression = compression
+        self.n_rows = 0
+        self._writer = None
+    
+    def write_batch(self, table: pa.Table) -> None:
+        batch = to_arrow_table(table)
+        
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self.out_file, batch.schema, compression = self.compression)
+        elif not batch.schema.equals(self._writer.schema):
+            try:
+                batch = batch.cast(self._writer.schema)
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                raise ValueError(f"Batch could not be cast to the schema of {self.out_file}, which was "
+                                 "set by the first batch. Try a larger batch size.")
+        
+        self._writer.write_table(batch)
+        self.n_rows += batch.num_rows
+    
+    def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+    
+    def __enter__(self) -> "ParquetBatchWriter":
+        return self
+    
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+class PartitionedDatasetWriter:
+    PARTITION_COLS = ("data_year", "state_code")
+    
+    def __init__(self, dataset_dir: str, segment_name: str, data_year: int, filesystem: pafs.FileSystem = None,
+                 sort_by: tuple = ("ori", "incident_date"), max_rows_per_group: int = 128 * 1024,
+                 rows_per_file: int = 1024 * 1024, max_buffered_rows: int = 4 * 1024 * 1024):
+        '''
+        dataset_dir: the root of the dataset, e.g., output/dataset, or bucket/dataset if filesystem is s3
+        filesystem: a pyarrow file system; defaults to the local file system
+        sort_by: the columns that rows are sorted by within each file
+        max_rows_per_group: the number of rows per row group
+        rows_per_file: the number of rows a state's batches are buffered up to before they are written as one file
+        max_buffered_rows: if the states' buffers hold more rows than this, the largest is written early
+        
+        writes tables to {dataset_dir}/{segment_name}/data_year={data_year}/state_code={state_code}/, in files
+        of about rows_per_file rows (the rest of each state on close), after emptying the data_year partition
+        '''
+        self.filesystem = filesystem or pafs.LocalFileSystem()
+        self.segment_dir = f"{dataset_dir}/{segment_name}"
+        self.data_year = int(data_year)
+        self.sort_by = sort_by
+        self.max_rows_per_group = max_rows_per_group
+        self.rows_per_file = rows_per_file
+        self.max_buffered_rows = max_buffered_rows
+        self.n_rows = 0
+        self.n_files = 0
+        
+        # state_code: the slices of the batches that are not written yet, and their number of rows
+        self._buffers = {}
+        self._buffered_rows = {}
+        
+        import pyarrow.dataset as ds # pyarrow.dataset is slow to import, so only this writer imports it
+        
+        self._partitioning = ds.partitioning(pa.schema([("data_year", pa.int16()), ("state_code", pa.string())]), 
+                                             flavor = "hive")
+        
+        year_dir = self.year_dir
+        if self.filesystem.get_file_info(year_dir).type != pafs.FileType.NotFound:
+            self.filesystem.delete_dir(year_dir)
+    
+    @property
+    def year_dir(self) -> str:
+        return f"{self.segment_dir}/data_year={self.data_year}"
+    
+    def write_batch(self, table: pa.Table) -> None:
+        batch = to_arrow_table(table)
+        
+        state_code = batch.column("state_code")
+        if pa.types.is_dictionary(state_code.type):
+            state_code = state_code.cast(pa.string())
+        
+        batch = (batch.set_column(batch.schema.get_field_index("state_code"), "state_code", state_code)
+                 .append_column("data_year", pa.repeat(pa.scalar(self.data_year, pa.int16()), batch.num_rows)))
+        
+        # each state's rows are contiguous once sorted, so the batch is split into one slice per state
+        batch = batch.sort_by([("state_code", "ascending")])
+        state_codes = batch.column("state_code").combine_chunks()
+        run_ends = pc.run_end_encode(state_codes).run_ends.to_numpy()
+        
+        first_row = 0
+        for run_end in run_ends:
+            state_batch = batch.slice(first_row, run_end - first_row)
+            state_code = state_codes[first_row].as_py()
+            self._buffers.setdefault(state_code, []).append(state_batch)
+            self._buffered_rows[state_code] = self._buffered_rows.get(state_code, 0) + state_batch.num_rows
+            first_row = run_end
+            
+            if self._buffered_rows[state_code] >= self.rows_per_file:
+                self._write_state(state_code)
+        
+        while sum(self._buffered_rows.values()) > self.max_buffered_rows:
+            self._write_state(max(self._buffered_rows, key = self._buffered_rows.get))
+        
+        self.n_rows += batch.num_rows
+    
+    def _write_state(self, state_code: str) -> None:
+        '''
+        writes the buffered rows of state_code as one file, sorted by self.sort_by
+        '''
+        state_table = pa.concat_tables(self._buffers.pop(state_code)).unify_dictionaries().combine_chunks()
+        del self._buffered_rows[state_code]
+        
+        sort_keys = [(col_name, "ascending") for col_name in self.sort_by if col_name in state_table.column_names]
+        if sort_keys:
+            state_table = state_table.sort_by(sort_keys)
+        
+        import pyarrow.dataset as ds
+        
+        ds.write_dataset(state_table, self.segment_dir, format = "parquet", partitioning = self._partitioning,
+                         filesystem = self.filesystem, basename_template = f"part-{self.n_files}-{{i}}.parquet",
+                         existing_data_behavior = "overwrite_or_ignore", preserve_order = True,
+                         min_rows_per_group = min(self.max_rows_per_group, 16 * 1024), 
+                         max_rows_per_group = self.max_rows_per_group)
+        
+        self.n_files += 1
+    
+    def close(self) -> None:
+        for state_code in list(self._buffers):
+            self._write_state(state_code)
+    
+    def __enter__(self) -> "PartitionedDatasetWriter":
+        return self
+    
+    def __exit__(self, *exc_info) -> None:
+        self.close()
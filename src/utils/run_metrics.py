@@ -0,0 +1,302 @@
+import cProfile
+import json
+import os
+import sys
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+from time import perf_counter, thread_time, time
+
+def _current_rss_bytes() -> int:
+    '''
+    returns this process's resident set size, or None where /proc is not available
+    '''
+    try:
+        with open("/proc/self/statm", "r") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+class StageRecord:
+    COUNTERS = ("rows", "bytes_in", "bytes_out")
+    
+    def __init__(self, name: str, labels: dict):
+        '''
+        the measurements of one run of a stage: wall and CPU seconds, rows, bytes in and out, peak
+        RSS, and any other counters that the stage adds with self.add()
+        '''
+        self.name = name
+        self.labels = labels
+        self.started_at = time()
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.peak_rss_bytes = None
+        self.counters = {counter: 0 for counter in StageRecord.COUNTERS}
+    
+    def add(self, **counters) -> None:
+        '''
+        adds to the stage's counters, e.g., stage.add(rows = len(table), bytes_out = n_bytes)
+        '''
+        for counter, value in counters.items():
+            self.counters[counter] = self.counters.get(counter, 0) + value
+    
+    def _observe_rss(self, rss_bytes: int) -> None:
+        if rss_bytes is not None and (self.peak_rss_bytes is None or rss_bytes > self.peak_rss_bytes):
+            self.peak_rss_bytes = rss_bytes
+    
+    def to_dict(self) -> dict:
+        return {
+            "stage": self.name,
+            "labels": self.labels,
+            "started_at": round(self.started_at, 3),
+            "wall_seconds": round(self.wall_seconds, 6),
+            "cpu_seconds": round(self.cpu_seconds, 6),
+            "peak_rss_bytes": self.peak_rss_bytes,
+            **self.counters
+            }
+
+class _StackSampler(threading.Thread):
+    def __init__(self, thread_id: int, interval: float):
+        '''
+        a sampling profiler that records the call stack of the thread with thread_id every interval seconds
+        '''
+        super().__init__(daemon = True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop_event = threading.Event()
+    
+    def run(self) -> None:
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})")
+                frame = frame.f_back
+            
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+    
+    def stop(self) -> None:
+        self._stop_event.set()
+        self.join()
+
+class RunMetrics:
+    def __init__(self, run_name: str, labels: dict = None, enabled: bool = True, rss_interval: float = 0.05):
+        '''
+        run_name: the name of the run, e.g., decode_segments
+        labels: labels of the whole run, e.g., {"data_year": "2022"}, which are added to every metric
+        enabled: if False, stages are neither measured nor recorded
+        rss_interval: how often, in seconds, the RSS is sampled while a stage runs
+        
+        collects per-stage measurements of a run (see self.stage()), written as json or a Prometheus textfile
+        '''
+        self.run_name = run_name
+        self.labels = labels or {}
+        self.enabled = enabled
+        self.rss_interval = rss_interval
+        self.started_at = time()
+        self.records = []
+        self.profiles = {}
+        
+        self._lock = threading.Lock()
+        self._open_records = set()
+        self._rss_stop_event = None
+    
+    def _sample_rss(self, stop_event: threading.Event) -> None:
+        while not stop_event.wait(self.rss_interval):
+            rss_bytes = _current_rss_bytes()
+            
+            with self._lock:
+                for record in self._open_records:
+                    record._observe_rss(rss_bytes)
+    
+    def _open(self, record: StageRecord) -> None:
+        with self._lock:
+            self._open_records.add(record)
+            
+            if self._rss_stop_event is None:
+                self._rss_stop_event = threading.Event()
+                threading.Thread(target = self._sample_rss, args = (self._rss_stop_event,), daemon = True).start()
+    
+    def _close(self, record: StageRecord) -> None:
+        with self._lock:
+            self._open_records.discard(record)
+            self.records.append(record)
+            
+            if not self._open_records and self._rss_stop_event is not None:
+                self._rss_stop_event.set()
+                self._rss_stop_event = None
+    
+    @contextmanager
+    def stage(self, name: str, **labels):
+        '''
+        name: the stage, e.g., parse
+        labels: what the stage ran on, e.g., segment = "offense_segment"
+        
+        measures the body of a with block as one run of the stage, and yields its StageRecord,
+        to which the body adds rows and bytes:
+            
+            with metrics.stage("parse", segment = segment_name) as stage:
+                ...
+                stage.add(rows = len(out_table))
+        '''
+        record = StageRecord(name, {key: str(value) for key, value in labels.items()})
+        
+        if not self.enabled:
+            yield record
+            return
+        
+        self._open(record)
+        record._observe_rss(_current_rss_bytes())
+        wall_start, cpu_start = perf_counter(), thread_time()
+        
+        try:
+            yield record
+        except BaseException as error:
+            record.labels["error"] = type(error).__name__
+            raise
+        finally:
+            record.wall_seconds = perf_counter() - wall_start
+            record.cpu_seconds = thread_time() - cpu_start
+            record._observe_rss(_current_rss_bytes())
+            self._close(record)
+    
+    @contextmanager
+    def profile(self, name: str, mode: str = None, out_dir: str = ".", interval: float = 0.005):
+        '''
+        mode: None (no profiling), 'cprofile', or 'sampling'
+        
+        profiles the body of a with block into out_dir/{name}.prof ('cprofile') or out_dir/{name}.folded ('sampling')
+        '''
+        if mode is None:
+            yield
+            return
+        
+        if mode not in ("cprofile", "sampling"):
+            raise ValueError(f"Invalid profiler '{mode}': only cprofile, sampling are allowed.")
+        
+        Path(out_dir).mkdir(parents = True, exist_ok = True)
+        
+        if mode == "cprofile":
+            profiler = cProfile.Profile()
+            out_file = Path(out_dir).joinpath(f"{name}.prof")
+            
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+                profiler.dump_stats(out_file)
+        else:
+            sampler = _StackSampler(threading.get_ident(), interval)
+            out_file = Path(out_dir).joinpath(f"{name}.folded")
+            
+            sampler.start()
+            try:
+                yield
+            finally:
+                sampler.stop()
+                
+                with open(out_file, "w") as file:
+                    for stack, n_samples in sampler.stacks.most_common():
+                        file.write(f"{stack} {n_samples}\n")
+        
+        self.profiles[name] = str(out_file)
+    
+    def summarize(self) -> list:
+        '''
+        returns the records aggregated by stage and labels: summed seconds and counters, the highest
+        peak RSS, and the number of runs
+        '''
+        summary = {}
+        
+        with self._lock:
+            records = list(self.records)
+        
+        for record in records:
+            key = (record.name, tuple(sorted(record.labels.items())))
+            totals = summary.setdefault(key, {"stage": record.name, "labels": record.labels, "runs": 0,
+                                              "wall_seconds": 0.0, "cpu_seconds": 0.0, "peak_rss_bytes": None})
+            totals["runs"] += 1
+            totals["wall_seconds"] += record.wall_seconds
+            totals["cpu_seconds"] += record.cpu_seconds
+            
+            for counter, value in record.counters.items():
+                totals[counter] = totals.get(counter, 0) + value
+            
+            if record.peak_rss_bytes is not None:
+                totals["peak_rss_bytes"] = max(totals["peak_rss_bytes"] or 0, record.peak_rss_bytes)
+        
+        return list(summary.values())
+    
+    def to_dict(self) -> dict:
+        with self._lock:
+            records = [record.to_dict() for record in self.records]
+        
+        return {
+            "run_name": self.run_name,
+            "labels": self.labels,
+            "started_at": round(self.started_at, 3),
+            "wall_seconds": round(time() - self.started_at, 3),
+            "summary": self.summarize(),
+            "stages": records,
+            "profiles": self.profiles
+            }
+    
+    @staticmethod
+    def _write_atomically(out_file: str, contents: str) -> None:
+        '''
+        writes to a temporary file first, so that readers (e.g., node_exporter's textfile collector)
+        never see a partial file
+        '''
+        out_file = Path(out_file)
+        out_file.parent.mkdir(parents = True, exist_ok = True)
+        temp_file = out_file.with_name(f".{out_file.name}.tmp")
+        
+        with open(temp_file, "w") as file:
+            file.write(contents)
+        
+        os.replace(temp_file, out_file)
+    
+    def write_json(self, out_file: str) -> None:
+        RunMetrics._write_atomically(out_file, json.dumps(self.to_dict(), indent = 2))
+    
+    @staticmethod
+    def _format_labels(labels: dict) -> str:
+        escaped = {key: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+                   for key, value in labels.items()}
+        
+        return "{" + ",".join(f'{key}="{value}"' for key, value in escaped.items()) + "}"
+    
+    def write_prometheus(self, out_file: str, prefix: str = "nibrs") -> None:
+        '''
+        writes the summary as Prometheus gauges to out_file, a .prom file in node_exporter's textfile collector directory
+        '''
+        run_labels = {"run": self.run_name, **self.labels}
+        lines = [f"# TYPE {prefix}_run_wall_seconds gauge",
+                 f"{prefix}_run_wall_seconds{self._format_labels(run_labels)} {round(time() - self.started_at, 3)}",
+                 f"# TYPE {prefix}_run_completed_timestamp_seconds gauge",
+                 f"{prefix}_run_completed_timestamp_seconds{self._format_labels(run_labels)} {round(time(), 3)}"]
+        
+        summary = self.summarize()
+        metric_names = ["runs", "wall_seconds", "cpu_seconds", "peak_rss_bytes"]
+        metric_names += sorted({key for totals in summary for key in totals} - set(metric_names) - {"stage", "labels"})
+        
+        for metric_name in metric_names:
+            lines.append(f"# TYPE {prefix}_stage_{metric_name} gauge")
+            
+            for totals in summary:
+                if totals.get(metric_name) is None:
+                    continue
+                
+                labels = {**run_labels, "stage": totals["stage"], **totals["labels"]}
+                lines.append(f"{prefix}_stage_{metric_name}{self._format_labels(labels)} {totals[metric_name]}")
+        
+        RunMetrics._write_atomically(out_file, "\n".join(lines) + "\n")
+
+# the default of the instrumented classes, which records nothing
+DISABLED_METRICS = RunMetrics("disabled", enabled = False)
\ No newline at end of file
@@ -0,0 +1,233 @@
+import hashlib
+import json
+from io import BytesIO
+import mmap
+import os
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+
+def file_digest(file: str, chunk_size: int = 64 * 1024 * 1024) -> str:
+    '''
+    returns the blake2b hex digest of file's contents
+    '''
+    hasher = hashlib.blake2b(digest_size = 32)
+    
+    with open(file, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            hasher.update(chunk)
+    
+    return hasher.hexdigest()
+
+def _encode_segment_code(segment_code: str) -> int:
+    first, second = segment_code.encode()
+    
+    return (first << 8) | second
+
+class SegmentIndex:
+    SIDECAR_SUFFIX = ".segidx.npz"
+    
+    def __init__(self, nibrs_master_file: str, codes: np.ndarray, offsets: np.ndarray, lengths: np.ndarray, fingerprint: dict):
+        '''
+        codes, offsets, lengths: the packed segment level and byte range of every run of same-segment lines
+        fingerprint: the size, mtime, and blake2b digest of nibrs_master_file when it was indexed
+        '''
+        self.nibrs_master_file = nibrs_master_file
+        self.codes = codes
+        self.offsets = offsets
+        self.lengths = lengths
+        self.fingerprint = fingerprint
+        self._file = None
+        self._mapped_file = None
+    
+    @classmethod
+    def sidecar_path(cls, nibrs_master_file: str) -> Path:
+        return Path(f"{nibrs_master_file}{cls.SIDECAR_SUFFIX}")
+    
+    @staticmethod
+    def _stat(nibrs_master_file: str) -> dict:
+        stat = os.stat(nibrs_master_file)
+        
+        return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    
+    @classmethod
+    def build(cls, nibrs_master_file: str, chunk_size: int = 64 * 1024 * 1024) -> "SegmentIndex":
+        '''
+        indexes and hashes nibrs_master_file in one pass; writes the index to its sidecar file and returns it
+        '''
+        hasher = hashlib.blake2b(digest_size = 32)
+        codes, offsets, lengths = [], [], []
+        buffer_offset = 0
+        carry = b""
+        
+        with open(nibrs_master_file, "rb") as file:
+            for chunk in iter(lambda: file.read(chunk_size), b""):
+                hasher.update(chunk)
+                buffer = carry + chunk
+                line_ends = np.flatnonzero(np.frombuffer(buffer, dtype = np.uint8) == ord("\n")) + 1
+                
+                if len(line_ends) > 0:
+                    runs = cls._find_runs(buffer, line_ends)
+                    codes.append(runs[0])
+                    offsets.append(runs[1] + buffer_offset)
+                    lengths.append(runs[2])
+                    
+                    buffer_offset += int(line_ends[-1])
+                    carry = buffer[line_ends[-1]:]
+                else:
+                    carry = buffer
+        
+        if carry:
+            runs = cls._find_runs(carry, np.array([len(carry)]))
+            codes.append(runs[0])
+            offsets.append(runs[1] + buffer_offset)
+            lengths.append(runs[2])
+        
+        fingerprint = {**cls._stat(nibrs_master_file), "blake2b": hasher.hexdigest()}
+        
+        if codes:
+            codes, offsets, lengths = cls._merge_adjacent_runs(
+                np.concatenate(codes), np.concatenate(offsets), np.concatenate(lengths)
+                )
+        else:
+            codes, offsets, lengths = (np.empty(0, dtype = np.uint16), np.empty(0, dtype = np.int64),
+                                       np.empty(0, dtype = np.int64))
+        
+        segment_index = cls(nibrs_master_file, codes, offsets, lengths, fingerprint)
+        segment_index.save()
+        
+        return segment_index
+    
+    @staticmethod
+    def _find_runs(buffer: bytes, line_ends: np.ndarray) -> tuple:
+        '''
+        line_ends: the position right after every line ending in buffer
+        
+        returns (codes, offsets, lengths) of the runs of same-segment lines in buffer
+        '''
+        as_array = np.frombuffer(buffer, dtype = np.uint8)
+        line_starts = np.concatenate(([0], line_ends[:-1]))
+        second_chars = np.minimum(line_starts + 1, len(as_array) - 1)
+        line_codes = (as_array[line_starts].astype(np.uint16) << 8) | as_array[second_chars]
+        
+        run_starts = np.concatenate(([0], np.flatnonzero(line_codes[1:] != line_codes[:-1]) + 1))
+        run_ends = np.concatenate((run_starts[1:], [len(line_codes)])) - 1
+        
+        return (line_codes[run_starts],
+                line_starts[run_starts].astype(np.int64),
+                (line_ends[run_ends] - line_starts[run_starts]).astype(np.int64))
+    
+    @staticmethod
+    def _merge_adjacent_runs(codes: np.ndarray, offsets: np.ndarray, lengths: np.ndarray) -> tuple:
+        '''
+        merges runs that were split across chunk boundaries (i.e., same segment code and contiguous)
+        '''
+        continues_previous = (codes[1:] == codes[:-1]) & (offsets[1:] == offsets[:-1] + lengths[:-1])
+        run_starts = np.concatenate(([0], np.flatnonzero(~continues_previous) + 1))
+        merged_lengths = np.add.reduceat(lengths, run_starts)
+        
+        return codes[run_starts], offsets[run_starts], merged_lengths
+    
+    def save(self) -> None:
+        np.savez(self.sidecar_path(self.nibrs_master_file),
+                 codes = self.codes,
+                 offsets = self.offsets,
+                 lengths = self.lengths,
+                 fingerprint = np.array(json.dumps(self.fingerprint)))
+    
+    def is_current(self) -> bool:
+        '''
+        whether self still describes self.nibrs_master_file, re-hashing it only if just its mtime changed
+        '''
+        stat = self._stat(self.nibrs_master_file)
+        
+        if stat["size"] != self.fingerprint["size"]:
+            return False
+        
+        if stat["mtime_ns"] != self.fingerprint["mtime_ns"]:
+            if file_digest(self.nibrs_master_file) != self.fingerprint["blake2b"]:
+                return False
+            
+            self.fingerprint["mtime_ns"] = stat["mtime_ns"]
+            self.save()
+        
+        return True
+    
+    @classmethod
+    def load(cls, nibrs_master_file: str) -> "SegmentIndex":
+        '''
+        reads the sidecar index of nibrs_master_file and raises a ValueError if it is stale
+        '''
+        sidecar = cls.sidecar_path(nibrs_master_file)
+        
+        try:
+            with np.load(sidecar) as arrays:
+                segment_index = cls(nibrs_master_file,
+                                    codes = arrays["codes"],
+                                    offsets = arrays["offsets"],
+                                    lengths = arrays["lengths"],
+                                    fingerprint = json.loads(str(arrays["fingerprint"])))
+        except FileNotFoundError:
+            raise FileNotFoundError(f"No segment index found for {nibrs_master_file}: expected {sidecar}.")
+        
+        if not segment_index.is_current():
+            raise ValueError(f"{sidecar} is stale: {nibrs_master_file} has changed since it was indexed.")
+        
+        return segment_index
+    
+    @classmethod
+    def load_or_build(cls, nibrs_master_file: str) -> "SegmentIndex":
+        try:
+            return cls.load(nibrs_master_file)
+        except (FileNotFoundError, ValueError):
+            return cls.build(nibrs_master_file)
+    
+    def n_bytes_for_segment(self, segment_code: str) -> int:
+        return int(self.lengths[self.codes == _encode_segment_code(segment_code)].sum())
+    
+    def open(self) -> "SegmentIndex":
+        '''
+        keeps nibrs_master_file open and memory-mapped until self.close(), instead of mapping it per segment read
+        '''
+        if self._mapped_file is None:
+            self._file = open(self.nibrs_master_file, "rb")
+            self._mapped_file = mmap.mmap(self._file.fileno(), 0, access = mmap.ACCESS_READ)
+        
+        return self
+    
+    def close(self) -> None:
+        if self._mapped_file is not None:
+            self._mapped_file.close()
+            self._file.close()
+            self._file, self._mapped_file = None, None
+    
+    @contextmanager
+    def _map_file(self):
+        if self._mapped_file is not None:
+            yield self._mapped_file
+            return
+        
+        with open(self.nibrs_master_file, "rb") as file:
+            with mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ) as mapped_file:
+                yield mapped_file
+    
+    def iter_lines(self, segment_code: str):
+        '''
+        yields every line of nibrs_master_file that starts with segment_code, in file order, by 
+        reading only the indexed byte ranges of that segment, one run at a time, through a memory map
+        '''
+        in_segment = self.codes == _encode_segment_code(segment_code)
+        
+        if not in_segment.any():
+            return
+        
+        with self._map_file() as mapped_file:
+            for offset, length in zip(self.offsets[in_segment].tolist(), self.lengths[in_segment].tolist()):
+                yield from BytesIO(mapped_file[offset:offset + length])
+    
+    def read_lines(self, segment_code: str) -> list:
+        '''
+        returns every line of nibrs_master_file that starts with segment_code; see self.iter_lines()
+        '''
+        return list(self.iter_lines(segment_code))
@@ -0,0 +1,185 @@
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from .decode_engines import INTEGER_DTYPES, _to_byte_matrix
+from .nibrs_codes import NIBRSCodeMapper
+
+# what each check flags
+CHECKS = {
+    "record_length": "the record is shorter than the segment's col_specs, so its last fields are cut off or blank",
+    "unparseable": "an integer or date field is not blank, but is not a number (or a calendar date) that fits its dtype",
+    "unknown_code": "a code column's value is not in its code lists in nibrs_codes"
+}
+
+VIOLATIONS_SCHEMA = pa.schema([
+    ("segment", pa.string()),
+    ("column", pa.string()),
+    ("check", pa.string()),
+    ("expected", pa.string()),
+    ("count", pa.int64()),
+    ("sample_rows", pa.list_(pa.int64())),
+    ("sample_values", pa.list_(pa.string()))
+])
+
+class SegmentValidator:
+    def __init__(self, col_specs: dict, code_mapper: NIBRSCodeMapper = None, n_samples: int = 5):
+        '''
+        col_specs: the contents of col_specs.yaml, as handed to NIBRSDecoder
+        code_mapper: if specified, code columns are checked against its code lists; see NIBRSCodeMapper
+        n_samples: the number of row numbers (and values) kept per violation, as examples
+        
+        checks decoded segments batch by batch, in the same pass as decoding (see CHECKS)
+        '''
+        self.col_specs = col_specs
+        self.code_mapper = code_mapper
+        self.n_samples = n_samples
+        self.n_rows = {}
+        self._violations = {}
+    
+    def _get_fields(self, segment_name: str) -> list:
+        return [(col_name, col_spec[0], col_spec[1], col_spec[2] if len(col_spec) > 2 else None)
+                for col_name, col_spec in self.col_specs[segment_name].items()]
+    
+    def _record(self, segment_name: str, col_name: str, check: str, expected: str, is_violation: np.ndarray,
+                first_row: int, get_values) -> None:
+        '''
+        is_violation: a boolean mask of a batch's rows
+        get_values: a function that returns the values of the rows at the positions it is given, as strings
+        '''
+        n_violations = int(is_violation.sum())
+        
+        if n_violations == 0:
+            return
+        
+        violation = self._violations.setdefault((segment_name, col_name, check),
+                                                {"expected": expected, "count": 0, "sample_rows": [], "sample_values": []})
+        violation["count"] += n_violations
+        
+        n_samples = self.n_samples - len(violation["sample_rows"])
+        
+        if n_samples > 0:
+            positions = np.flatnonzero(is_violation)[:n_samples]
+            violation["sample_rows"].extend((positions + first_row).tolist())
+            violation["sample_values"].extend(get_values(positions))
+    
+    def check_records(self, segment_name: str, lines: list, columns, first_row: int = 0) -> None:
+        '''
+        lines: a batch of a segment's raw lines
+        columns: the batch's decoded integer and date columns, by column name (e.g., its decoded table)
+        first_row: the row number of the batch's first line within its segment
+        
+        checks that every record is as long as the segment's col_specs, and that every integer and date
+        field that is not blank was decoded into a value
+        '''
+        fields = self._get_fields(segment_name)
+        self.n_rows[segment_name] = self.n_rows.get(segment_name, 0) + len(lines)
+        
+        if not lines:
+            return
+        
+        record_length = max(end for _, _, end, _ in fields)
+        records = [line.rstrip(b"\r\n") for line in lines]
+        lengths = np.fromiter(map(len, records), dtype = np.int64, count = len(records))
+        
+        self._record(segment_name, "*", "record_length", f">= {record_length} bytes", lengths < record_length, first_row,
+                     lambda positions: [str(lengths[i]) for i in positions])
+        
+        missing_rows = {field: np.flatnonzero(columns[field[0]].is_null().to_numpy(zero_copy_only = False))
+                        for field in fields if (field[3] in INTEGER_DTYPES or field[3] == "date") and columns[field[0]].null_count > 0}
+        
+        if not missing_rows:
+            return
+        
+        # only the records with a missing integer or date are laid out as a byte matrix
+        rows = np.unique(np.concatenate(list(missing_rows.values())))
+        byte_matrix = _to_byte_matrix([records[i] for i in rows], max(end for _, _, end, _ in missing_rows))
+        
+        for (col_name, start, end, dtype), missing in missing_rows.items():
+            is_violation = np.zeros(len(records), dtype = bool)
+            is_violation[missing] = (byte_matrix[np.searchsorted(rows, missing), start:end] != ord(" ")).any(axis = 1)
+            
+            self._record(segment_name, col_name, "unparseable", dtype, is_violation, first_row, 
+                         lambda positions: [records[i][start:end].decode("latin-1") for i in positions])
+    
+    def check_table(self, segment_name: str, table: pa.Table, first_row: int = 0) -> None:
+        '''
+        table: a batch of a segment, as decoded by NIBRSDecoder (before NIBRSCodeMapper.encode())
+        first_row: the row number of the batch's first row within its segment
+        
+        checks that the values of the code columns are in their code lists
+        '''
+        code_columns = self.code_mapper.get_code_columns_for_segment(segment_name) if self.code_mapper is not None else {}
+        
+        for col_name, code_list_names in code_columns.items():
+            if col_name not in table.column_names:
+                continue
+            
+            codes, _ = self.code_mapper.get_dictionary(code_list_names)
+            
+            row = first_row
+            for chunk in table.column(col_name).chunks:
+                # a category column is checked once per distinct value, which is then spread to its rows
+                values = chunk.dictionary.cast(pa.string()) if pa.types.is_dictionary(chunk.type) else chunk.cast(pa.string())
+                is_violation = pc.and_(values.is_valid(), pc.invert(pc.is_in(values, value_set = codes)))
+                
+                if pc.any(is_violation).as_py():
+                    if pa.types.is_dictionary(chunk.type):
+                        is_violation = is_violation.take(chunk.indices)
+                    
+                    self._record(segment_name, col_name, "unknown_code", ", ".join(code_list_names),
+                                 is_violation.fill_null(False).to_numpy(zero_copy_only = False), row,
+                                 lambda positions: [str(chunk[int(i)]) for i in positions])
+                
+                row += len(chunk)
+    
+    def validate(self, segment_name: str, lines: list, table: pa.Table, first_row: int = 0) -> None:
+        '''
+        runs every check on a batch of a segment: its raw lines and the table they were decoded into
+        '''
+        self.check_records(segment_name, lines, table, first_row)
+        self.check_table(segment_name, table, first_row)
+    
+    def merge(self, other: "SegmentValidator", first_rows: dict) -> None:
+        '''
+        other: a SegmentValidator that checked other batches (e.g., in a worker process), whose row
+        numbers start at 0 in every segment
+        first_rows: the row number, within each segment, of the first row that other checked
+        
+        adds the violations of other to self's
+        '''
+        for segment_name, n_rows in other.n_rows.items():
+            self.n_rows[segment_name] = self.n_rows.get(segment_name, 0) + n_rows
+        
+        for key, other_violation in other._violations.items():
+            violation = self._violations.setdefault(key, {"expected": other_violation["expected"], "count": 0,
+                                                          "sample_rows": [], "sample_values": []})
+            violation["count"] += other_violation["count"]
+            
+            n_samples = self.n_samples - len(violation["sample_rows"])
+            first_row = first_rows.get(key[0], 0)
+            
+            violation["sample_rows"].extend(row + first_row for row in other_violation["sample_rows"][:n_samples])
+            violation["sample_values"].extend(other_violation["sample_values"][:n_samples])
+    
+    def violations(self) -> pa.Table:
+        '''
+        returns one row per segment, column ('*' for whole records), and check that found violations,
+        with their count and the row numbers and values of the first self.n_samples of them
+        '''
+        rows = [{"segment": segment_name, "column": col_name, "check": check, **violation}
+                for (segment_name, col_name, check), violation in sorted(self._violations.items())]
+        
+        return pa.Table.from_pylist(rows, schema = VIOLATIONS_SCHEMA)
+    
+    def summarize(self) -> dict:
+        '''
+        returns the number of violations per check, and the number of rows checked per segment
+        '''
+        summary = {check: 0 for check in CHECKS}
+        for (_, _, check), violation in self._violations.items():
+            summary[check] += violation["count"]
+        
+        summary["rows"] = dict(self.n_rows)
+        
+        return summary
@@ -0,0 +1,290 @@
+import re
+import zipfile
+from pathlib import Path
+
+import numpy as np
+
+from .incident_index import TOTAL_COUNT_COLS
+from .nibrs_codes import NIBRSCodeMapper
+
+# the columns that every segment shares, which are drawn once per incident
+INCIDENT_COLS = ("state_code", "ori", "incident_number", "incident_date")
+
+_SPACE = ord(" ")
+_ALPHANUMERIC = np.frombuffer(b"ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789", dtype = np.uint8)
+
+def _to_digits(values: np.ndarray, width: int, pad: str = "0") -> np.ndarray:
+    '''
+    returns a (len(values), width) byte matrix of values as right-justified ASCII digits, padded with pad
+    '''
+    powers = 10 ** np.arange(width - 1, -1, -1, dtype = np.int64)
+    digits = (values[:, None] // powers) % 10 + ord("0")
+    
+    if pad != "0":
+        is_leading_zero = (values[:, None] < powers) & (powers > 1)
+        digits = np.where(is_leading_zero, ord(pad), digits)
+    
+    return digits.astype(np.uint8)
+
+def _to_byte_matrix(strings: list, width: int) -> np.ndarray:
+    '''
+    returns a (len(strings), width) byte matrix of strings, left-justified and padded with spaces
+    '''
+    return np.frombuffer(b"".join(string.encode()[:width].ljust(width) for string in strings),
+                         dtype = np.uint8).reshape(len(strings), width)
+
+class SyntheticMasterFile:
+    # average rows per incident of the segments in col_specs; segments with an average of at least 1
+    # have at least one row per incident, as the offense and victim segments do in the real data
+    DEFAULT_SEGMENT_MIX = {"offense_segment": 1.3, "victim_segment": 1.25, "arrestee_segment": 0.3}
+    
+    # segment_level_code: (average rows per incident, line width) of the segments that are not decoded
+    # (property, offender, and group B arrest report), whose lines decoding has to skip as it does in
+    # the real data; their contents are filler
+    DEFAULT_OTHER_SEGMENTS = {"03": (0.9, 307), "05": (1.3, 45), "07": (0.02, 66)}
+    
+    def __init__(self, col_specs: dict, nibrs_codes: dict = None, data_year: int = 2022, segment_mix: dict = None,
+                 other_segments: dict = None, blank_rate: float = 0.2, n_agencies: int = 5000, seed: int = 0):
+        '''
+        col_specs: a dictionary like configuration/col_specs.yaml
+        nibrs_codes: if specified, a dictionary like configuration/nibrs_codes.yaml whose code lists the code columns are drawn from
+        segment_mix: average rows per incident of each segment in col_specs (see DEFAULT_SEGMENT_MIX)
+        other_segments: see DEFAULT_OTHER_SEGMENTS
+        blank_rate: the share of blank (missing) values in columns that are not keys or counts
+        
+        generates fixed-width master files that look like the FBI's releases
+        '''
+        if "segment_level_codes" not in col_specs.keys():
+            raise KeyError("Invalid col_specs. It must have a segment_level_codes key.")
+        
+        self.col_specs = col_specs
+        self.code_mapper = NIBRSCodeMapper(nibrs_codes) if nibrs_codes is not None else None
+        self.data_year = data_year
+        self.segment_mix = segment_mix or SyntheticMasterFile.DEFAULT_SEGMENT_MIX
+        self.other_segments = other_segments if other_segments is not None else SyntheticMasterFile.DEFAULT_OTHER_SEGMENTS
+        self.blank_rate = blank_rate
+        self.rng = np.random.default_rng(seed)
+        self.n_incidents = 0
+        
+        unknown_segments = [name for name in self.segment_mix if name not in col_specs["segment_level_codes"]]
+        if unknown_segments:
+            raise KeyError(f"Segments in segment_mix but not in col_specs: {', '.join(unknown_segments)}.")
+        
+        # every agency keeps its state code and ORI across incidents
+        n_agencies = max(n_agencies, 1)
+        state_codes = self.rng.integers(1, 51, n_agencies)
+        self._agency_state_codes = _to_digits(state_codes, 2)
+        self._agency_oris = np.concatenate([
+            self.rng.choice(_ALPHANUMERIC[:26], (n_agencies, 2)),
+            _to_digits(self.rng.integers(0, 10 ** 5, n_agencies), 5),
+            _to_digits(self.rng.integers(0, 100, n_agencies), 2)
+            ], axis = 1).astype(np.uint8)
+        self._agency_weights = self._zipf_weights(n_agencies)
+        
+        # the vocabulary of every category column that is not a code column, drawn once so that it is
+        # the same in every chunk
+        self._vocabularies = {}
+    
+    @staticmethod
+    def _zipf_weights(n: int, exponent: float = 1.1) -> np.ndarray:
+        weights = 1 / np.arange(1, n + 1) ** exponent
+        
+        return weights / weights.sum()
+    
+    def _segment_width(self, segment_name: str) -> int:
+        return max(col_spec[1] for col_spec in self.col_specs[segment_name].values())
+    
+    def _blank_rate_for(self, col_name: str) -> float:
+        match = re.search(r"(\d+)$", col_name)
+        
+        if match is None or int(match.group(1)) <= 1:
+            return self.blank_rate
+        
+        return 1 - (1 - self.blank_rate) * 0.3 ** (int(match.group(1)) - 1)
+    
+    def _get_vocabulary(self, segment_name: str, col_name: str, width: int) -> tuple:
+        '''
+        returns (vocabulary, weights): the byte matrix of a column's possible values and their frequencies
+        '''
+        key = (segment_name, col_name)
+        
+        if key not in self._vocabularies:
+            code_columns = self.code_mapper.get_code_columns_for_segment(segment_name) if self.code_mapper else {}
+            
+            if col_name in code_columns:
+                codes, _ = self.code_mapper.get_dictionary(code_columns[col_name])
+                codes = codes.to_pylist()
+            else:
+                # numeric codes, as most of the FBI's are (e.g., location_type)
+                codes = [str(code).zfill(width) for code in range(1, min(10 ** width, 40))]
+            
+            order = self.rng.permutation(len(codes))
+            self._vocabularies[key] = (_to_byte_matrix([codes[i] for i in order], width), self._zipf_weights(len(codes)))
+        
+        return self._vocabularies[key]
+    
+    def _draw_dates(self, n: int) -> np.ndarray:
+        days = np.datetime64(f"{self.data_year}-01-01") + self.rng.integers(0, 365, n).astype("timedelta64[D]")
+        as_bytes = np.datetime_as_string(days).astype("S10").view(np.uint8).reshape(n, 10)
+        
+        return as_bytes[:, [0, 1, 2, 3, 5, 6, 8, 9]]
+    
+    def _draw_identifiers(self, n: int, width: int) -> np.ndarray:
+        '''
+        returns a (n, width) byte matrix of identifiers shaped like ORIs and incident numbers: two letters, then digits
+        '''
+        n_letters = min(width, 2)
+        
+        return np.concatenate([
+            self.rng.choice(_ALPHANUMERIC[:26], (n, n_letters)),
+            _to_digits(self.rng.integers(0, 10 ** min(width - n_letters, 18), n), width - n_letters)
+            ], axis = 1).astype(np.uint8)
+    
+    def _draw_column(self, segment_name: str, col_name: str, dtype: str, width: int, n: int) -> np.ndarray:
+        '''
+        returns a (n, width) byte matrix of random values for a column that is not a key, count, or
+        sequence number
+        '''
+        if dtype.startswith("int"):
+            values = _to_digits(self.rng.integers(0, min(10 ** width, 100), n), width, pad = " ")
+        elif dtype == "date":
+            values = self._draw_dates(n)
+        elif dtype == "category":
+            vocabulary, weights = self._get_vocabulary(segment_name, col_name, width)
+            values = vocabulary[self.rng.choice(len(vocabulary), n, p = weights)]
+        else:
+            # the string columns are identifiers, e.g., arrest_transaction_number
+            values = self._draw_identifiers(n, width)
+        
+        is_blank = self.rng.random(n) < self._blank_rate_for(col_name)
+        values[is_blank] = _SPACE
+        
+        return values
+    
+    def _draw_counts(self, mean: float, n: int) -> np.ndarray:
+        if mean >= 1:
+            return 1 + self.rng.poisson(mean - 1, n)
+        
+        return self.rng.poisson(mean, n)
+    
+    def _build_segment(self, segment_name: str, incident_cols: dict, rows_of_incident: np.ndarray,
+                       rank_in_incident: np.ndarray, totals: dict) -> np.ndarray:
+        '''
+        returns the segment's lines as a byte matrix, one row per line, without line endings
+        '''
+        n = len(rows_of_incident)
+        lines = np.full((n, self._segment_width(segment_name)), _SPACE, dtype = np.uint8)
+        
+        for col_name, col_spec in self.col_specs[segment_name].items():
+            start, end = col_spec[0], col_spec[1]
+            dtype = col_spec[2] if len(col_spec) > 2 else "string"
+            
+            if col_name == "segment_level":
+                values = np.frombuffer(self.col_specs["segment_level_codes"][segment_name].encode(), dtype = np.uint8)
+            elif col_name in INCIDENT_COLS:
+                values = incident_cols[col_name][rows_of_incident]
+            elif segment_name == "administrative_segment" and col_name in totals:
+                values = _to_digits(np.minimum(totals[col_name], 10 ** (end - start) - 1), end - start)
+            elif col_name.endswith("sequence_number"):
+                values = _to_digits(rank_in_incident + 1, end - start)
+            else:
+                values = self._draw_column(segment_name, col_name, dtype, end - start, n)
+            
+            lines[:, start:end] = values
+        
+        return lines
+    
+    def _build_filler_segment(self, segment_level_code: str, width: int, incident_cols: dict,
+                              rows_of_incident: np.ndarray) -> np.ndarray:
+        n = len(rows_of_incident)
+        lines = self.rng.choice(_ALPHANUMERIC[26:], (n, width))
+        lines[:, 0:2] = np.frombuffer(segment_level_code.encode(), dtype = np.uint8)
+        lines[:, 2:4] = incident_cols["state_code"][rows_of_incident]
+        lines[:, 4:13] = incident_cols["ori"][rows_of_incident]
+        lines[:, 13:25] = incident_cols["incident_number"][rows_of_incident]
+        
+        return lines
+    
+    def generate_chunk(self, n_incidents: int) -> bytes:
+        '''
+        returns the lines of the next n_incidents incidents
+        '''
+        agencies = self.rng.choice(len(self._agency_oris), n_incidents, p = self._agency_weights)
+        incident_cols = {
+            "state_code": self._agency_state_codes[agencies],
+            "ori": self._agency_oris[agencies],
+            "incident_number": np.concatenate([
+                self.rng.choice(_ALPHANUMERIC[:26], (n_incidents, 2)),
+                _to_digits(np.arange(self.n_incidents, self.n_incidents + n_incidents), 10)
+                ], axis = 1).astype(np.uint8),
+            "incident_date": self._draw_dates(n_incidents)
+            }
+        self.n_incidents += n_incidents
+        
+        segment_codes = self.col_specs["segment_level_codes"]
+        counts = {"administrative_segment": np.ones(n_incidents, dtype = np.int64)}
+        counts.update({name: self._draw_counts(mean, n_incidents) for name, mean in self.segment_mix.items()})
+        counts.update({code: self._draw_counts(mean, n_incidents) for code, (mean, _) in self.other_segments.items()})
+        
+        # the offender segment (05) is not in col_specs, but the administrative segment counts it
+        totals = {col: counts.get(name, counts.get("05") if name == "offender_segment" else None)
+                  for name, col in TOTAL_COUNT_COLS.items()}
+        totals = {col: total for col, total in totals.items() if total is not None}
+        
+        blocks = []
+        for name, segment_counts in counts.items():
+            rows_of_incident = np.repeat(np.arange(n_incidents), segment_counts)
+            rank_in_incident = np.arange(len(rows_of_incident)) - np.repeat(np.cumsum(segment_counts) - segment_counts,
+                                                                            segment_counts)
+            
+            if name in segment_codes:
+                code = segment_codes[name]
+                lines = self._build_segment(name, incident_cols, rows_of_incident, rank_in_incident, totals)
+            else:
+                code = name
+                lines = self._build_filler_segment(code, self.other_segments[code][1], incident_cols, rows_of_incident)
+            
+            lines = np.concatenate([lines, np.full((len(lines), 1), ord("\n"), dtype = np.uint8)], axis = 1)
+            blocks.append((code, rows_of_incident, rank_in_incident, lines))
+        
+        # every incident's lines in the order of their segment codes, then of their rank within the segment
+        block_codes = np.concatenate([np.full(len(rows), int(code, 36)) for code, rows, _, _ in blocks])
+        rows_of_incident = np.concatenate([rows for _, rows, _, _ in blocks])
+        ranks = np.concatenate([ranks for _, _, ranks, _ in blocks])
+        line_widths = np.concatenate([np.full(len(lines), lines.shape[1]) for _, _, _, lines in blocks])
+        
+        order = np.lexsort((ranks, block_codes, rows_of_incident))
+        line_offsets = np.empty(len(order), dtype = np.int64)
+        line_offsets[order] = np.concatenate(([0], np.cumsum(line_widths[order])[:-1]))
+        
+        out_buffer = np.empty(int(line_widths.sum()), dtype = np.uint8)
+        first_line = 0
+        for _, _, _, lines in blocks:
+            offsets = line_offsets[first_line:first_line + len(lines)]
+            out_buffer[offsets[:, None] + np.arange(lines.shape[1])] = lines
+            first_line += len(lines)
+        
+        return out_buffer.tobytes()
+    
+    def write(self, out_file: str, n_incidents: int, chunk_size: int = 20_000) -> Path:
+        '''
+        out_file: a .txt file, or a .zip file with {data_year}_NIBRS_NATIONAL_MASTER_FILE_ENC.txt inside it
+        
+        writes n_incidents incidents to out_file, chunk_size incidents at a time, and returns its path
+        '''
+        out_file = Path(out_file)
+        out_file.parent.mkdir(parents = True, exist_ok = True)
+        
+        def write_chunks(file) -> None:
+            for first_incident in range(0, n_incidents, chunk_size):
+                file.write(self.generate_chunk(min(chunk_size, n_incidents - first_incident)))
+        
+        if out_file.suffix == ".zip":
+            with zipfile.ZipFile(out_file, "w", compression = zipfile.ZIP_DEFLATED) as zipped_file:
+                with zipped_file.open(f"{self.data_year}_NIBRS_NATIONAL_MASTER_FILE_ENC.txt", "w", force_zip64 = True) as file:
+                    write_chunks(file)
+        else:
+            with open(out_file, "wb") as file:
+                write_chunks(file)
+        
+        return out_file
\ No newline at end of file
@@ -0,0 +1,141 @@
+import logging
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+class Task:
+    def __init__(self, name: str, fn, args: tuple = (), deps: tuple = (), cpus: int = 1, memory_gb: float = 1.0):
+        '''
+        name: a unique name, e.g., decode_2022
+        fn: a module-level function (so that it can be sent to a worker process), called as fn(*args)
+        deps: the names of the tasks that must succeed before this one starts
+        cpus, memory_gb: how much of TaskScheduler's budgets the task holds while it runs
+        '''
+        self.name = name
+        self.fn = fn
+        self.args = args
+        self.deps = tuple(deps)
+        self.cpus = cpus
+        self.memory_gb = memory_gb
+        self.attempts = 0
+
+class TaskScheduler:
+    def __init__(self, max_cpus: int, max_memory_gb: float, max_retries: int = 1, logger: logging.Logger = None):
+        '''
+        max_cpus, max_memory_gb: the budgets shared by the running tasks (a task larger than a budget runs alone)
+        max_retries: how many more times a task that raised, or whose worker died, is run before it is marked as failed
+        
+        runs a graph of Tasks, each in a fresh worker process, as soon as its dependencies succeeded and the budgets allow
+        '''
+        self.max_cpus = max_cpus
+        self.max_memory_gb = max_memory_gb
+        self.max_retries = max_retries
+        self.logger = logger or logging.getLogger(__name__)
+    
+    def _fits(self, task: Task, cpus_in_use: int, memory_gb_in_use: float, n_running: int) -> bool:
+        if n_running == 0:
+            return True
+        
+        return (cpus_in_use + task.cpus <= self.max_cpus) and (memory_gb_in_use + task.memory_gb <= self.max_memory_gb)
+    
+    @staticmethod
+    def _find_cycle(tasks_by_name: dict) -> list:
+        '''
+        returns the names of the tasks that are in or behind a dependency cycle, in order, or an empty list
+        '''
+        n_deps_left = {task_name: len(task.deps) for task_name, task in tasks_by_name.items()}
+        dependents = {task_name: [] for task_name in tasks_by_name}
+        for task_name, task in tasks_by_name.items():
+            for dep in task.deps:
+                dependents[dep].append(task_name)
+        
+        ready = [task_name for task_name, n_deps in n_deps_left.items() if n_deps == 0]
+        while ready:
+            for dependent in dependents[ready.pop()]:
+                n_deps_left[dependent] -= 1
+                if n_deps_left[dependent] == 0:
+                    ready.append(dependent)
+        
+        return [task_name for task_name, n_deps in n_deps_left.items() if n_deps > 0]
+    
+    def run(self, tasks: list) -> tuple:
+        '''
+        returns (statuses, results): dictionaries of task_name:status pairs, where status is 'succeeded',
+        'failed', or 'skipped' (a dependency did not succeed), and of task_name:result pairs, where result
+        is what the task returned or, if it failed, its last error
+        '''
+        tasks_by_name = {task.name: task for task in tasks}
+        
+        for task in tasks:
+            unknown_deps = [dep for dep in task.deps if dep not in tasks_by_name]
+            if unknown_deps:
+                raise KeyError(f"Task {task.name} depends on unknown tasks: {', '.join(unknown_deps)}.")
+        
+        cyclic = TaskScheduler._find_cycle(tasks_by_name)
+        if cyclic:
+            raise ValueError(f"The dependencies of these tasks form a cycle: {', '.join(cyclic)}.")
+        
+        statuses = {task.name: "pending" for task in tasks}
+        results = {}
+        running = {}
+        cpus_in_use, memory_gb_in_use = 0, 0.0
+        
+        # every task gets a pool of its own, so that a worker that dies (e.g., killed for running out of memory)
+        # only breaks its own task's pool, and counts as that task's failed attempt
+        executors = {}
+        
+        try:
+            while True:
+                for task in tasks:
+                    if statuses[task.name] != "pending":
+                        continue
+                    
+                    dep_statuses = [statuses[dep] for dep in task.deps]
+                    
+                    if any(status in ("failed", "skipped") for status in dep_statuses):
+                        statuses[task.name] = "skipped"
+                        self.logger.warning(f"Skipping {task.name}: a dependency did not succeed.")
+                    elif all(status == "succeeded" for status in dep_statuses) and \
+                            self._fits(task, cpus_in_use, memory_gb_in_use, len(running)):
+                        task.attempts += 1
+                        statuses[task.name] = "running"
+                        executor = ProcessPoolExecutor(max_workers = 1, mp_context = multiprocessing.get_context("spawn"))
+                        future = executor.submit(task.fn, *task.args)
+                        running[future] = task
+                        executors[future] = executor
+                        cpus_in_use += task.cpus
+                        memory_gb_in_use += task.memory_gb
+                        self.logger.info(f"Started {task.name} (attempt {task.attempts}).")
+                
+                if not running:
+                    break # whatever is still pending depends on a task that was just skipped
+                
+                done, _ = wait(running, return_when = FIRST_COMPLETED)
+                
+                for future in done:
+                    task = running.pop(future)
+                    executors.pop(future).shutdown()
+                    cpus_in_use -= task.cpus
+                    memory_gb_in_use -= task.memory_gb
+                    
+                    try:
+                        results[task.name] = future.result()
+                        statuses[task.name] = "succeeded"
+                        self.logger.info(f"Finished {task.name}.")
+                    except Exception as error:
+                        results[task.name] = repr(error)
+                        
+                        if task.attempts <= self.max_retries:
+                            statuses[task.name] = "pending"
+                            self.logger.warning(f"{task.name} failed ({error!r}); retrying.")
+                        else:
+                            statuses[task.name] = "failed"
+                            self.logger.error(f"{task.name} failed after {task.attempts} attempts: {error!r}")
+        finally:
+            for executor in executors.values():
+                executor.shutdown(cancel_futures = True)
+        
+        for task_name, status in statuses.items():
+            if status == "pending":
+                statuses[task_name] = "skipped"
+        
+        return statuses, results
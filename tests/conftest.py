@@ -0,0 +1,43 @@
+import sys
+import zipfile
+from pathlib import Path
+
+import pytest
+
+REPO_DIR = Path(__file__).resolve().parents[1]
+
+# the scripts in src import utils and db_design as top-level packages
+sys.path.insert(0, str(REPO_DIR.joinpath("src")))
+
+from utils import general_utils, SyntheticMasterFile
+
+N_INCIDENTS = 3000
+
+@pytest.fixture(scope = "session")
+def config() -> dict:
+    return general_utils.load_yaml(REPO_DIR.joinpath("configuration", "col_specs.yaml"))
+
+@pytest.fixture(scope = "session")
+def nibrs_codes() -> dict:
+    return general_utils.load_yaml(REPO_DIR.joinpath("configuration", "nibrs_codes.yaml"))
+
+@pytest.fixture(scope = "session")
+def master_file(tmp_path_factory, config: dict, nibrs_codes: dict) -> Path:
+    '''
+    a synthetic master file of 2022 with N_INCIDENTS incidents, written once per test session
+    '''
+    out_file = tmp_path_factory.mktemp("raw_data").joinpath("2022_NIBRS_NATIONAL_MASTER_FILE_ENC.txt")
+    
+    return SyntheticMasterFile(config, nibrs_codes, seed = 0).write(out_file, N_INCIDENTS)
+
+@pytest.fixture(scope = "session")
+def zipped_master_file(master_file: Path) -> Path:
+    '''
+    master_file zipped as the FBI releases it, e.g., nibrs-2022.zip
+    '''
+    out_file = master_file.with_name("nibrs-2022.zip")
+    
+    with zipfile.ZipFile(out_file, "w", compression = zipfile.ZIP_DEFLATED) as zipped_file:
+        zipped_file.write(master_file, master_file.name)
+    
+    return out_file
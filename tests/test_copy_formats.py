@@ -0,0 +1,136 @@
+import re
+from datetime import date, timedelta
+
+import pyarrow as pa
+import pytest
+
+pytest.importorskip("psycopg2") # db_design imports its Postgres class, which needs the database drivers
+pytest.importorskip("sqlalchemy")
+
+from db_design.copy_formats import _concat_values, encode_text, encode_binary, BINARY_HEADER, BINARY_TRAILER, CopyStream
+from utils import NIBRSDecoder, NIBRSCodeMapper
+
+PG_EPOCH = date(2000, 1, 1)
+
+_TEXT_ESCAPES = {"\\\\": "\\", "\\t": "\t", "\\n": "\n", "\\r": "\r"}
+
+def parse_text(payload: bytes) -> list:
+    '''
+    parses COPY's text format as postgres does, into rows of strings (None for \\N)
+    '''
+    assert payload.endswith(b"\n")
+    
+    return [[None if field == "\\N" else re.sub(r"\\[\\tnr]", lambda match: _TEXT_ESCAPES[match.group()], field)
+             for field in line.split("\t")]
+            for line in payload.decode().split("\n")[:-1]]
+
+def parse_binary(payload: bytes, pg_types: list) -> list:
+    '''
+    parses rows in COPY's binary format (without its header and trailer) as postgres does, into Python values
+    '''
+    rows = []
+    position = 0
+    while position < len(payload):
+        n_fields = int.from_bytes(payload[position:position + 2], "big", signed = True)
+        assert n_fields == len(pg_types)
+        position += 2
+        
+        row = []
+        for pg_type in pg_types:
+            length = int.from_bytes(payload[position:position + 4], "big", signed = True)
+            position += 4
+            
+            if length == -1:
+                row.append(None)
+                continue
+            
+            field = payload[position:position + length]
+            position += length
+            
+            if pg_type == "text":
+                row.append(field.decode())
+            elif pg_type == "date":
+                row.append(PG_EPOCH + timedelta(days = int.from_bytes(field, "big", signed = True)))
+            else:
+                assert length == {"smallint": 2, "integer": 4, "bigint": 8}[pg_type]
+                row.append(int.from_bytes(field, "big", signed = True))
+        
+        rows.append(row)
+    
+    return rows
+
+def get_pg_types(schema: pa.Schema) -> list:
+    '''
+    returns the postgres type of every field of schema, as raw_tables.py declares them
+    '''
+    def get_pg_type(pa_type: pa.DataType) -> str:
+        if pa.types.is_dictionary(pa_type) or pa.types.is_string(pa_type):
+            return "text"
+        if pa.types.is_date(pa_type):
+            return "date"
+        
+        return {8: "smallint", 16: "smallint", 32: "integer", 64: "bigint"}[pa_type.bit_width]
+    
+    return [get_pg_type(field.type) for field in schema]
+
+@pytest.fixture(scope = "module")
+def batches(master_file, config: dict, nibrs_codes: dict) -> list:
+    '''
+    record batches of every decoded segment, encoded and with db_id as they are loaded, plus a batch of
+    values that need escaping
+    '''
+    code_mapper = NIBRSCodeMapper(nibrs_codes)
+    segment_names = list(config["segment_level_codes"])
+    
+    out_batches = []
+    for segment_name, table in NIBRSDecoder(str(master_file), config, engine = "numpy").decode_segments(segment_names).items():
+        table = NIBRSDecoder.add_db_id(code_mapper.encode(table, segment_name), "2022")
+        out_batches += table.to_batches(max_chunksize = 1000)
+    
+    out_batches.append(pa.record_batch({
+        "text": pa.array(["tab\there", "new\nline", "back\\slash", "carriage\rreturn", "\\N", "", None]),
+        "number": pa.array([-(2 ** 31), 2 ** 31 - 1, None, 0, 1, -1, 2], type = pa.int64())
+        }))
+    
+    return out_batches
+
+def test_text_round_trip(batches: list):
+    for batch in batches:
+        expected = [[None if value is None else str(value) for value in row.values()] for row in batch.to_pylist()]
+        
+        assert parse_text(encode_text(batch)) == expected
+
+def test_binary_round_trip(batches: list):
+    for batch in batches:
+        assert parse_binary(encode_binary(batch, get_pg_types(batch.schema)), get_pg_types(batch.schema)) == \
+            [list(row.values()) for row in batch.to_pylist()]
+
+def test_binary_stream_has_header_and_trailer(batches: list):
+    batch = batches[0]
+    payload = CopyStream([BINARY_HEADER, encode_binary(batch, get_pg_types(batch.schema)), BINARY_TRAILER]).read()
+    
+    assert payload.startswith(b"PGCOPY\n\xff\r\n\x00")
+    assert payload.endswith(b"\xff\xff")
+    assert parse_binary(payload[len(BINARY_HEADER):-len(BINARY_TRAILER)], get_pg_types(batch.schema)) == \
+        [list(row.values()) for row in batch.to_pylist()]
+
+def test_binary_rejects_values_that_do_not_fit():
+    with pytest.raises(ValueError):
+        encode_binary(pa.record_batch({"number": pa.array([2 ** 15], type = pa.int32())}), ["smallint"])
+
+def test_concat_values_reads_int32_offsets_of_a_slice():
+    array = pa.array(["skipped", None, "ab", None, "", "cde", "after"]).slice(2, 4)
+    
+    assert array.type == pa.string() # int32 offsets
+    assert _concat_values(array) == b"abcde"
+    assert _concat_values(pa.array(["x"]).slice(1)) == b""
+
+def test_sliced_batches_encode_like_copies(batches: list):
+    batch = batches[0]
+    
+    for offset, length in [(0, 1), (1, 5), (len(batch) - 3, 3)]:
+        sliced = batch.slice(offset, length)
+        copied = pa.RecordBatch.from_pylist(sliced.to_pylist(), schema = sliced.schema)
+        
+        assert encode_text(sliced) == encode_text(copied)
+        assert encode_binary(sliced, get_pg_types(batch.schema)) == encode_binary(copied, get_pg_types(batch.schema))
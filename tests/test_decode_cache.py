@@ -0,0 +1,112 @@
+import os
+from pathlib import Path
+
+import pytest
+
+import decode_segments
+from utils import DecodeCache
+
+CONFIG_DIR = Path(__file__).resolve().parents[1].joinpath("configuration")
+
+# an mtime that no decode run would give its output
+OLD_MTIME_NS = 10 ** 18
+
+def decode_offense_segment(master_file, output_dir, *extra_args) -> Path:
+    '''
+    decodes the offense segment of master_file into output_dir, unless it is up to date, and returns the output's path
+    '''
+    decode_segments.main(decode_segments.parse_args([
+        f"--output_dir={output_dir}",
+        f"--nibrs_master_file={master_file}",
+        f"--config_file={CONFIG_DIR.joinpath('col_specs.yaml')}",
+        f"--nibrs_codes_file={CONFIG_DIR.joinpath('nibrs_codes.yaml')}",
+        "--segment_name=offense_segment",
+        "--engine=numpy",
+        *extra_args
+        ]))
+    
+    return Path(output_dir).joinpath("offense_segment_2022.parquet")
+
+def is_written_again(out_file: Path, rerun) -> bool:
+    '''
+    returns whether rerun() writes out_file again
+    '''
+    os.utime(out_file, ns = (OLD_MTIME_NS, OLD_MTIME_NS))
+    rerun()
+    
+    return out_file.stat().st_mtime_ns != OLD_MTIME_NS
+
+def test_make_key_depends_on_every_input():
+    key = DecodeCache.make_key(master_file = "abc", col_specs = {"ori": [4, 13, "string"]}, encode_errors = "raise")
+    
+    assert key == DecodeCache.make_key(encode_errors = "raise", col_specs = {"ori": [4, 13, "string"]}, master_file = "abc")
+    assert key != DecodeCache.make_key(master_file = "abc", col_specs = {"ori": [4, 13, "string"]}, encode_errors = "coerce")
+    assert key != DecodeCache.make_key(master_file = "abc", col_specs = {"ori": [4, 14, "string"]}, encode_errors = "raise")
+
+def test_entry_is_up_to_date_only_with_its_key_and_location(tmp_path):
+    decode_cache = DecodeCache(tmp_path)
+    location = "s3://bucket/offense_segment_2022.parquet"
+    decode_cache.record("offense_segment_2022.parquet", "key", location)
+    
+    # the manifest is saved as entries are recorded
+    decode_cache = DecodeCache(tmp_path)
+    
+    assert decode_cache.is_up_to_date("offense_segment_2022.parquet", "key", location, lambda location: True)
+    assert not decode_cache.is_up_to_date("offense_segment_2022.parquet", "other key", location, lambda location: True)
+    assert not decode_cache.is_up_to_date("offense_segment_2022.parquet", "key", location, lambda location: False)
+    assert not decode_cache.is_up_to_date("offense_segment_2022.parquet", "key", str(tmp_path.joinpath("offense_segment_2022.parquet")),
+                                          lambda location: True)
+    assert not decode_cache.is_up_to_date("victim_segment_2022.parquet", "key", location, lambda location: True)
+
+def test_evict_keeps_the_most_recently_used_entries(tmp_path):
+    decode_cache = DecodeCache(tmp_path, max_entries = 2)
+    
+    for out_name in ["a", "b", "c"]:
+        decode_cache.record(out_name, "key", out_name)
+    decode_cache.is_up_to_date("a", "key", "a", lambda location: True)
+    
+    assert decode_cache.evict() == ["b"]
+    assert sorted(decode_cache.manifest["entries"]) == ["a", "c"]
+
+def test_decode_is_skipped_on_a_hit(master_file, tmp_path):
+    out_file = decode_offense_segment(master_file, tmp_path)
+    
+    assert not is_written_again(out_file, lambda: decode_offense_segment(master_file, tmp_path))
+
+def test_decode_runs_again_on_a_miss(master_file, tmp_path):
+    out_file = decode_offense_segment(master_file, tmp_path)
+    
+    # --validate encodes unknown codes as missing values, so it must not reuse a strict run's output, nor vice versa
+    assert is_written_again(out_file, lambda: decode_offense_segment(master_file, tmp_path, "--validate"))
+    assert is_written_again(out_file, lambda: decode_offense_segment(master_file, tmp_path))
+    assert is_written_again(out_file, lambda: decode_offense_segment(master_file, tmp_path, "--no_cache"))
+    
+    out_file.unlink()
+    decode_offense_segment(master_file, tmp_path)
+    
+    assert out_file.exists()
+
+def test_local_output_is_not_reused_for_s3(master_file, tmp_path, config: dict, monkeypatch):
+    pytest.importorskip("s3fs")
+    moto = pytest.importorskip("moto")
+    import boto3
+    
+    out_file = decode_offense_segment(master_file, tmp_path)
+    
+    for name in ("region_name", "aws_access_key_id", "aws_secret_access_key"):
+        monkeypatch.setenv(name, "us-east-1" if name == "region_name" else "testing")
+    
+    with moto.mock_aws():
+        s3_client = boto3.client("s3", region_name = "us-east-1")
+        s3_client.create_bucket(Bucket = config["s3_bucket"])
+        
+        decode_offense_segment(master_file, tmp_path, "--to_aws_s3")
+        s3_object = s3_client.head_object(Bucket = config["s3_bucket"], Key = out_file.name)
+        
+        assert s3_object["ContentLength"] > 0
+        
+        # the next s3 run reuses the s3 output, so it leaves the object as it is
+        s3_client.put_object(Bucket = config["s3_bucket"], Key = out_file.name, Body = b"uploaded")
+        decode_offense_segment(master_file, tmp_path, "--to_aws_s3")
+        
+        assert s3_client.get_object(Bucket = config["s3_bucket"], Key = out_file.name)["Body"].read() == b"uploaded"
@@ -0,0 +1,122 @@
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import pytest
+
+import decode_segments
+from utils import NIBRSDecoder
+
+CONFIG_DIR = Path(__file__).resolve().parents[1].joinpath("configuration")
+
+SEGMENT_NAMES = ["administrative_segment", "offense_segment", "arrestee_segment", "victim_segment"]
+
+def to_comparable(table: pa.Table) -> pa.Table:
+    '''
+    returns table with its dictionary columns decoded to strings and its chunks combined, since batches
+    (and parquet row groups) each have their own dictionaries
+    '''
+    columns = [column.cast(pa.string()) if pa.types.is_dictionary(column.type) else column for column in table.columns]
+    
+    return pa.table(columns, names = table.column_names).combine_chunks()
+
+def run_decode_segments(master_file, output_dir, *extra_args) -> None:
+    decode_segments.main(decode_segments.parse_args([
+        f"--output_dir={output_dir}",
+        f"--nibrs_master_file={master_file}",
+        f"--config_file={CONFIG_DIR.joinpath('col_specs.yaml')}",
+        f"--nibrs_codes_file={CONFIG_DIR.joinpath('nibrs_codes.yaml')}",
+        "--all_segments",
+        "--engine=numpy",
+        *extra_args
+        ]))
+
+@pytest.fixture(scope = "module")
+def reference(master_file, config: dict) -> dict:
+    '''
+    every segment decoded in a single pass by the numpy engine
+    '''
+    return NIBRSDecoder(str(master_file), config, engine = "numpy").decode_segments(SEGMENT_NAMES)
+
+@pytest.fixture(scope = "module")
+def reference_dir(master_file, tmp_path_factory):
+    '''
+    the output of decode_segments.py in a single pass, which the other modes are compared to
+    '''
+    output_dir = tmp_path_factory.mktemp("single_pass")
+    run_decode_segments(master_file, output_dir)
+    
+    return output_dir
+
+def test_segments_are_decoded(reference: dict):
+    assert reference["administrative_segment"].num_rows == 3000
+    assert all(reference[segment_name].num_rows > 0 for segment_name in SEGMENT_NAMES)
+    assert reference["administrative_segment"].schema.field("incident_date").type == pa.date32()
+
+@pytest.mark.parametrize("decoder_args", [
+    {"engine": "pandas"},
+    {"engine": "numpy", "use_index": True},
+    {"engine": "numpy", "n_workers": 2}
+    ], ids = ["pandas", "indexed", "parallel"])
+def test_decoder_modes_match_single_pass(master_file, config: dict, reference: dict, decoder_args: dict):
+    out_tables = NIBRSDecoder(str(master_file), config, **decoder_args).decode_segments(SEGMENT_NAMES)
+    
+    for segment_name in SEGMENT_NAMES:
+        assert out_tables[segment_name].equals(reference[segment_name]), segment_name
+
+def test_zipped_master_file_matches_single_pass(zipped_master_file, config: dict, reference: dict):
+    out_tables = NIBRSDecoder(str(zipped_master_file), config, engine = "numpy").decode_segments(SEGMENT_NAMES)
+    
+    for segment_name in SEGMENT_NAMES:
+        assert out_tables[segment_name].equals(reference[segment_name]), segment_name
+
+def test_batches_match_single_pass(master_file, config: dict, reference: dict):
+    decoder = NIBRSDecoder(str(master_file), config, engine = "numpy")
+    
+    batches = {segment_name: [] for segment_name in SEGMENT_NAMES}
+    for segment_name, batch in decoder.iter_segment_batches(SEGMENT_NAMES, batch_size = 700):
+        assert batch.num_rows <= 700
+        batches[segment_name].append(batch)
+    
+    for segment_name in SEGMENT_NAMES:
+        assert len(batches[segment_name]) > 1
+        assert to_comparable(pa.concat_tables(batches[segment_name])).equals(to_comparable(reference[segment_name]))
+
+@pytest.mark.parametrize("extra_args", [
+    ["--batch_size=700"],
+    ["--batch_size=700", "--pipelined"]
+    ], ids = ["batch", "pipelined"])
+def test_streamed_outputs_match_single_pass(master_file, reference_dir, tmp_path, extra_args: list):
+    run_decode_segments(master_file, tmp_path, *extra_args)
+    
+    for segment_name in SEGMENT_NAMES:
+        expected = pq.read_table(reference_dir.joinpath(f"{segment_name}_2022.parquet"))
+        out_file = pq.ParquetFile(tmp_path.joinpath(f"{segment_name}_2022.parquet"))
+        
+        assert out_file.metadata.num_row_groups > 1
+        assert to_comparable(out_file.read()).equals(to_comparable(expected)), segment_name
+
+def test_partitioned_dataset_matches_single_pass(master_file, reference_dir, tmp_path):
+    run_decode_segments(master_file, tmp_path, "--batch_size=700", "--partitioned")
+    
+    # as PartitionedDatasetWriter writes them, rather than inferred from the directory names (e.g., 01 as 1)
+    partitioning = ds.partitioning(pa.schema([("data_year", pa.int16()), ("state_code", pa.string())]), flavor = "hive")
+    
+    for segment_name in SEGMENT_NAMES:
+        expected = to_comparable(pq.read_table(reference_dir.joinpath(f"{segment_name}_2022.parquet")))
+        dataset = pq.read_table(tmp_path.joinpath("dataset", segment_name), partitioning = partitioning)
+        
+        assert pc.all(pc.equal(dataset.column("data_year"), 2022)).as_py()
+        
+        # rows are sorted by ori and incident_date within each state, so they are compared in db_id order
+        out_table = to_comparable(dataset.select(expected.column_names))
+        out_table = out_table.take(pc.sort_indices(out_table, [("db_id", "ascending")]))
+        expected = expected.take(pc.sort_indices(expected, [("db_id", "ascending")]))
+        
+        assert out_table.equals(expected), segment_name
+        
+        # the batches of each state are buffered into one file rather than written as a file per batch
+        state_dirs = list(tmp_path.joinpath("dataset", segment_name, "data_year=2022").iterdir())
+        assert [len(list(state_dir.glob("*.parquet"))) for state_dir in state_dirs] == [1] * len(state_dirs)
@@ -0,0 +1,15 @@
+import pytest
+
+pl = pytest.importorskip("polars")
+
+from utils.nibrs_processor import Diagnostics
+
+def test_profile_labels_the_columns_it_covers():
+    table = pl.DataFrame({"ori": ["IL0010000", "IL0010000", "IL0010000"], "incident_number": ["1", "1", "2"],
+                          "offense": ["13A", "13B", "13A"]})
+    
+    whole_rows = Diagnostics(table).profile().row(0, named = True)
+    subset = Diagnostics(table).profile(columns = ["ori", "incident_number"]).row(0, named = True)
+    
+    assert (whole_rows["column"], whole_rows["n_distinct"], whole_rows["n_duplicates"]) == (Diagnostics.ALL_COLUMNS, 3, 0)
+    assert (subset["column"], subset["n_distinct"], subset["n_duplicates"]) == (Diagnostics.PROFILED_COLUMNS, 2, 1)
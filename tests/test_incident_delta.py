@@ -0,0 +1,88 @@
+import pytest
+
+pl = pytest.importorskip("polars")
+
+from utils import NIBRSDecoder, IncidentDelta
+
+@pytest.fixture(scope = "module")
+def offense_table(master_file, config: dict) -> pl.DataFrame:
+    table = NIBRSDecoder(str(master_file), config, engine = "numpy").decode_segments(["offense_segment"])["offense_segment"]
+    
+    return pl.from_arrow(NIBRSDecoder.add_db_id(table, "2022"))
+
+def get_hashes(table: pl.DataFrame) -> dict:
+    return {(row["ori"], row["incident_number"]): row["incident_hash"]
+            for row in IncidentDelta.hash_incidents(table).iter_rows(named = True)}
+
+def get_incident(table: pl.DataFrame, n_rows: int) -> tuple:
+    '''
+    returns the key of the first incident of table with at least n_rows rows
+    '''
+    counts = table.group_by("ori", "incident_number", maintain_order = True).len()
+    
+    return counts.filter(pl.col("len") >= n_rows).row(0)[:2]
+
+def test_hash_ignores_row_order_dtypes_and_db_id(offense_table: pl.DataFrame):
+    hashes = get_hashes(offense_table)
+    
+    # as if an earlier incident gained a row, every db_id shifts
+    shifted = offense_table.with_columns(db_id = pl.concat_str(pl.lit("2022_"), pl.int_range(1, pl.len() + 1).cast(pl.String)))
+    reversed_rows = offense_table.reverse()
+    as_strings = offense_table.with_columns(pl.col(pl.Categorical).cast(pl.String))
+    
+    assert len(hashes) == offense_table.select("ori", "incident_number").n_unique()
+    assert get_hashes(shifted) == hashes
+    assert get_hashes(reversed_rows) == hashes
+    assert get_hashes(as_strings) == hashes
+
+def test_hash_changes_with_any_value(offense_table: pl.DataFrame):
+    hashes = get_hashes(offense_table)
+    ori, incident_number = get_incident(offense_table, 1)
+    is_incident = (pl.col("ori") == ori) & (pl.col("incident_number") == incident_number)
+    
+    changed = offense_table.with_columns(
+        offense_attempted_or_completed = pl.when(is_incident).then(pl.lit("X"))
+                                           .otherwise(pl.col("offense_attempted_or_completed").cast(pl.String)))
+    changed_hashes = get_hashes(changed)
+    
+    assert changed_hashes[(ori, incident_number)] != hashes[(ori, incident_number)]
+    assert {key: value for key, value in changed_hashes.items() if key != (ori, incident_number)} == \
+        {key: value for key, value in hashes.items() if key != (ori, incident_number)}
+
+def test_identical_releases_have_no_changes(offense_table: pl.DataFrame):
+    delta = IncidentDelta.compare(offense_table, offense_table.reverse(), "offense_segment", 2022)
+    
+    assert delta.changes.num_rows == delta.rows.num_rows == 0
+    assert delta.summarize() == {"inserted": 0, "updated": 0, "deleted": 0, "rows": 0, "pct_rows": 0.0}
+
+def test_compare_finds_inserted_updated_and_deleted_incidents(offense_table: pl.DataFrame):
+    keys = offense_table.select("ori", "incident_number").unique(maintain_order = True).rows()
+    updated = get_incident(offense_table, 2)
+    deleted, inserted = [key for key in keys if key != updated][:2]
+    
+    def is_key(key: tuple) -> pl.Expr:
+        return (pl.col("ori") == key[0]) & (pl.col("incident_number") == key[1])
+    
+    previous_table = offense_table.filter(~is_key(inserted))
+    # the updated incident loses its last row
+    is_last_row = pl.int_range(pl.len()).over("ori", "incident_number") == pl.len().over("ori", "incident_number") - 1
+    new_table = offense_table.filter(~is_key(deleted), ~(is_key(updated) & is_last_row))
+    
+    delta = IncidentDelta.compare(previous_table, new_table.to_arrow(), "offense_segment", 2022)
+    
+    assert {(row["ori"], row["incident_number"]): row["change"] for row in delta.changes.to_pylist()} == \
+        {inserted: "inserted", updated: "updated", deleted: "deleted"}
+    
+    # the release keeps the db_ids of the rows that previous_table has, and numbers the others on after its last row
+    out_table = pl.from_arrow(delta.table)
+    last_row = previous_table["db_id"].str.split("_").list.last().cast(pl.Int64).max()
+    n_inserted_rows = new_table.filter(is_key(inserted)).height
+    
+    assert out_table.drop("db_id").equals(new_table.drop("db_id"))
+    assert out_table.filter(~is_key(inserted)).equals(new_table.filter(~is_key(inserted)))
+    assert out_table.filter(is_key(inserted))["db_id"].to_list() == [f"2022_{last_row + 1 + i}" for i in range(n_inserted_rows)]
+    
+    # the rows of the inserted and updated incidents, in the new release's order
+    assert pl.from_arrow(delta.rows).equals(out_table.filter(is_key(inserted) | is_key(updated)))
+    assert delta.summarize()["rows"] == delta.rows.num_rows
+    assert delta.summarize()["updated"] == 1
@@ -0,0 +1,75 @@
+import pytest
+
+pytest.importorskip("s3fs") # aws_integration imports it for its readers
+moto = pytest.importorskip("moto")
+
+import boto3
+from botocore.exceptions import ClientError
+
+from utils import AmazonS3
+
+BUCKET_NAME = "nibrs-test"
+PART_SIZE = 5 * 1024 * 1024
+
+@pytest.fixture
+def s3_client():
+    with moto.mock_aws():
+        client = boto3.client("s3", region_name = "us-east-1")
+        client.create_bucket(Bucket = BUCKET_NAME)
+        
+        yield client
+
+@pytest.fixture
+def aws_s3_tool(s3_client) -> AmazonS3:
+    return AmazonS3(region_name = "us-east-1", aws_access_key_id = "testing", aws_secret_access_key = "testing",
+                    part_size = PART_SIZE, max_concurrency = 2)
+
+def list_uploads(s3_client) -> list:
+    return s3_client.list_multipart_uploads(Bucket = BUCKET_NAME).get("Uploads", [])
+
+def test_parts_are_uploaded_and_completed(s3_client, aws_s3_tool: AmazonS3):
+    data = bytes(range(256)) * (PART_SIZE // 256 * 2 + 100)
+    
+    with aws_s3_tool.open_multipart_writer(bucket_name = BUCKET_NAME, object_name = "segment.parquet") as writer:
+        for start in range(0, len(data), 1024 * 1024):
+            writer.write(data[start:start + 1024 * 1024])
+    
+    out_object = s3_client.get_object(Bucket = BUCKET_NAME, Key = "segment.parquet")
+    
+    assert out_object["Body"].read() == data
+    assert out_object["ETag"].strip('"').endswith("-3")
+    assert list_uploads(s3_client) == []
+
+def test_error_in_with_block_aborts_the_upload(s3_client, aws_s3_tool: AmazonS3):
+    with pytest.raises(RuntimeError):
+        with aws_s3_tool.open_multipart_writer(bucket_name = BUCKET_NAME, object_name = "segment.parquet") as writer:
+            writer.write(b"0" * (PART_SIZE + 1))
+            raise RuntimeError("decoding failed")
+    
+    assert writer.closed
+    assert "Contents" not in s3_client.list_objects_v2(Bucket = BUCKET_NAME)
+    assert list_uploads(s3_client) == []
+
+def test_failed_part_aborts_the_upload(s3_client, aws_s3_tool: AmazonS3, monkeypatch):
+    writer = aws_s3_tool.open_multipart_writer(bucket_name = BUCKET_NAME, object_name = "segment.parquet")
+    
+    def fail_upload_part(**kwargs):
+        raise ClientError({"Error": {"Code": "InternalError", "Message": "part failed"}}, "UploadPart")
+    
+    monkeypatch.setattr(writer.client, "upload_part", fail_upload_part)
+    writer.write(b"0" * (PART_SIZE * 2))
+    
+    with pytest.raises(ClientError):
+        writer.close()
+    
+    assert "Contents" not in s3_client.list_objects_v2(Bucket = BUCKET_NAME)
+    assert list_uploads(s3_client) == []
+
+def test_clients_are_cached_per_config(aws_s3_tool: AmazonS3):
+    client = aws_s3_tool._get_s3_client()
+    
+    assert aws_s3_tool._get_s3_client() is client
+    
+    aws_s3_tool.max_concurrency = 32
+    
+    assert aws_s3_tool._get_s3_client().meta.config.max_pool_connections == 32
@@ -0,0 +1,98 @@
+import pytest
+
+from utils import NIBRSDecoder, NIBRSCodeMapper, SegmentValidator, SyntheticMasterFile
+
+def corrupt(lines: list, config: dict, segment_name: str, row: int, col_name: str, value: bytes) -> None:
+    '''
+    overwrites col_name of the row-th record of segment_name in lines (e.g., with a shifted or unknown value)
+    '''
+    code = config["segment_level_codes"][segment_name].encode()
+    i = [i for i, line in enumerate(lines) if line.startswith(code)][row]
+    start, end = config[segment_name][col_name][:2]
+    
+    assert len(value) == end - start
+    lines[i] = lines[i][:start] + value + lines[i][end:]
+
+def truncate(lines: list, config: dict, segment_name: str, row: int, length: int) -> None:
+    code = config["segment_level_codes"][segment_name].encode()
+    i = [i for i, line in enumerate(lines) if line.startswith(code)][row]
+    lines[i] = lines[i][:length] + b"\n"
+
+@pytest.fixture
+def lines(config: dict, nibrs_codes: dict) -> list:
+    return SyntheticMasterFile(config, nibrs_codes, seed = 1).generate_chunk(500).splitlines(keepends = True)
+
+def validate(lines: list, config: dict, nibrs_codes: dict, tmp_path, batch_size: int = None, **decoder_args) -> dict:
+    '''
+    decodes lines as a master file with a SegmentValidator, and returns its violations by segment, column, and check
+    '''
+    master_file = tmp_path.joinpath("2022_NIBRS_NATIONAL_MASTER_FILE_ENC.txt")
+    master_file.write_bytes(b"".join(lines))
+    
+    validator = SegmentValidator(config, NIBRSCodeMapper(nibrs_codes))
+    decoder = NIBRSDecoder(str(master_file), config, validator = validator, **decoder_args)
+    segment_names = list(config["segment_level_codes"])
+    
+    if batch_size:
+        for _ in decoder.iter_segment_batches(segment_names, batch_size = batch_size):
+            pass
+    else:
+        decoder.decode_segments(segment_names)
+    
+    return {(violation["segment"], violation["column"], violation["check"]): violation
+            for violation in validator.violations().to_pylist()}
+
+def test_clean_records_have_no_violations(lines: list, config: dict, nibrs_codes: dict, tmp_path):
+    assert validate(lines, config, nibrs_codes, tmp_path, engine = "numpy") == {}
+
+@pytest.mark.parametrize("decoder_args", [{"engine": "numpy"}, {"engine": "pandas"}], ids = ["numpy", "pandas"])
+def test_corrupted_records_are_reported(lines: list, config: dict, nibrs_codes: dict, tmp_path, decoder_args: dict):
+    corrupt(lines, config, "administrative_segment", 10, "incident_date", b"2022AB01")
+    corrupt(lines, config, "administrative_segment", 11, "incident_date", b"20221345")
+    corrupt(lines, config, "administrative_segment", 20, "incident_date_hour", b"X1")
+    corrupt(lines, config, "offense_segment", 5, "ucr_offense_code", b"ZZZ")
+    truncate(lines, config, "administrative_segment", 30, 40)
+    
+    violations = validate(lines, config, nibrs_codes, tmp_path, **decoder_args)
+    
+    assert violations.keys() == {
+        ("administrative_segment", "incident_date", "unparseable"),
+        ("administrative_segment", "incident_date_hour", "unparseable"),
+        ("administrative_segment", "*", "record_length"),
+        ("offense_segment", "ucr_offense_code", "unknown_code")
+        }
+    
+    assert violations[("administrative_segment", "incident_date", "unparseable")]["sample_rows"] == [10, 11]
+    assert violations[("administrative_segment", "incident_date", "unparseable")]["sample_values"] == ["2022AB01", "20221345"]
+    assert violations[("administrative_segment", "incident_date_hour", "unparseable")]["sample_rows"] == [20]
+    assert violations[("administrative_segment", "*", "record_length")]["sample_values"] == ["40"]
+    assert violations[("offense_segment", "ucr_offense_code", "unknown_code")]["count"] == 1
+    assert violations[("offense_segment", "ucr_offense_code", "unknown_code")]["sample_rows"] == [5]
+
+@pytest.mark.parametrize("decoder_args", [{"engine": "numpy", "batch_size": 64}, {"engine": "numpy", "n_workers": 2}],
+                         ids = ["batches", "parallel"])
+def test_row_numbers_are_within_the_segment(lines: list, config: dict, nibrs_codes: dict, tmp_path, decoder_args: dict):
+    corrupt(lines, config, "administrative_segment", 3, "incident_date", b"2022AB01")
+    corrupt(lines, config, "administrative_segment", 470, "incident_date", b"2022AB01")
+    corrupt(lines, config, "offense_segment", 200, "ucr_offense_code", b"ZZZ")
+    
+    violations = validate(lines, config, nibrs_codes, tmp_path, **decoder_args)
+    
+    assert violations[("administrative_segment", "incident_date", "unparseable")]["sample_rows"] == [3, 470]
+    assert violations[("offense_segment", "ucr_offense_code", "unknown_code")]["sample_rows"] == [200]
+
+def test_summarize_counts_violations_per_check(lines: list, config: dict, nibrs_codes: dict, tmp_path):
+    corrupt(lines, config, "offense_segment", 5, "ucr_offense_code", b"ZZZ")
+    corrupt(lines, config, "offense_segment", 6, "ucr_offense_code", b"ZZY")
+    
+    master_file = tmp_path.joinpath("2022_NIBRS_NATIONAL_MASTER_FILE_ENC.txt")
+    master_file.write_bytes(b"".join(lines))
+    
+    validator = SegmentValidator(config, NIBRSCodeMapper(nibrs_codes))
+    NIBRSDecoder(str(master_file), config, engine = "numpy", validator = validator).decode_segments(["offense_segment"])
+    
+    summary = validator.summarize()
+    
+    assert summary["unknown_code"] == 2
+    assert summary["unparseable"] == summary["record_length"] == 0
+    assert summary["rows"]["offense_segment"] == sum(line.startswith(b"02") for line in lines)
@@ -0,0 +1,54 @@
+import os
+from pathlib import Path
+
+import pytest
+
+from utils import Task, TaskScheduler
+
+# the tasks run in spawned worker processes, so they are module-level functions of plain arguments
+
+def crash_once(marker_file: str) -> str:
+    '''
+    kills its worker process on the first call, as the OOM killer would, and succeeds on the next
+    '''
+    if not Path(marker_file).exists():
+        Path(marker_file).touch()
+        os._exit(1)
+    
+    return "recovered"
+
+def crash() -> str:
+    os._exit(1)
+
+def succeed(value: str) -> str:
+    return value
+
+def test_task_is_retried_after_its_worker_dies(tmp_path):
+    tasks = [Task("crash_once", crash_once, args = (str(tmp_path.joinpath("crashed")),)),
+             Task("sibling", succeed, args = ("ok",)),
+             Task("dependent", succeed, args = ("done",), deps = ("crash_once",))]
+    
+    statuses, results = TaskScheduler(max_cpus = 2, max_memory_gb = 4, max_retries = 1).run(tasks)
+    
+    assert statuses == {"crash_once": "succeeded", "sibling": "succeeded", "dependent": "succeeded"}
+    assert results == {"crash_once": "recovered", "sibling": "ok", "dependent": "done"}
+    assert tasks[0].attempts == 2
+
+def test_task_fails_once_its_retries_run_out():
+    tasks = [Task("crash", crash),
+             Task("dependent", succeed, args = ("done",), deps = ("crash",))]
+    
+    statuses, results = TaskScheduler(max_cpus = 2, max_memory_gb = 4, max_retries = 1).run(tasks)
+    
+    assert statuses == {"crash": "failed", "dependent": "skipped"}
+    assert "BrokenProcessPool" in results["crash"]
+    assert tasks[0].attempts == 2
+
+def test_dependency_cycle_is_rejected():
+    tasks = [Task("a", succeed, args = ("a",), deps = ("c",)),
+             Task("b", succeed, args = ("b",), deps = ("a",)),
+             Task("c", succeed, args = ("c",), deps = ("b",)),
+             Task("d", succeed, args = ("d",))]
+    
+    with pytest.raises(ValueError, match = "a, b, c"):
+        TaskScheduler(max_cpus = 2, max_memory_gb = 4).run(tasks)